@@ -0,0 +1 @@
+"""Benchmarks for the dashboard app. Run modules with `python -m bench.<name>`."""
@@ -0,0 +1,167 @@
+"""Deterministic synthetic data: buyers, socs, cabinets, EUR/USD rates and records.
+
+    python -m bench.datagen --out /tmp/statka-bench.db [--users 10 --socs 2 --cabs 3 --days 60]
+
+The schema is created by the checked-out main.py (imported once in a
+subprocess); the rows are then written with plain SQL against the columns
+the app has had since its first version, so the same generator seeds any
+commit and the numbers measured on them are comparable. The same arguments
+and --seed always produce the same rows (timestamps included). Every
+GEO/vertical cell that has a CPA in CPA_SLOTS / CPA_CRASH can get a record;
+--fill is the share of cells filled per cabinet and day.
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BENCH_PASSWORD = "bench"
+ADMIN = ("ADMIN_HEAD", "chinCHIN")   # создаётся самим main.py на пустой базе
+END_DATE = "2024-06-30"
+
+# печатает CPA-таблицы и хэш пароля — только то, что есть в main.py с первой версии
+_APP_INFO = f"""
+import json, main
+print(json.dumps({{"cpa": {{"Slots": main.CPA_SLOTS, "Crash": main.CPA_CRASH}},
+                  "hash": main.hash_password({BENCH_PASSWORD!r})}}))
+"""
+
+UPSERT_SQL = """
+    INSERT INTO records (user, user_id, date, geo, vertical, cabinet_id,
+                         spend_raw, spend_currency, spend, deps, revenue, profit, spend_usd,
+                         created_at, updated_at)
+    VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+    ON CONFLICT(user, date, geo, vertical, cabinet_id) DO UPDATE SET
+      spend_raw=excluded.spend_raw, spend_currency=excluded.spend_currency, spend=excluded.spend,
+      spend_usd=excluded.spend_usd, deps=excluded.deps, revenue=excluded.revenue,
+      profit=excluded.profit, updated_at=excluded.updated_at
+"""
+
+
+def app_env(db_path: str, **extra) -> dict:
+    """Environment for running main.py against `db_path`."""
+    env = dict(os.environ, DATA_PATH=os.path.abspath(db_path), **extra)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, (ROOT, env.get("PYTHONPATH"))))
+    return env
+
+
+def init_app_db(db_path: str) -> dict:
+    """Let main.py create (and migrate) the database; returns its CPA tables and a password hash."""
+    workdir = tempfile.mkdtemp(prefix="bench-init-")  # main.py создаёт ./backups
+    out = subprocess.run([sys.executable, "-c", _APP_INFO], cwd=workdir, env=app_env(db_path),
+                         check=True, capture_output=True, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def record_row(uname, uid, d, geo, vertical, cab, spend, deps, cpa, rate, ts) -> tuple:
+    """Row for UPSERT_SQL, computed the way input_save does it."""
+    factor = 1.0 + cab["commission_pct"] / 100.0 if cab["cab_type"] == "AGENCY" else 1.0
+    spend_usd = round(spend * factor * rate, 4)
+    revenue = deps * cpa
+    return (uname, uid, d, geo, vertical, cab["id"], int(round(spend)), cab["currency"],
+            int(round(spend_usd)), deps, revenue, revenue - int(round(spend_usd)), spend_usd, ts, ts)
+
+
+def generate(db_path: str, users=10, socs=2, cabs=3, days=60, fill=0.6, seed=1, end=END_DATE) -> dict:
+    """Create `db_path` with synthetic data; returns row counts and the date range."""
+    app = init_app_db(db_path)
+    rng = random.Random(seed)
+    last = date.fromisoformat(end)
+    dates = [(last - timedelta(days=days - 1 - i)).isoformat() for i in range(days)]
+    ts = f"{end} 12:00:00"
+    cells = [(geo, vertical, cpa) for vertical, table in app["cpa"].items()
+             for geo, cpa in sorted(table.items()) if cpa is not None]
+    # один хэш на всех: bcrypt здесь не то, что измеряем
+    ph = app["hash"]
+    n_records = 0
+    conn = sqlite3.connect(db_path)
+    try:
+        with conn:
+            fx = {}
+            for d in dates:
+                fx[d] = round(rng.uniform(1.05, 1.12), 4)
+                conn.execute("""
+                    INSERT INTO fx_rates (date, from_currency, to_currency, rate) VALUES (?,?,?,?)
+                    ON CONFLICT(date, from_currency, to_currency) DO UPDATE SET rate=excluded.rate
+                """, (d, "EUR", "USD", fx[d]))
+        for u in range(1, users + 1):
+            uname = f"buyer{u:03d}"
+            with conn:
+                uid = conn.execute(
+                    "INSERT INTO users (username, password_hash, role, created_at) VALUES (?,?,?,?)",
+                    (uname, ph, "BUYER", ts)).lastrowid
+                user_cabs = []
+                for s in range(1, socs + 1):
+                    soc_id = conn.execute(
+                        "INSERT INTO socs (user_id, name, created_at) VALUES (?,?,?)",
+                        (uid, f"{uname}-soc{s}", ts)).lastrowid
+                    for k in range(1, cabs + 1):
+                        cab = {"currency": rng.choice(("USD", "EUR")),
+                               "cab_type": rng.choice(("AGENCY", "FARM")),
+                               "commission_pct": rng.choice((5.0, 6.0, 8.0)),
+                               "status": "BANNED" if rng.random() < 0.1 else "ACTIVE"}
+                        cab["id"] = conn.execute("""
+                            INSERT INTO cabinets (soc_id, name, status, currency, cab_type,
+                                                  commission_pct, created_at)
+                            VALUES (?,?,?,?,?,?,?)
+                        """, (soc_id, f"{uname}-s{s}-cab{k}", cab["status"], cab["currency"],
+                              cab["cab_type"], cab["commission_pct"], ts)).lastrowid
+                        user_cabs.append(cab)
+            for d in dates:
+                rows = []
+                for cab in user_cabs:
+                    rate = 1.0 if cab["currency"] == "USD" else fx[d]
+                    for geo, vertical, cpa in cells:
+                        if rng.random() >= fill:
+                            continue
+                        spend = round(rng.uniform(20, 600), 2)
+                        deps = rng.choices((0, 1, 2, 3, 4, 5), (30, 25, 20, 12, 8, 5))[0]
+                        rows.append(record_row(uname, uid, d, geo, vertical, cab, spend, deps, cpa, rate, ts))
+                with conn:
+                    conn.executemany(UPSERT_SQL, rows)
+                n_records += len(rows)
+        conn.execute("PRAGMA optimize")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        conn.close()
+    return {"users": users, "socs": users * socs, "cabinets": users * socs * cabs,
+            "records": n_records, "start": dates[0], "end": dates[-1]}
+
+
+def add_args(ap: argparse.ArgumentParser):
+    ap.add_argument("--users", type=int, default=10, help="buyers (buyer001, ...)")
+    ap.add_argument("--socs", type=int, default=2, help="socs per buyer")
+    ap.add_argument("--cabs", type=int, default=3, help="cabinets per soc")
+    ap.add_argument("--days", type=int, default=60, help=f"days of records ending {END_DATE}")
+    ap.add_argument("--fill", type=float, default=0.6, help="share of GEO/vertical cells with a record")
+    ap.add_argument("--seed", type=int, default=1)
+
+
+def gen_kwargs(args) -> dict:
+    return dict(users=args.users, socs=args.socs, cabs=args.cabs, days=args.days,
+                fill=args.fill, seed=args.seed)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--out", required=True, help="database to create (must not exist)")
+    add_args(ap)
+    args = ap.parse_args(argv)
+    if os.path.exists(args.out):
+        ap.error(f"{args.out} already exists")
+    t0 = time.perf_counter()
+    out = generate(args.out, **gen_kwargs(args))
+    out["seconds"] = round(time.perf_counter() - t0, 2)
+    print(json.dumps(out, indent=2))
+
+
+if __name__ == "__main__":
+    main()
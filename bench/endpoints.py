@@ -0,0 +1,171 @@
+"""Flask test-client microbenchmarks of the hot endpoints on synthetic data.
+
+    python -m bench.endpoints [--n 30] [--out result.json] [--compare previous.json]
+
+Builds a throwaway database with bench.datagen (same options, same seed ->
+same data), then times login, dashboard (one buyer and ALL), data_input,
+input_save and export_csv through the Flask test client. Only HTTP-level
+behaviour is used, so any commit of main.py can be measured; the dashboard
+result cache is whatever DASH_CACHE_MB says (--no-cache sets it to 0).
+Prints one JSON object; --out also writes it to a file and --compare prints
+the p50 ratio against an earlier run to stderr.
+"""
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date
+
+from bench.datagen import ADMIN, BENCH_PASSWORD, ROOT, add_args, gen_kwargs, generate
+
+
+def _git_rev():
+    try:
+        return subprocess.run(["git", "-C", ROOT, "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def _login(client, username, password):
+    resp = client.post("/", data={"username": username, "password": password})
+    if resp.status_code != 302:
+        raise RuntimeError(f"login as {username} failed: {resp.status_code}")
+
+
+def load_app(db_path: str):
+    """Import main.py against `db_path` in this process."""
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    os.makedirs(os.path.join(workdir, "backups"))
+    # дневной бэкап уже «сделан» — первое сохранение не копирует базу во время замера
+    open(os.path.join(workdir, "backups", f"data-{date.today().isoformat()}.db"), "w").close()
+    os.environ["DATA_PATH"] = os.path.abspath(db_path)
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    import main as app_main
+    return app_main
+
+
+def _measure(call, n: int, expect: int) -> dict:
+    call()  # прогрев
+    times, size, errors = [], 0, 0
+    for _ in range(n):
+        t0 = time.perf_counter()
+        resp = call()
+        body = resp.get_data()  # export_csv стримится — дочитываем до конца
+        times.append((time.perf_counter() - t0) * 1000.0)
+        size = len(body)
+        errors += resp.status_code != expect
+    times.sort()
+    return {"n": n, "mean_ms": round(statistics.fmean(times), 3),
+            "p50_ms": round(times[len(times) // 2], 3),
+            "p95_ms": round(times[min(len(times) - 1, int(len(times) * 0.95))], 3),
+            "min_ms": round(times[0], 3), "max_ms": round(times[-1], 3),
+            "bytes": size, "errors": errors}
+
+
+def run(args) -> dict:
+    # лимитер входа не должен срабатывать на сотнях входов подряд
+    for var in ("LOGIN_IP_BURST", "LOGIN_USER_BURST"):
+        os.environ.setdefault(var, "1000000")
+    if args.no_cache:
+        os.environ["DASH_CACHE_MB"] = "0"
+    db_path = os.path.join(tempfile.mkdtemp(prefix="bench-data-"), "bench.db")
+    t0 = time.perf_counter()
+    data = generate(db_path, **gen_kwargs(args))
+    gen_seconds = round(time.perf_counter() - t0, 2)
+    start, end = data["start"], data["end"]
+
+    conn = sqlite3.connect(db_path)
+    try:
+        cab_id, soc_id = conn.execute("""
+            SELECT c.id, c.soc_id FROM cabinets c JOIN socs s ON s.id=c.soc_id
+            JOIN users u ON u.id=s.user_id WHERE u.username='buyer001' ORDER BY c.id LIMIT 1
+        """).fetchone()
+        geos = [r[0] for r in conn.execute("SELECT DISTINCT geo FROM records ORDER BY geo")]
+    finally:
+        conn.close()
+
+    m = load_app(db_path)
+    buyer, admin = m.app.test_client(), m.app.test_client()
+    _login(buyer, "buyer001", BENCH_PASSWORD)
+    _login(admin, *ADMIN)
+    form = {"date": end, "soc_id": soc_id, "cab_id": cab_id}
+    for i, geo in enumerate(geos):
+        form.update({f"spend_slots_{geo}": 100 + i, f"deps_slots_{geo}": i % 4,
+                     f"spend_crash_{geo}": 50 + i, f"deps_crash_{geo}": i % 3})
+    period = {"start_date": start, "end_date": end}
+
+    cases = {
+        "login": (lambda: m.app.test_client().post(
+            "/", data={"username": "buyer001", "password": BENCH_PASSWORD}), 302, args.login_n),
+        "dashboard_user": (lambda: buyer.get("/dashboard", query_string=period), 200, args.n),
+        "dashboard_all": (lambda: admin.get("/dashboard", query_string=dict(period, selected_user="ALL")),
+                          200, args.n),
+        "data_input": (lambda: buyer.get("/input", query_string=form), 200, args.n),
+        "input_save": (lambda: buyer.post("/input/save", data=form), 302, args.n),
+        "export_csv": (lambda: admin.get("/export_csv", query_string={"start": start, "end": end,
+                                                                      "user": "ALL"}), 200, args.n),
+    }
+    only = set(args.only.split(",")) if args.only else None
+    results = {}
+    for name, (call, expect, n) in cases.items():
+        if only and name not in only:
+            continue
+        results[name] = _measure(call, n, expect)
+    return {
+        "meta": {"commit": _git_rev(), "python": platform.python_version(),
+                 "sqlite": sqlite3.sqlite_version, "bcrypt_rounds": os.getenv("BCRYPT_ROUNDS"),
+                 "dash_cache_mb": os.getenv("DASH_CACHE_MB"),
+                 "datagen_seconds": gen_seconds,
+                 "ts": time.strftime("%Y-%m-%d %H:%M:%S")},
+        "data": data,
+        "results": results,
+    }
+
+
+def compare(old: dict, new: dict):
+    print(f"{'case':<22}{'old p50':>10}{'new p50':>10}{'ratio':>8}", file=sys.stderr)
+    for name, res in new["results"].items():
+        before = old.get("results", {}).get(name)
+        if not before:
+            print(f"{name:<22}{'-':>10}{res['p50_ms']:>10.2f}{'-':>8}", file=sys.stderr)
+            continue
+        ratio = res["p50_ms"] / before["p50_ms"] if before["p50_ms"] else float("nan")
+        print(f"{name:<22}{before['p50_ms']:>10.2f}{res['p50_ms']:>10.2f}{ratio:>8.2f}", file=sys.stderr)
+    if old.get("data") != new.get("data"):
+        print("note: datasets differ, compare with the same datagen options", file=sys.stderr)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--n", type=int, default=30, help="timed requests per case")
+    ap.add_argument("--login-n", type=int, default=10, help="timed logins (bcrypt-bound)")
+    ap.add_argument("--only", help="comma-separated case names")
+    ap.add_argument("--no-cache", action="store_true", help="DASH_CACHE_MB=0: dashboards computed every time")
+    ap.add_argument("--out", help="also write the JSON result here")
+    ap.add_argument("--compare", help="earlier JSON result to compare p50 against")
+    add_args(ap)
+    args = ap.parse_args(argv)
+    old = None
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+    result = run(args)
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    if old is not None:
+        compare(old, result)
+
+
+if __name__ == "__main__":
+    main()
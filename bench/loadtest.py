@@ -0,0 +1,294 @@
+"""HTTP load test: a realistic request mix against gunicorn gthread at rising concurrency.
+
+    python -m bench.loadtest [--configs 1x4,1x8,2x8] [--concurrency 1,4,16,32] [--duration 10]
+
+Generates a dataset once with bench.datagen, then for every WORKERSxTHREADS
+config starts `gunicorn -k gthread` on a fresh copy of it and replays the mix
+(dashboard reads, input saves, CSV exports, logins) from N client threads at
+each concurrency level. Reports throughput, p50/p95/p99 latency, error rate
+and how many "database is locked" errors the server logged, as a table on
+stderr and JSON on stdout. Stdlib only on the client side; needs gunicorn.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+from urllib.parse import urlencode
+
+from bench.datagen import BENCH_PASSWORD, ROOT, add_args
+
+LOCKED = "OperationalError: database is locked"
+DEFAULT_MIX = "dashboard=55,save=25,export=10,login=10"
+
+
+def _percentile(sorted_ms: list, p: float):
+    if not sorted_ms:
+        return None
+    return round(sorted_ms[min(len(sorted_ms) - 1, int(len(sorted_ms) * p))], 2)
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _dataset(workdir: str, args) -> tuple[str, dict]:
+    """Generate the seed database in a subprocess (keeps the app out of this process)."""
+    path = os.path.join(workdir, "seed.db")
+    cmd = [sys.executable, "-m", "bench.datagen", "--out", path,
+           "--users", str(args.users), "--socs", str(args.socs), "--cabs", str(args.cabs),
+           "--days", str(args.days), "--fill", str(args.fill), "--seed", str(args.seed)]
+    out = subprocess.run(cmd, cwd=ROOT, check=True, capture_output=True, text=True).stdout
+    info = json.loads(out)
+    conn = sqlite3.connect(path)
+    try:
+        info["cabs"] = {}
+        for uname, cab_id, soc_id in conn.execute("""
+            SELECT u.username, c.id, c.soc_id FROM cabinets c
+            JOIN socs s ON s.id=c.soc_id JOIN users u ON u.id=s.user_id
+            WHERE c.status='ACTIVE' ORDER BY c.id
+        """):
+            info["cabs"].setdefault(uname, []).append((cab_id, soc_id))
+        info["geos"] = [r[0] for r in conn.execute("SELECT DISTINCT geo FROM records ORDER BY geo")]
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        conn.close()
+    return path, info
+
+
+class Server:
+    """One gunicorn gthread instance on a private copy of the seed database."""
+
+    def __init__(self, seed_db: str, workers: int, threads: int, workdir: str):
+        self.dir = tempfile.mkdtemp(prefix=f"w{workers}t{threads}-", dir=workdir)
+        self.db = os.path.join(self.dir, "data.db")
+        shutil.copyfile(seed_db, self.db)
+        self.port = _free_port()
+        self.log_path = os.path.join(self.dir, "server.log")
+        env = dict(os.environ, DATA_PATH=self.db,
+                   LOGIN_IP_BURST="1000000", LOGIN_USER_BURST="1000000")  # все клиенты с 127.0.0.1
+        self._log = open(self.log_path, "w")
+        self.proc = subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "-w", str(workers), "-k", "gthread",
+             "--threads", str(threads), "-b", f"127.0.0.1:{self.port}",
+             "--pythonpath", ROOT, "main:app"],
+            cwd=self.dir, env=env, stdout=self._log, stderr=subprocess.STDOUT)
+
+    def wait_ready(self, timeout: float = 30.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"gunicorn exited, see {self.log_path}")
+            try:
+                conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=2)
+                conn.request("GET", "/health")
+                if conn.getresponse().status == 200:
+                    return
+            except OSError:
+                pass
+            time.sleep(0.2)
+        raise RuntimeError(f"gunicorn not ready after {timeout}s, see {self.log_path}")
+
+    def locked_count(self) -> int:
+        self._log.flush()
+        with open(self.log_path, errors="replace") as f:
+            return sum(LOCKED in line for line in f)
+
+    def stop(self):
+        self.proc.terminate()
+        try:
+            self.proc.wait(15)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+        self._log.close()
+
+
+class VirtualUser(threading.Thread):
+    """A buyer session on one keep-alive connection, issuing the mix until `stop` is set."""
+
+    def __init__(self, port: int, username: str, cabs: list, geos: list, dates: list, mix: dict,
+                 seed: int, stop: threading.Event, results: list):
+        super().__init__(daemon=True)
+        self.port, self.username, self.cabs, self.geos, self.dates = port, username, cabs, geos, dates
+        self.ops, self.weights = list(mix), list(mix.values())
+        self.rng = random.Random(seed)
+        self.stop, self.results = stop, results
+        self.conn = None
+        self.cookie = None
+
+    def _request(self, method: str, path: str, body: dict | None = None):
+        headers = {"Cookie": self.cookie} if self.cookie else {}
+        data = None
+        if body is not None:
+            data = urlencode(body)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=60)
+        try:
+            self.conn.request(method, path, data, headers)
+            resp = self.conn.getresponse()
+            resp.read()
+        except (OSError, http.client.HTTPException):
+            self.conn.close()
+            self.conn = None
+            raise
+        cookie = resp.getheader("Set-Cookie")
+        if cookie:
+            self.cookie = cookie.split(";", 1)[0]
+        return resp
+
+    def _period(self, days: int) -> tuple[str, str]:
+        i = self.rng.randrange(len(self.dates))
+        return self.dates[max(0, i - days + 1)], self.dates[i]
+
+    def login(self):
+        resp = self._request("POST", "/", {"username": self.username, "password": BENCH_PASSWORD})
+        return resp.status == 302
+
+    def dashboard(self):
+        start, end = self._period(self.rng.choice((1, 7, 30)))
+        return self._request("GET", "/dashboard?" + urlencode(
+            {"start_date": start, "end_date": end})).status == 200
+
+    def save(self):
+        cab_id, soc_id = self.rng.choice(self.cabs)
+        form = {"date": self.rng.choice(self.dates), "soc_id": soc_id, "cab_id": cab_id}
+        for geo in self.geos:
+            form[f"spend_slots_{geo}"] = self.rng.randint(0, 500)
+            form[f"deps_slots_{geo}"] = self.rng.randint(0, 4)
+            form[f"spend_crash_{geo}"] = self.rng.randint(0, 300)
+            form[f"deps_crash_{geo}"] = self.rng.randint(0, 3)
+        # при неудачной записи input_save отвечает 503 и возвращает форму
+        return self._request("POST", "/input/save", form).status == 302
+
+    def export(self):
+        start, end = self._period(7)
+        return self._request("GET", "/export_csv?" + urlencode({"start": start, "end": end})).status == 200
+
+    def run(self):
+        try:
+            self.login()
+        except (OSError, http.client.HTTPException):
+            pass
+        while not self.stop.is_set():
+            op = self.rng.choices(self.ops, self.weights)[0]
+            t0 = time.perf_counter()
+            try:
+                ok = getattr(self, op)()
+            except (OSError, http.client.HTTPException):
+                ok = False
+            self.results.append((op, (time.perf_counter() - t0) * 1000.0, ok))
+
+
+def run_level(server: Server, info: dict, concurrency: int, duration: float, mix: dict, seed: int) -> dict:
+    last = date.fromisoformat(info["end"])
+    first = date.fromisoformat(info["start"])
+    dates = [(first + timedelta(days=i)).isoformat() for i in range((last - first).days + 1)]
+    users = sorted(info["cabs"])
+    locked_before = server.locked_count()
+    stop, results = threading.Event(), []
+    vus = []
+    for i in range(concurrency):
+        uname = users[i % len(users)]
+        vus.append(VirtualUser(server.port, uname, info["cabs"][uname], info["geos"], dates, mix,
+                               seed * 1000 + i, stop, results))
+    for vu in vus:
+        vu.start()
+    t0 = time.perf_counter()
+    time.sleep(duration)
+    stop.set()
+    for vu in vus:
+        vu.join(60)
+    elapsed = time.perf_counter() - t0
+
+    def summary(rows):
+        ms = sorted(r[1] for r in rows)
+        errors = sum(not r[2] for r in rows)
+        return {"requests": len(rows), "errors": errors,
+                "error_rate": round(errors / len(rows), 4) if rows else None,
+                "p50_ms": _percentile(ms, 0.50), "p95_ms": _percentile(ms, 0.95),
+                "p99_ms": _percentile(ms, 0.99)}
+
+    out = summary(results)
+    out.update(concurrency=concurrency, rps=round(len(results) / elapsed, 1),
+               locked=server.locked_count() - locked_before,
+               by_op={op: summary([r for r in results if r[0] == op]) for op in mix})
+    return out
+
+
+def _parse_mix(text: str) -> dict:
+    mix = {}
+    for part in text.split(","):
+        op, _, weight = part.partition("=")
+        if op not in ("dashboard", "save", "export", "login"):
+            raise argparse.ArgumentTypeError(f"unknown operation {op!r}")
+        mix[op] = float(weight or 1)
+    return mix
+
+
+def _parse_configs(text: str) -> list:
+    return [tuple(int(x) for x in c.lower().split("x")) for c in text.split(",")]
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--configs", type=_parse_configs, default=_parse_configs("1x4,1x8,2x4"),
+                    help="WORKERSxTHREADS list, e.g. 1x4,2x8")
+    ap.add_argument("--concurrency", default="1,4,16,32", help="client threads per level")
+    ap.add_argument("--duration", type=float, default=10.0, help="seconds per level")
+    ap.add_argument("--mix", type=_parse_mix, default=_parse_mix(DEFAULT_MIX),
+                    help=f"operation weights (default {DEFAULT_MIX})")
+    ap.add_argument("--out", help="also write the JSON result here")
+    ap.add_argument("--keep", action="store_true", help="keep the temp dir with databases and server logs")
+    add_args(ap)
+    args = ap.parse_args(argv)
+    levels = [int(c) for c in args.concurrency.split(",")]
+
+    workdir = tempfile.mkdtemp(prefix="bench-load-")
+    runs = []
+    try:
+        seed_db, info = _dataset(workdir, args)
+        print(f"{'config':<8}{'conc':>6}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'err%':>7}{'locked':>8}",
+              file=sys.stderr)
+        for workers, threads in args.configs:
+            server = Server(seed_db, workers, threads, workdir)
+            try:
+                server.wait_ready()
+                for conc in levels:
+                    res = run_level(server, info, conc, args.duration, args.mix, args.seed)
+                    res.update(workers=workers, threads=threads)
+                    runs.append(res)
+                    print(f"{workers}x{threads:<6}{conc:>6}{res['rps']:>9.1f}{res['p50_ms'] or 0:>9.1f}"
+                          f"{res['p95_ms'] or 0:>9.1f}{res['p99_ms'] or 0:>9.1f}"
+                          f"{100 * (res['error_rate'] or 0):>7.2f}{res['locked']:>8}", file=sys.stderr)
+            finally:
+                server.stop()
+    finally:
+        if args.keep:
+            print(f"kept {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    info.pop("cabs", None)
+    info.pop("geos", None)
+    result = {"data": info, "duration": args.duration, "mix": args.mix, "runs": runs}
+    text = json.dumps(result, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
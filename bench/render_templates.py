@@ -0,0 +1,91 @@
+"""Per-request render cost: render_template_string (old path) vs precompiled templates.
+
+    python -m bench.render_templates [--n 200]
+
+Prints one JSON object with mean milliseconds per render for each page.
+Runs against a throwaway database, the repo's data.db is not touched.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _load_app():
+    tmp = tempfile.mkdtemp(prefix="bench-render-")
+    os.environ["DATA_PATH"] = os.path.join(tmp, "bench.db")
+    os.chdir(tmp)  # main.py creates ./backups
+    sys.path.insert(0, ROOT)
+    import main as app_main
+    return app_main
+
+
+def _contexts(m):
+    cab = {"id": 1, "soc_id": 1, "name": "cab-1", "status": "ACTIVE", "currency": "EUR",
+           "cab_type": "AGENCY", "commission_pct": 6.0}
+    socs = [{"id": i, "name": f"soc-{i}"} for i in range(1, 6)]
+    rows = []
+    for day in range(1, 31):
+        for vertical, cpa in m.CPA_BY_VERTICAL.items():
+            for geo in m.GEOS:
+                if cpa.get(geo) is None:
+                    continue
+                for cab_id in (1, 2, 3):
+                    rows.append({"date": f"2024-01-{day:02d}", "vertical": vertical, "geo": geo,
+                                 "cabinet_id": cab_id, "soc_id": 1, "spend": 100.5, "deps": 2,
+                                 "revenue": 2 * cpa[geo], "profit": 2 * cpa[geo] - 100,
+                                 "last": "2024-01-31 10:00:00"})
+    agg = m.aggregate_dashboard(rows)
+    return {
+        "login.html": {},
+        "accounts.html": dict(role="ADMIN", users=[], socs=socs, by_soc={1: [cab]}, fx_rows=[],
+                              today_iso="2024-01-31"),
+        "input.html": dict(chosen_date="2024-01-31", socs=socs, cabs_by_soc={1: [cab]},
+                           chosen_soc=1, chosen_cab=1, cab=cab, geos=m.GEOS, flags=m.FLAGS,
+                           cpa_slots=m.CPA_SLOTS, cpa_crash=m.CPA_CRASH, existing={}),
+        "dashboard.html": dict(role="ADMIN", session_user="ADMIN_HEAD", users=[],
+                               view_user="ALL", start_date="2024-01-01", end_date="2024-01-31",
+                               socs=[], cabs=[], sel_soc=None, sel_cab=None,
+                               by_vert=agg["by_vert"], by_vert_geo=agg["by_vert_geo"],
+                               total=agg["total"], total_by_geo=agg["total_by_geo"],
+                               by_day=agg["by_day"], per_geo_cab=agg["per_geo_cab"], cab_names={1: "cab-1"},
+                               soc_names={1: "soc-1"}, flags=m.FLAGS),
+    }
+
+
+def _mean_ms(fn, n):
+    fn()  # прогрев
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - t0) * 1000.0 / n
+
+
+def run(n: int) -> dict:
+    m = _load_app()
+    from flask import render_template, render_template_string
+    out = {}
+    with m.app.test_request_context("/"):
+        for name, ctx in _contexts(m).items():
+            source = m.TEMPLATES[name]
+            before = _mean_ms(lambda: render_template_string(source, **ctx), n)
+            after = _mean_ms(lambda: render_template(name, **ctx), n)
+            out[name] = {"render_template_string_ms": round(before, 3),
+                         "precompiled_ms": round(after, 3),
+                         "speedup": round(before / after, 1) if after else None}
+    return out
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--n", type=int, default=200, help="renders per template and path")
+    args = ap.parse_args(argv)
+    print(json.dumps({"n": args.n, "templates": run(args.n)}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
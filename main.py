@@ -1,16 +1,52 @@
 # main.py
 import os
+import atexit
+import io
+import csv
 import sqlite3
 import json
+import math
+import re
+import sys
 import shutil
+import gzip
+import functools
+import hashlib
+import itertools
+import mimetypes
+import tempfile
+import queue
+import random
+import bisect
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import date, datetime
 from zoneinfo import ZoneInfo
 from flask import (
-    Flask, request, redirect, url_for, render_template_string,
-    session, Response, send_file
+    Flask, request, redirect, url_for, render_template,
+    session, Response, g, jsonify, has_app_context, has_request_context
 )
 import bcrypt
+import click
+from jinja2 import ChoiceLoader, DictLoader, FileSystemBytecodeCache
 import logging
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+try:  # опционально: колоночные форматы экспорта (Arrow IPC / Parquet)
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pa = None
+try:  # опционально: Content-Encoding: br
+    import brotli
+except ImportError:
+    brotli = None
 logging.basicConfig(level=logging.INFO)
 
 # ==================== App & Config ====================
@@ -45,135 +81,936 @@ FLAGS = {
     "Greece":"🇬🇷", "Portugal":"🇵🇹"
 }
 
-# ==================== DB bootstrap / migrations ====================
-def ensure_daily_backup():
-    today = date.today().isoformat()
-    backup_path = os.path.join(BACKUP_DIR, f"data-{today}.db")
-    if os.path.exists(DB_PATH) and not os.path.exists(backup_path):
+# ==================== Metrics ====================
+METRICS_DIR = os.getenv("METRICS_DIR")                      # общий каталог снапшотов воркеров
+METRICS_SNAPSHOT_SECONDS = float(os.getenv("METRICS_SNAPSHOT_SECONDS", 10))
+METRICS_SQL = os.getenv("METRICS_SQL", "1") == "1"            # 0 — без замеров SQL (курсор без обёртки)
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 0))         # >0 — включает журнал медленных запросов
+SLOW_QUERY_KEEP = int(os.getenv("SLOW_QUERY_KEEP", 200))     # последних медленных запросов в памяти
+SLOW_QUERY_TOP = int(os.getenv("SLOW_QUERY_TOP", 20))
+SLOW_QUERY_PLAN_EVERY = 100   # план переснимается каждые N медленных выполнений запроса
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+METRIC_HELP = {
+    "http_request_duration_seconds": ("histogram", "Request latency by Flask endpoint."),
+    "sqlite_query_duration_seconds": ("histogram", "execute()/executemany() time by normalized statement."),
+    "sqlite_fetch_seconds_total": ("counter", "Time spent in fetchone/fetchmany/fetchall by statement."),
+    "sqlite_query_rows_total": ("counter", "Rows fetched (SELECT) or changed (DML) by statement."),
+    "sqlite_query_errors_total": ("counter", "Statements that raised, by statement."),
+    "sqlite_write_lock_wait_seconds": ("histogram", "Time to take the write lock (BEGIN IMMEDIATE) by writer."),
+    "sqlite_write_lock_retries_total": ("counter", "BEGIN IMMEDIATE retries after 'database is locked', by writer."),
+    "sqlite_write_lock_failures_total": ("counter", "Writes given up after DB_WRITE_RETRIES, by writer."),
+}
+
+@functools.lru_cache(maxsize=2048)
+def normalize_sql(sql: str) -> str:
+    """One-line statement text with literals and IN-lists folded, used as a label."""
+    s = " ".join(sql.split())
+    s = re.sub(r"'(?:[^']|'')*'", "'?'", s)
+    s = re.sub(r"\b\d+(?:\.\d+)?\b", "N", s)
+    s = re.sub(r"\((?:\s*\?\s*,)+\s*\?\s*\)", "(?…)", s)
+    return s[:200]
+
+class Metrics:
+    """Process-local counters and histograms, rendered in Prometheus text format.
+
+    With METRICS_DIR set every worker also dumps a snapshot there and /metrics
+    sums the snapshots of all live workers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hist = {}       # (name, labels) -> [bucket counts..., sum, count]
+        self._counters = {}   # (name, labels) -> value
+
+    def observe(self, name: str, labels: tuple, value: float, buckets=LATENCY_BUCKETS):
+        key = (name, labels)
+        with self._lock:
+            h = self._hist.get(key)
+            if h is None:
+                h = self._hist[key] = [0] * len(buckets) + [0.0, 0]
+            for i, le in enumerate(buckets):
+                if value <= le:
+                    h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+
+    def inc(self, name: str, labels: tuple, value: float = 1):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            hist = [[n, list(lb), list(h)] for (n, lb), h in self._hist.items()]
+            counters = [[n, list(lb), v] for (n, lb), v in self._counters.items()]
+        return {"pid": os.getpid(), "hist": hist, "counters": counters, "gauges": collect_gauges()}
+
+metrics = Metrics()
+
+def collect_gauges() -> list:
+    """[name, type, labels, value] for the pool, caches and queues of this process."""
+    out = []
+    def add(prefix, stats, counters=()):
+        for k, v in stats.items():
+            if isinstance(v, (int, float)) and not isinstance(v, bool):
+                if k in counters:
+                    out.append([f"{prefix}_{k}_total", "counter", [], v])
+                else:
+                    out.append([f"{prefix}_{k}", "gauge", [], v])
+    add("statka_db_pool", pool.stats(), ("created", "checkouts", "waits", "wait_seconds", "discarded"))
+    add("statka_dashboard_cache", dash_cache.stats(), ("hits", "misses", "stale", "evictions"))
+    add("statka_bcrypt", hasher.stats(), ("hashes", "verifies", "dummy_verifies", "rehashes",
+                                          "rejected", "hash_seconds", "queue_seconds"))
+    add("statka_audit", audit_writer.stats(), ("enqueued", "written", "batches", "dropped", "failed"))
+    add("statka_login", login_limiter.stats(), ("allowed", "limited", "locked", "lockouts"))
+    return out
+
+def _snapshot_path(pid: int) -> str:
+    return os.path.join(METRICS_DIR, f"worker-{pid}.json")
+
+def write_metrics_snapshot():
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    snap = metrics.snapshot()
+    tmp = _snapshot_path(snap["pid"]) + ".tmp"
+    with open(tmp, "w") as fh:
+        json.dump(snap, fh)
+    os.replace(tmp, _snapshot_path(snap["pid"]))
+    return snap
+
+def _metrics_snapshot_loop():
+    while True:
         try:
-            shutil.copyfile(DB_PATH, backup_path)
+            write_metrics_snapshot()
         except Exception:
-            pass
+            logging.exception("metrics snapshot failed")
+        time.sleep(METRICS_SNAPSHOT_SECONDS)
+
+_metrics_thread_pid = None
+_metrics_thread_lock = threading.Lock()
+
+def start_metrics_snapshots():
+    """Start this worker's snapshot thread once; keyed by pid, so forked workers get their own."""
+    global _metrics_thread_pid
+    if not METRICS_DIR or _metrics_thread_pid == os.getpid():
+        return
+    with _metrics_thread_lock:
+        if _metrics_thread_pid == os.getpid():
+            return
+        _metrics_thread_pid = os.getpid()
+    threading.Thread(target=_metrics_snapshot_loop, name="metrics-snapshot", daemon=True).start()
+
+def gather_snapshots() -> list[dict]:
+    """This worker's snapshot plus those of other workers updated recently."""
+    if not METRICS_DIR:
+        return [metrics.snapshot()]
+    own = write_metrics_snapshot()
+    snaps = [own]
+    horizon = time.time() - 3 * METRICS_SNAPSHOT_SECONDS
+    for fn in os.listdir(METRICS_DIR):
+        path = os.path.join(METRICS_DIR, fn)
+        if not fn.endswith(".json") or path == _snapshot_path(own["pid"]):
+            continue
+        try:
+            if os.path.getmtime(path) < horizon:
+                os.remove(path)       # воркер умер или перезапущен
+                continue
+            with open(path) as fh:
+                snaps.append(json.load(fh))
+        except (OSError, ValueError):
+            continue
+    return snaps
+
+def _label_str(labels) -> str:
+    if not labels:
+        return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in labels) + "}"
+
+def render_metrics(snaps: list[dict]) -> str:
+    hist, counters, gauges, types = {}, {}, {}, {}
+    for snap in snaps:
+        for name, labels, h in snap["hist"]:
+            key = (name, tuple(map(tuple, labels)))
+            acc = hist.setdefault(key, [0] * len(h))
+            for i, v in enumerate(h):
+                acc[i] += v
+        for name, labels, v in snap["counters"]:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + v
+        for name, kind, labels, v in snap["gauges"]:
+            types[name] = kind
+            if kind == "counter":
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + v
+            else:
+                gauges[(name, tuple(map(tuple, labels)) + (("worker", snap["pid"]),))] = v
+
+    lines = []
+    def header(name, kind):
+        help_ = METRIC_HELP.get(name, (kind, name.replace("_", " ")))[1]
+        lines.append(f"# HELP {name} {help_}")
+        lines.append(f"# TYPE {name} {kind}")
+    for name in sorted({n for n, _ in hist}):
+        header(name, "histogram")
+        for (n, labels), h in sorted(hist.items()):
+            if n != name:
+                continue
+            for le, cnt in zip(LATENCY_BUCKETS, h):
+                lines.append(f"{name}_bucket{_label_str(labels + (('le', le),))} {cnt}")
+            lines.append(f"{name}_bucket{_label_str(labels + (('le', '+Inf'),))} {h[-1]}")
+            lines.append(f"{name}_sum{_label_str(labels)} {h[-2]}")
+            lines.append(f"{name}_count{_label_str(labels)} {h[-1]}")
+    for name in sorted({n for n, _ in counters}):
+        header(name, "counter")
+        lines += [f"{name}{_label_str(lb)} {v}" for (n, lb), v in sorted(counters.items()) if n == name]
+    for name in sorted({n for n, _ in gauges}):
+        header(name, "gauge")
+        lines += [f"{name}{_label_str(lb)} {v}" for (n, lb), v in sorted(gauges.items()) if n == name]
+    return "\n".join(lines) + "\n"
+
+def param_shape(params) -> list | dict:
+    """Types of bound parameters, never their values."""
+    if isinstance(params, dict):
+        return {k: type(v).__name__ for k, v in params.items()}
+    return [type(v).__name__ for v in params]
+
+class SlowQueryLog:
+    """Statements slower than SLOW_QUERY_MS: recent entries plus per-statement totals.
+
+    The query plan is captured with EXPLAIN QUERY PLAN on the first slow
+    execution of a statement and re-sampled every SLOW_QUERY_PLAN_EVERY
+    executions, so only the statements that keep showing up pay for it.
+    """
+
+    def __init__(self, threshold_ms: float, keep: int = 200):
+        self.threshold = threshold_ms / 1000.0
+        self._recent = deque(maxlen=keep)
+        self._by_sql = {}
+        self._lock = threading.Lock()
+
+    def record(self, conn, sql: str, params, seconds: float, rows: int, many: int | None):
+        key = normalize_sql(sql)
+        with self._lock:
+            agg = self._by_sql.get(key)
+            if agg is None:
+                agg = self._by_sql[key] = {"sql": key, "count": 0, "total_ms": 0.0, "max_ms": 0.0,
+                                           "rows": 0, "plan": None, "plan_at": None}
+            agg["count"] += 1
+            agg["total_ms"] += seconds * 1000
+            agg["max_ms"] = max(agg["max_ms"], seconds * 1000)
+            agg["rows"] += rows
+            need_plan = agg["plan"] is None or agg["count"] % SLOW_QUERY_PLAN_EVERY == 0
+        plan = self._explain(conn, sql, params) if need_plan else None
+        entry = {
+            "ts": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+            "sql": key, "params": param_shape(params), "ms": round(seconds * 1000, 3),
+            "rows": rows, "endpoint": request.endpoint if has_request_context() else None,
+        }
+        if many is not None:
+            entry["many"] = many
+        with self._lock:
+            if plan is not None:
+                agg["plan"], agg["plan_at"] = plan, entry["ts"]
+                entry["plan"] = plan
+            self._recent.append(entry)
+        logging.warning("slow query %.1f ms, %d rows: %s", entry["ms"], rows, key)
+
+    @staticmethod
+    def _explain(conn, sql: str, params) -> list[str] | None:
+        try:
+            # базовый курсор: сам EXPLAIN не должен попадать в метрики и в журнал
+            cur = sqlite3.Cursor(conn)
+            return [r[3] for r in cur.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+        except sqlite3.Error as e:
+            return [f"unavailable: {e}"]
+
+    def report(self, top: int = SLOW_QUERY_TOP) -> dict:
+        with self._lock:
+            by_sql = [dict(a, total_ms=round(a["total_ms"], 3), max_ms=round(a["max_ms"], 3))
+                      for a in self._by_sql.values()]
+            recent = list(self._recent)
+        by_sql.sort(key=lambda a: a["total_ms"], reverse=True)
+        return {"threshold_ms": self.threshold * 1000, "top": by_sql[:top],
+                "recent": recent[::-1]}
+
+    def reset(self):
+        with self._lock:
+            self._recent.clear()
+            self._by_sql.clear()
+
+slow_log = SlowQueryLog(SLOW_QUERY_MS, SLOW_QUERY_KEEP) if SLOW_QUERY_MS > 0 else None
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor that reports statement time and row counts to `metrics`.
+
+    With the slow-query log on it also keeps the statement's time (execute
+    plus fetch calls; plain iteration counts only the execute) and hands it to
+    `slow_log` once the statement is done.
+    """
+
+    _label = None
+    _iterated = 0
+    _slow = None      # [sql, params, seconds, rows, many] пока запрос не дочитан
+
+    def _timed(self, method, sql, *args):
+        label = (("query", normalize_sql(sql)),)
+        t0 = time.perf_counter()
+        try:
+            cur = method(sql, *args)
+        except Exception:
+            metrics.inc("sqlite_query_errors_total", label)
+            raise
+        finally:
+            took = time.perf_counter() - t0
+            metrics.observe("sqlite_query_duration_seconds", label, took)
+        self._label, self._iterated = label, 0
+        dml = self.description is None
+        if dml and self.rowcount > 0:
+            metrics.inc("sqlite_query_rows_total", label, self.rowcount)
+        if slow_log is not None:
+            many = None
+            params = args[0]
+            if method.__name__ == "executemany":
+                many, params = len(params), (params[0] if params else ())
+            self._slow = [sql, params, took, max(self.rowcount, 0) if dml else 0, many]
+            if dml:
+                self._slow_done()
+        return cur
+
+    def _slow_done(self):
+        st, self._slow = self._slow, None
+        if st is not None and st[2] >= slow_log.threshold:
+            slow_log.record(self.connection, *st)
+
+    def execute(self, sql, parameters=()):
+        return self._timed(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        if slow_log is not None and not isinstance(seq_of_parameters, (list, tuple)):
+            seq_of_parameters = list(seq_of_parameters)   # для числа строк и первого набора в журнале
+        return self._timed(super().executemany, sql, seq_of_parameters)
+
+    def _fetched(self, rows: int, t0: float, done: bool):
+        if self._label is not None:
+            took = time.perf_counter() - t0
+            metrics.inc("sqlite_fetch_seconds_total", self._label, took)
+            if rows:
+                metrics.inc("sqlite_query_rows_total", self._label, rows)
+            if self._slow is not None:
+                self._slow[2] += took
+                self._slow[3] += rows
+                if done:
+                    self._slow_done()
+
+    def __next__(self):
+        # построчная итерация: только счётчик, в метрики — один раз в конце
+        try:
+            row = super().__next__()
+        except StopIteration:
+            if self._iterated and self._label is not None:
+                metrics.inc("sqlite_query_rows_total", self._label, self._iterated)
+            if self._slow is not None:
+                self._slow[3] += self._iterated
+                self._slow_done()
+            self._iterated = 0
+            raise
+        self._iterated += 1
+        return row
+
+    def fetchone(self):
+        t0 = time.perf_counter()
+        row = super().fetchone()
+        # одна строка — обычно весь результат (lookup по ключу)
+        self._fetched(row is not None, t0, True)
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        t0 = time.perf_counter()
+        rows = super().fetchmany(size)
+        self._fetched(len(rows), t0, len(rows) < size)
+        return rows
+
+    def fetchall(self):
+        t0 = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(len(rows), t0, True)
+        return rows
+
+class InstrumentedConnection(sqlite3.Connection):
+    """Connection whose execute()/cursor() go through InstrumentedCursor."""
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+@app.before_request
+def _start_timer():
+    # снапшоты пишет каждый воркер с первого запроса, а не только тот, что отдаёт /metrics
+    start_metrics_snapshots()
+    g.request_t0 = time.perf_counter()
+
+@app.teardown_request
+def _observe_request(exc):
+    t0 = g.pop("request_t0", None)
+    if t0 is None:
+        return
+    status = g.pop("response_status", 500 if exc is not None else 200)
+    metrics.observe("http_request_duration_seconds",
+                    (("endpoint", request.endpoint or "unmatched"), ("method", request.method),
+                     ("status", str(status))),
+                    time.perf_counter() - t0)
+
+@app.after_request
+def _remember_status(resp):
+    g.response_status = resp.status_code
+    return resp
+
+# ==================== DB connection pool ====================
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 8))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", 5000))
+DB_WRITE_RETRIES = int(os.getenv("DB_WRITE_RETRIES", 3))           # повторов BEGIN IMMEDIATE после busy_timeout
+DB_WRITE_BACKOFF_MS = float(os.getenv("DB_WRITE_BACKOFF_MS", 50))  # базовая пауза, удваивается, с джиттером
+
+# применяются один раз при открытии соединения, а не на каждый запрос
+DB_PRAGMAS = (
+    f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}",
+    "PRAGMA synchronous=NORMAL",      # в WAL-режиме безопасно и без fsync на каждый коммит
+    "PRAGMA cache_size=-16000",       # ~16 MB page cache на соединение
+    "PRAGMA mmap_size=134217728",     # 128 MB
+    "PRAGMA temp_store=MEMORY",
+)
 
-def migrate():
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    with conn:
-        conn.execute("PRAGMA journal_mode=WAL;")
+class ConnectionPool:
+    """Bounded pool of SQLite connections shared by the worker threads.
+
+    Connections are opened lazily up to `size` and handed out LIFO, so the
+    most recently used one (with a warm page cache) is reused first.
+    """
+
+    def __init__(self, path: str, size: int = 8, timeout: float = 10.0):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0
+        self._counters = {
+            "created": 0, "checkouts": 0, "waits": 0,
+            "wait_seconds": 0.0, "discarded": 0,
+        }
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT_MS / 1000.0,
+                               check_same_thread=False,
+                               factory=InstrumentedConnection if METRICS_SQL or slow_log else sqlite3.Connection)
+        conn.row_factory = sqlite3.Row
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = None
+        if conn is None:
+            with self._lock:
+                can_open = self._opened < self.size
+                if can_open:
+                    self._opened += 1
+            if can_open:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._opened -= 1
+                    raise
+                with self._lock:
+                    self._counters["created"] += 1
+            else:
+                t0 = time.perf_counter()
+                try:
+                    conn = self._idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise sqlite3.OperationalError("connection pool exhausted") from None
+                with self._lock:
+                    self._counters["waits"] += 1
+                    self._counters["wait_seconds"] += time.perf_counter() - t0
+        with self._lock:
+            self._counters["checkouts"] += 1
+        return conn
+
+    def release(self, conn: sqlite3.Connection):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except Exception:
+            # соединение в неизвестном состоянии — выбрасываем, пул откроет новое
+            try:
+                conn.close()
+            except Exception:
+                pass
+            with self._lock:
+                self._opened -= 1
+                self._counters["discarded"] += 1
+            return
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """Checkout for code running outside a request (CLI, background threads)."""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def stats(self) -> dict:
+        with self._lock:
+            out = dict(self._counters)
+            out["opened"] = self._opened
+        out["size"] = self.size
+        out["idle"] = self._idle.qsize()
+        out["in_use"] = out["opened"] - out["idle"]
+        out["wait_seconds"] = round(out["wait_seconds"], 6)
+        return out
+
+pool = ConnectionPool(DB_PATH, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT)
+
+def _is_locked(exc: sqlite3.OperationalError) -> bool:
+    msg = str(exc)
+    return "database is locked" in msg or "database is busy" in msg
+
+@contextmanager
+def write_tx(conn: sqlite3.Connection):
+    """BEGIN IMMEDIATE ... COMMIT; a locked BEGIN is retried with jittered backoff.
+
+    The write lock is taken up front: a deferred transaction that reads and
+    then writes can't wait on busy_timeout when it upgrades and fails with
+    "database is locked" straight away. Lock waits are reported to `metrics`.
+    """
+    label = (("writer", request.endpoint if has_request_context() else threading.current_thread().name),)
+    t0 = time.perf_counter()
+    for attempt in range(DB_WRITE_RETRIES + 1):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            break
+        except sqlite3.OperationalError as e:
+            if not _is_locked(e) or attempt == DB_WRITE_RETRIES:
+                metrics.inc("sqlite_write_lock_failures_total", label)
+                raise
+            metrics.inc("sqlite_write_lock_retries_total", label)
+            time.sleep(DB_WRITE_BACKOFF_MS / 1000.0 * (2 ** attempt) * random.uniform(0.5, 1.5))
+    metrics.observe("sqlite_write_lock_wait_seconds", label, time.perf_counter() - t0)
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+# ==================== Passwords (bcrypt) ====================
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))            # cost factor для новых хэшей
+BCRYPT_WORKERS = int(os.getenv("BCRYPT_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+BCRYPT_MAX_PENDING = int(os.getenv("BCRYPT_MAX_PENDING", 32))  # очередь + в работе
+BCRYPT_QUEUE_TIMEOUT = float(os.getenv("BCRYPT_QUEUE_TIMEOUT", 5))
+
+class HasherBusy(RuntimeError):
+    """Raised when the bcrypt queue stays full for longer than the timeout."""
+
+class PasswordHasher:
+    """Runs bcrypt on a small bounded thread pool.
+
+    bcrypt releases the GIL while hashing, so a few dedicated threads keep a
+    login burst from occupying every request thread; at most `max_pending`
+    jobs are queued, further callers wait up to `timeout` and then get
+    HasherBusy. Unknown users are verified against a dummy hash of the same
+    cost, so response time does not reveal whether a username exists.
+    """
+
+    def __init__(self, rounds: int = 12, workers: int = 2,
+                 max_pending: int = 32, timeout: float = 5.0):
+        self.rounds = rounds
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = None
+        self._dummy = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._running = 0
+        self._counters = {
+            "hashes": 0, "verifies": 0, "dummy_verifies": 0, "rehashes": 0,
+            "rejected": 0, "hash_seconds": 0.0, "hash_seconds_max": 0.0,
+            "queue_seconds": 0.0,
+        }
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self._counters["rejected"] += 1
+            raise HasherBusy("bcrypt queue is full")
+        submitted = time.perf_counter()
+        with self._lock:
+            self._pending += 1
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="bcrypt")
+
+        def job():
+            started = time.perf_counter()
+            with self._lock:
+                self._running += 1
+            try:
+                return fn(*args)
+            finally:
+                took = time.perf_counter() - started
+                with self._lock:
+                    self._running -= 1
+                    self._pending -= 1
+                    c = self._counters
+                    c["hash_seconds"] += took
+                    c["hash_seconds_max"] = max(c["hash_seconds_max"], took)
+                    c["queue_seconds"] += started - submitted
+                self._slots.release()
+
+        return self._executor.submit(job).result()
+
+    def _count(self, key: str):
+        with self._lock:
+            self._counters[key] += 1
+
+    def hash(self, pw: str) -> str:
+        self._count("hashes")
+        salt = bcrypt.gensalt(self.rounds)
+        return self._run(bcrypt.hashpw, pw.encode(), salt).decode()
+
+    def verify(self, pw: str, ph: str | None) -> bool:
+        """Checks pw against ph; with ph=None burns the same time and returns False."""
+        if ph is None:
+            self._count("dummy_verifies")
+            self._run(bcrypt.checkpw, pw.encode(), self.dummy_hash())
+            return False
+        self._count("verifies")
+        try:
+            return self._run(bcrypt.checkpw, pw.encode(), ph.encode())
+        except HasherBusy:
+            raise
+        except Exception:
+            return False
 
-        # users
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-          id INTEGER PRIMARY KEY AUTOINCREMENT,
-          username TEXT UNIQUE NOT NULL,
-          password_hash TEXT NOT NULL,
-          role TEXT NOT NULL CHECK(role IN ('BUYER','TEAM_LEAD','ADMIN')) DEFAULT 'BUYER',
-          is_active INTEGER NOT NULL DEFAULT 1,
-          is_deleted INTEGER NOT NULL DEFAULT 0,
-          created_at TEXT NOT NULL DEFAULT (datetime('now'))
-        )
-        """)
-        cols_u = {r[1]: True for r in conn.execute("PRAGMA table_info(users)").fetchall()}
-        if "is_deleted" not in cols_u:
-            conn.execute("ALTER TABLE users ADD COLUMN is_deleted INTEGER NOT NULL DEFAULT 0")
+    def rehash(self, pw: str) -> str:
+        self._count("rehashes")
+        return self.hash(pw)
 
-        # socs
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS socs (
-          id INTEGER PRIMARY KEY AUTOINCREMENT,
-          user_id INTEGER NOT NULL,
-          name TEXT NOT NULL,
-          is_closed INTEGER NOT NULL DEFAULT 0,
-          created_at TEXT NOT NULL DEFAULT (datetime('now'))
-        )
-        """)
+    def dummy_hash(self) -> bytes:
+        if self._dummy is None:
+            salt = bcrypt.gensalt(self.rounds)
+            self._dummy = self._run(bcrypt.hashpw, os.urandom(16).hex().encode(), salt)
+        return self._dummy
 
-        # cabinets
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS cabinets (
-          id INTEGER PRIMARY KEY AUTOINCREMENT,
-          soc_id INTEGER NOT NULL,
-          name TEXT NOT NULL,
-          status TEXT NOT NULL CHECK(status IN ('ACTIVE','BANNED')) DEFAULT 'ACTIVE',
-          currency TEXT NOT NULL CHECK(currency IN ('USD','EUR')),
-          cab_type TEXT NOT NULL CHECK(cab_type IN ('AGENCY','FARM')),
-          commission_pct REAL NOT NULL DEFAULT 6.0,
-          created_at TEXT NOT NULL DEFAULT (datetime('now'))
-        )
-        """)
+    def needs_rehash(self, ph: str) -> bool:
+        """True when ph was made with a different cost factor than the current one."""
+        try:
+            return int(ph.split("$")[2]) != self.rounds
+        except (IndexError, ValueError):
+            return False
+
+    def stats(self) -> dict:
+        with self._lock:
+            out = dict(self._counters)
+            out["pending"] = self._pending
+            out["running"] = self._running
+        out["queued"] = out["pending"] - out["running"]
+        done = out["hashes"] + out["verifies"] + out["dummy_verifies"]
+        out["hash_seconds_avg"] = round(out["hash_seconds"] / done, 6) if done else 0.0
+        for k in ("hash_seconds", "hash_seconds_max", "queue_seconds"):
+            out[k] = round(out[k], 6)
+        out.update(rounds=self.rounds, workers=self.workers, max_pending=self.max_pending)
+        return out
+
+hasher = PasswordHasher(BCRYPT_ROUNDS, workers=BCRYPT_WORKERS,
+                        max_pending=BCRYPT_MAX_PENDING, timeout=BCRYPT_QUEUE_TIMEOUT)
+
+@app.errorhandler(HasherBusy)
+def hasher_busy(exc):
+    return "Password service is busy, try again", 503
 
-        # fx_rates
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS fx_rates (
-          id INTEGER PRIMARY KEY AUTOINCREMENT,
-          date TEXT NOT NULL,
-          from_currency TEXT NOT NULL CHECK(from_currency IN ('USD','EUR')),
-          to_currency TEXT NOT NULL CHECK(to_currency IN ('USD')),
-          rate REAL NOT NULL,
-          UNIQUE(date, from_currency, to_currency)
-        )
-        """)
+def hash_password(pw: str) -> str:
+    return hasher.hash(pw)
 
-        # day_locks
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS day_locks (
-          user_id INTEGER NOT NULL,
-          date TEXT NOT NULL,
-          locked_at TEXT NOT NULL DEFAULT (datetime('now')),
-          PRIMARY KEY (user_id, date)
-        )
-        """)
+def check_password(pw: str, ph: str | None) -> bool:
+    return hasher.verify(pw, ph)
 
-        # audit_log
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS audit_log (
-          id INTEGER PRIMARY KEY AUTOINCREMENT,
-          ts TEXT NOT NULL DEFAULT (datetime('now')),
-          actor_user TEXT NOT NULL,
-          action TEXT NOT NULL,
-          payload TEXT
-        )
-        """)
+# ==================== Backups ====================
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", 14))            # сколько дневных копий хранить
+BACKUP_COMPRESS = os.getenv("BACKUP_COMPRESS", "0") == "1"  # gzip дневных копий
 
-        # records (legacy + new columns)
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS records (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user TEXT,
-            date TEXT,
-            geo TEXT,
-            vertical TEXT,
-            spend INTEGER,
-            deps INTEGER,
-            revenue INTEGER,
-            profit INTEGER
-        )
-        """)
-        cols = {r[1]: True for r in conn.execute("PRAGMA table_info(records)").fetchall()}
-        if "created_at" not in cols:
-            conn.execute("ALTER TABLE records ADD COLUMN created_at TEXT NOT NULL DEFAULT (datetime('now'))")
-        if "updated_at" not in cols:
-            conn.execute("ALTER TABLE records ADD COLUMN updated_at TEXT")
-        if "user_id" not in cols:
-            conn.execute("ALTER TABLE records ADD COLUMN user_id INTEGER")
-        if "cabinet_id" not in cols:
-            conn.execute("ALTER TABLE records ADD COLUMN cabinet_id INTEGER")
-        if "spend_raw" not in cols:
-            conn.execute("ALTER TABLE records ADD COLUMN spend_raw REAL")
-        if "spend_currency" not in cols:
-            conn.execute("ALTER TABLE records ADD COLUMN spend_currency TEXT")
-        if "spend_usd" not in cols:
-            conn.execute("ALTER TABLE records ADD COLUMN spend_usd REAL")
-
-        conn.execute("DROP INDEX IF EXISTS ux_records_user_date_geo_vert")
-        conn.execute("""
-        CREATE UNIQUE INDEX IF NOT EXISTS ux_records_user_date_geo_vert_cab
-        ON records(user, date, geo, vertical, cabinet_id)
-        """)
-    conn.close()
+_backup_lock = threading.Lock()
+_backup_state = {"running": False, "last_day": None, "last_error": None}
+
+def snapshot_db(dest_path: str):
+    """Consistent copy of the live DB via the online backup API, in one step.
+
+    Unlike copying the file this sees committed WAL content and never a torn
+    page. The copy runs inside one read transaction, which in WAL mode does
+    not block writers. A stepped backup restarts from page 0 after every
+    commit by another connection, so with steady saves it might never finish.
+    """
+    tmp = dest_path + ".part"
+    src = sqlite3.connect(DB_PATH)
+    dst = sqlite3.connect(tmp)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+    os.replace(tmp, dest_path)
+
+def _daily_backup_paths(day: str) -> tuple[str, str]:
+    base = os.path.join(BACKUP_DIR, f"data-{day}.db")
+    return base, base + ".gz"
+
+def rotate_backups(keep: int = BACKUP_KEEP):
+    names = sorted(
+        n for n in os.listdir(BACKUP_DIR)
+        if n.startswith("data-") and (n.endswith(".db") or n.endswith(".db.gz"))
+    )
+    for n in names[:-keep] if keep > 0 else []:
+        try:
+            os.remove(os.path.join(BACKUP_DIR, n))
+        except OSError:
+            logging.warning("backup rotation: cannot remove %s", n)
+
+def run_daily_backup(day: str):
+    plain, gz = _daily_backup_paths(day)
+    lock_fh = None
+    try:
+        if fcntl is not None:
+            # другой воркер уже делает копию — не дублируем
+            lock_fh = open(os.path.join(BACKUP_DIR, ".backup.lock"), "a")
+            try:
+                fcntl.flock(lock_fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return
+        if os.path.exists(plain) or os.path.exists(gz):
+            return
+        t0 = time.perf_counter()
+        snapshot_db(plain)
+        if BACKUP_COMPRESS:
+            with open(plain, "rb") as f_in, gzip.open(gz + ".part", "wb", compresslevel=6) as f_out:
+                shutil.copyfileobj(f_in, f_out, 1024 * 1024)
+            os.replace(gz + ".part", gz)
+            os.remove(plain)
+        rotate_backups()
+        logging.info("daily backup %s done in %.2fs", day, time.perf_counter() - t0)
+        _backup_state["last_error"] = None
+    except Exception as e:
+        _backup_state["last_error"] = repr(e)
+        _backup_state["last_day"] = None  # повторим при следующем сохранении
+        logging.exception("daily backup failed")
+    finally:
+        if lock_fh is not None:
+            lock_fh.close()
+        with _backup_lock:
+            _backup_state["running"] = False
+
+def ensure_daily_backup():
+    """Start today's backup in a background thread if it doesn't exist yet; never blocks."""
+    today = date.today().isoformat()
+    if _backup_state["last_day"] == today or not os.path.exists(DB_PATH):
+        return
+    with _backup_lock:
+        if _backup_state["running"] or _backup_state["last_day"] == today:
+            return
+        _backup_state["running"] = True
+        _backup_state["last_day"] = today
+    threading.Thread(target=run_daily_backup, args=(today,), name="daily-backup",
+                     daemon=True).start()
+
+# ==================== DB bootstrap / migrations ====================
+# Ключ роллапа — та же гранулярность, что и у records, но без «сырых» колонок:
+# дашборд читает узкую таблицу, упорядоченную по дате. NULL-идентификаторы
+# легаси-строк сворачиваются в 0, т.к. колонки первичного ключа NOT NULL.
+ROLLUP_USER_ID = "COALESCE({r}.user_id, (SELECT id FROM users WHERE username={r}.user), 0)"
+ROLLUP_KEY_OK = "{r}.date IS NOT NULL AND {r}.geo IS NOT NULL AND {r}.vertical IS NOT NULL"
+
+def _rollup_add_sql(r: str) -> str:
+    return f"""
+      INSERT INTO daily_rollups (date, user_id, cabinet_id, vertical, geo,
+                                 spend_usd, deps, revenue, profit, n_records, updated_at)
+      SELECT {r}.date, {ROLLUP_USER_ID.format(r=r)}, IFNULL({r}.cabinet_id, 0), {r}.vertical, {r}.geo,
+             ROUND(IFNULL({r}.spend_usd, 0), 4), IFNULL({r}.deps, 0), IFNULL({r}.revenue, 0), IFNULL({r}.profit, 0),
+             1, {r}.updated_at
+      WHERE {ROLLUP_KEY_OK.format(r=r)}
+      ON CONFLICT(date, user_id, cabinet_id, vertical, geo) DO UPDATE SET
+        spend_usd=ROUND(spend_usd + excluded.spend_usd, 4),
+        deps=deps + excluded.deps,
+        revenue=revenue + excluded.revenue,
+        profit=profit + excluded.profit,
+        n_records=n_records + 1,
+        updated_at=MAX(IFNULL(updated_at, ''), IFNULL(excluded.updated_at, ''));
+    """
+
+def _rollup_sub_sql(r: str) -> str:
+    key = f"""date={r}.date AND user_id={ROLLUP_USER_ID.format(r=r)}
+              AND cabinet_id=IFNULL({r}.cabinet_id, 0) AND vertical={r}.vertical AND geo={r}.geo"""
+    return f"""
+      UPDATE daily_rollups SET
+        spend_usd=ROUND(spend_usd - IFNULL({r}.spend_usd, 0), 4),
+        deps=deps - IFNULL({r}.deps, 0),
+        revenue=revenue - IFNULL({r}.revenue, 0),
+        profit=profit - IFNULL({r}.profit, 0),
+        n_records=n_records - 1
+      WHERE {key};
+      DELETE FROM daily_rollups WHERE {key} AND n_records<=0;
+    """
+
+def _fill_daily_rollups(conn):
+    conn.execute("DELETE FROM daily_rollups")
+    conn.execute(f"""
+        INSERT INTO daily_rollups (date, user_id, cabinet_id, vertical, geo,
+                                   spend_usd, deps, revenue, profit, n_records, updated_at)
+        SELECT date, {ROLLUP_USER_ID.format(r="records")} AS uid, IFNULL(cabinet_id, 0) AS cab,
+               vertical, geo,
+               ROUND(IFNULL(SUM(spend_usd), 0), 4), IFNULL(SUM(deps), 0),
+               IFNULL(SUM(revenue), 0), IFNULL(SUM(profit), 0),
+               COUNT(*), MAX(updated_at)
+        FROM records
+        WHERE {ROLLUP_KEY_OK.format(r="records")}
+        GROUP BY date, uid, cab, vertical, geo
+    """)
+
+def rebuild_daily_rollups(conn) -> int:
+    """Recompute daily_rollups from records in one transaction; returns row count."""
+    with write_tx(conn):
+        _fill_daily_rollups(conn)
+        conn.execute(_REPORTS_BUMP_SQL)
+    return conn.execute("SELECT COUNT(*) FROM daily_rollups").fetchone()[0]
+
+# Миграции: (версия, функция). Версия хранится в PRAGMA user_version; каждая
+# миграция выполняется один раз в своей транзакции. Новые — только в конец списка.
+def _m001_base_schema(conn):
+    # users
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      username TEXT UNIQUE NOT NULL,
+      password_hash TEXT NOT NULL,
+      role TEXT NOT NULL CHECK(role IN ('BUYER','TEAM_LEAD','ADMIN')) DEFAULT 'BUYER',
+      is_active INTEGER NOT NULL DEFAULT 1,
+      is_deleted INTEGER NOT NULL DEFAULT 0,
+      created_at TEXT NOT NULL DEFAULT (datetime('now'))
+    )
+    """)
+    cols_u = {r[1]: True for r in conn.execute("PRAGMA table_info(users)").fetchall()}
+    if "is_deleted" not in cols_u:
+        conn.execute("ALTER TABLE users ADD COLUMN is_deleted INTEGER NOT NULL DEFAULT 0")
+
+    # socs
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS socs (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      user_id INTEGER NOT NULL,
+      name TEXT NOT NULL,
+      is_closed INTEGER NOT NULL DEFAULT 0,
+      created_at TEXT NOT NULL DEFAULT (datetime('now'))
+    )
+    """)
+
+    # cabinets
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS cabinets (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      soc_id INTEGER NOT NULL,
+      name TEXT NOT NULL,
+      status TEXT NOT NULL CHECK(status IN ('ACTIVE','BANNED')) DEFAULT 'ACTIVE',
+      currency TEXT NOT NULL CHECK(currency IN ('USD','EUR')),
+      cab_type TEXT NOT NULL CHECK(cab_type IN ('AGENCY','FARM')),
+      commission_pct REAL NOT NULL DEFAULT 6.0,
+      created_at TEXT NOT NULL DEFAULT (datetime('now'))
+    )
+    """)
+
+    # fx_rates
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS fx_rates (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      date TEXT NOT NULL,
+      from_currency TEXT NOT NULL CHECK(from_currency IN ('USD','EUR')),
+      to_currency TEXT NOT NULL CHECK(to_currency IN ('USD')),
+      rate REAL NOT NULL,
+      UNIQUE(date, from_currency, to_currency)
+    )
+    """)
+
+    # day_locks
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS day_locks (
+      user_id INTEGER NOT NULL,
+      date TEXT NOT NULL,
+      locked_at TEXT NOT NULL DEFAULT (datetime('now')),
+      PRIMARY KEY (user_id, date)
+    )
+    """)
+
+    # audit_log
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS audit_log (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      ts TEXT NOT NULL DEFAULT (datetime('now')),
+      actor_user TEXT NOT NULL,
+      action TEXT NOT NULL,
+      payload TEXT
+    )
+    """)
+
+    # records (legacy + new columns)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS records (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user TEXT,
+        date TEXT,
+        geo TEXT,
+        vertical TEXT,
+        spend INTEGER,
+        deps INTEGER,
+        revenue INTEGER,
+        profit INTEGER
+    )
+    """)
+    cols = {r[1]: True for r in conn.execute("PRAGMA table_info(records)").fetchall()}
+    if "created_at" not in cols:
+        conn.execute("ALTER TABLE records ADD COLUMN created_at TEXT NOT NULL DEFAULT (datetime('now'))")
+    if "updated_at" not in cols:
+        conn.execute("ALTER TABLE records ADD COLUMN updated_at TEXT")
+    if "user_id" not in cols:
+        conn.execute("ALTER TABLE records ADD COLUMN user_id INTEGER")
+    if "cabinet_id" not in cols:
+        conn.execute("ALTER TABLE records ADD COLUMN cabinet_id INTEGER")
+    if "spend_raw" not in cols:
+        conn.execute("ALTER TABLE records ADD COLUMN spend_raw REAL")
+    if "spend_currency" not in cols:
+        conn.execute("ALTER TABLE records ADD COLUMN spend_currency TEXT")
+    if "spend_usd" not in cols:
+        conn.execute("ALTER TABLE records ADD COLUMN spend_usd REAL")
+
+    conn.execute("DROP INDEX IF EXISTS ux_records_user_date_geo_vert")
+    conn.execute("""
+    CREATE UNIQUE INDEX IF NOT EXISTS ux_records_user_date_geo_vert_cab
+    ON records(user, date, geo, vertical, cabinet_id)
+    """)
 
     # первичный ADMIN
-    conn = sqlite3.connect(DB_PATH); conn.row_factory = sqlite3.Row
-    cnt = conn.execute("SELECT COUNT(*) AS c FROM users").fetchone()["c"]
+    cnt = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
     if cnt == 0:
         ph = bcrypt.hashpw(b"chinCHIN", bcrypt.gensalt()).decode()
         conn.execute("INSERT INTO users (username, password_hash, role) VALUES (?,?,?)",
@@ -181,37 +1018,273 @@ def migrate():
         today = date.today().isoformat()
         conn.execute("INSERT OR IGNORE INTO fx_rates (date, from_currency, to_currency, rate) VALUES (?,?,?,?)",
                      (today, "EUR", "USD", 1.10))
-        conn.commit()
-    conn.close()
 
-migrate()
+def _m002_daily_rollups(conn):
+    # daily_rollups: предагрегат для дашборда, поддерживается триггерами на records
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS daily_rollups (
+      date TEXT NOT NULL,
+      user_id INTEGER NOT NULL,
+      cabinet_id INTEGER NOT NULL,
+      vertical TEXT NOT NULL,
+      geo TEXT NOT NULL,
+      spend_usd REAL NOT NULL DEFAULT 0,
+      deps INTEGER NOT NULL DEFAULT 0,
+      revenue INTEGER NOT NULL DEFAULT 0,
+      profit INTEGER NOT NULL DEFAULT 0,
+      n_records INTEGER NOT NULL DEFAULT 0,
+      updated_at TEXT,
+      PRIMARY KEY (date, user_id, cabinet_id, vertical, geo)
+    ) WITHOUT ROWID
+    """)
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_records_rollup_ins AFTER INSERT ON records BEGIN
+      {_rollup_add_sql("NEW")}
+    END
+    """)
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_records_rollup_upd AFTER UPDATE ON records BEGIN
+      {_rollup_sub_sql("OLD")}
+      {_rollup_add_sql("NEW")}
+    END
+    """)
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_records_rollup_del AFTER DELETE ON records BEGIN
+      {_rollup_sub_sql("OLD")}
+    END
+    """)
+    _fill_daily_rollups(conn)
+
+def _m003_report_indexes(conn):
+    # индексы под реальные фильтры страниц (см. hot_queries / check-query-plans)
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS ix_records_date_user_vert_geo
+    ON records(date, user, vertical, geo)
+    """)
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS ix_records_uid_cab_date
+    ON records(user_id, cabinet_id, date, geo, vertical, spend_raw, spend_currency, deps)
+    """)
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS ix_rollups_user_date
+    ON daily_rollups(user_id, date, spend_usd, deps, revenue, profit, updated_at)
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_cabinets_soc_name ON cabinets(soc_id, name)")
+    conn.execute("CREATE INDEX IF NOT EXISTS ix_socs_user_name ON socs(user_id, name)")
+
+def _m004_counters(conn):
+    # версии кэшей, общие для всех воркеров (fx и т.п.)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS counters (
+      name TEXT PRIMARY KEY,
+      value INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID
+    """)
+    conn.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('fx', 0)")
+
+def _m005_login_limits(conn):
+    # состояние лимитера входа для LOGIN_LIMIT_STORE=sqlite (общее для воркеров)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS login_limits (
+      key TEXT PRIMARY KEY,
+      tokens REAL NOT NULL,
+      updated REAL NOT NULL,
+      failures INTEGER NOT NULL DEFAULT 0,
+      locked_until REAL NOT NULL DEFAULT 0
+    ) WITHOUT ROWID
+    """)
+
+# узкие индексы (фильтр, ts) + неявный rowid: выдача ts DESC, id DESC идёт по
+# индексу без сортировки, а в индексе нет payload — на десятках миллионов строк
+# он в разы меньше таблицы. Те же индексы создаются в архивных базах.
+AUDIT_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS ix_audit_ts ON audit_log(ts)",
+    "CREATE INDEX IF NOT EXISTS ix_audit_actor_ts ON audit_log(actor_user, ts)",
+    "CREATE INDEX IF NOT EXISTS ix_audit_action_ts ON audit_log(action, ts)",
+)
 
-# ==================== Helpers ====================
-def db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+def _m006_audit_indexes(conn):
+    for sql in AUDIT_INDEXES:
+        conn.execute(sql)
+
+def _dv_bump_sql(d: str) -> str:
+    return f"""
+      INSERT INTO data_versions (date, version) SELECT {d}, 1 WHERE {d} IS NOT NULL
+      ON CONFLICT(date) DO UPDATE SET version=version+1;"""
+
+_REPORTS_BUMP_SQL = """
+      INSERT INTO counters (name, value) VALUES ('reports', 1)
+      ON CONFLICT(name) DO UPDATE SET value=value+1;"""
+
+def _m007_data_versions(conn):
+    # версия данных по дате — ключ валидности кэша отчётов; бампается триггерами
+    # в той же транзакции, что и изменение. Справочники (кабинеты/SOC) меняют
+    # подписи и фильтры для всех дат — для них общий счётчик 'reports'.
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS data_versions (
+      date TEXT PRIMARY KEY,
+      version INTEGER NOT NULL
+    ) WITHOUT ROWID
+    """)
+    conn.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('reports', 0)")
+    for table, key in (("records", "date"), ("day_locks", "date"), ("fx_rates", "date")):
+        conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_dv_ins AFTER INSERT ON {table} BEGIN
+          {_dv_bump_sql("NEW." + key)}
+        END
+        """)
+        conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_dv_upd AFTER UPDATE ON {table} BEGIN
+          {_dv_bump_sql("NEW." + key)}
+          {_dv_bump_sql(f"(CASE WHEN OLD.{key} IS NOT NEW.{key} THEN OLD.{key} END)")}
+        END
+        """)
+        conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_dv_del AFTER DELETE ON {table} BEGIN
+          {_dv_bump_sql("OLD." + key)}
+        END
+        """)
+    for table in ("cabinets", "socs"):
+        for op in ("INSERT", "UPDATE", "DELETE"):
+            conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_reports_{op[:3].lower()} AFTER {op} ON {table} BEGIN
+              {_REPORTS_BUMP_SQL}
+            END
+            """)
+
+def _m008_spend_exact(conn):
+    # spend_raw хранится целым (так показывает форма), а spend_usd считался от
+    # введённого значения — для пересчёта по новому курсу нужно точное.
+    # Старым строкам точное неизвестно: пересчёт берёт для них spend_raw.
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(records)").fetchall()}
+    if "spend_exact" not in cols:
+        conn.execute("ALTER TABLE records ADD COLUMN spend_exact REAL")
+
+# колонки выгрузки (EXPORT_SQL) после ключа сортировки — оба индекса покрывающие:
+# выгрузка идёт по индексу без обращений к таблице и без временного B-дерева
+_EXPORT_COLS = "cabinet_id, spend_raw, spend_currency, spend_usd, deps, revenue, profit, updated_at"
+
+def _m009_export_indexes(conn):
+    # ALL: date, user, vertical, geo, id = ORDER BY; заменяет ix_records_date_user_vert_geo.
+    # Один пользователь: user=? фиксирован, дальше тот же порядок. id в ключе — чтобы
+    # батчи выгрузки продолжались с позиции последней строки (keyset)
+    conn.execute("DROP INDEX IF EXISTS ix_records_date_user_vert_geo")
+    conn.execute(f"""
+    CREATE INDEX IF NOT EXISTS ix_records_export_date
+    ON records(date, user, vertical, geo, id, {_EXPORT_COLS})
+    """)
+    conn.execute(f"""
+    CREATE INDEX IF NOT EXISTS ix_records_export_user
+    ON records(user, date, vertical, geo, id, {_EXPORT_COLS})
+    """)
+
+def _m010_export_null_safe_keys(conn):
+    # user/vertical/geo легаси-строк бывают NULL, а (…) > (…) с NULL даёт NULL: батч
+    # выгрузки, закончившийся на такой строке, терял всё после неё. Ключ — IFNULL(col,''),
+    # одинаково в индексе, ORDER BY и условии продолжения (EXPORT_KEY_ALL/EXPORT_KEY_USER);
+    # сами колонки остаются в индексе, чтобы он оставался покрывающим
+    conn.execute("DROP INDEX IF EXISTS ix_records_export_date")
+    conn.execute("DROP INDEX IF EXISTS ix_records_export_user")
+    conn.execute(f"""
+    CREATE INDEX IF NOT EXISTS ix_records_export_date
+    ON records(date, IFNULL(user,''), IFNULL(vertical,''), IFNULL(geo,''), id,
+               user, vertical, geo, {_EXPORT_COLS})
+    """)
+    conn.execute(f"""
+    CREATE INDEX IF NOT EXISTS ix_records_export_user
+    ON records(user, date, IFNULL(vertical,''), IFNULL(geo,''), id, vertical, geo, {_EXPORT_COLS})
+    """)
+
+MIGRATIONS = [
+    (1, _m001_base_schema),
+    (2, _m002_daily_rollups),
+    (3, _m003_report_indexes),
+    (4, _m004_counters),
+    (5, _m005_login_limits),
+    (6, _m006_audit_indexes),
+    (7, _m007_data_versions),
+    (8, _m008_spend_exact),
+    (9, _m009_export_indexes),
+    (10, _m010_export_null_safe_keys),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+@contextmanager
+def _migration_lock():
+    # один воркер мигрирует, остальные ждут на flock; на Windows fcntl нет —
+    # там блокировку даёт только BEGIN IMMEDIATE
+    if fcntl is None:
+        yield
+        return
+    with open(DB_PATH + ".migrate.lock", "a") as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
 
-def audit(actor_user: str, action: str, payload: dict):
+def schema_version(conn) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate() -> int:
+    """Bring the schema to SCHEMA_VERSION; returns the number of migrations applied.
+
+    The steady-state boot path is a single `PRAGMA user_version` read.
+    """
+    conn = sqlite3.connect(DB_PATH, isolation_level=None)
     try:
-        conn = db()
-        with conn:
-            conn.execute(
-                "INSERT INTO audit_log (actor_user, action, payload) VALUES (?,?,?)",
-                (actor_user, action, json.dumps(payload, ensure_ascii=False))
-            )
+        if schema_version(conn) >= SCHEMA_VERSION:
+            return 0
+        with _migration_lock():
+            current = schema_version(conn)  # пока ждали лок, мог отработать другой воркер
+            if current >= SCHEMA_VERSION:
+                return 0
+            conn.execute("PRAGMA journal_mode=WAL")
+            applied = 0
+            for version, fn in MIGRATIONS:
+                if version <= current:
+                    continue
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    fn(conn)
+                    conn.execute(f"PRAGMA user_version={version}")
+                    conn.execute("COMMIT")
+                except Exception:
+                    conn.execute("ROLLBACK")
+                    raise
+                logging.info("schema migrated to v%d (%s)", version, fn.__name__)
+                applied += 1
+            return applied
+    finally:
         conn.close()
-    except Exception:
-        pass
 
-def hash_password(pw: str) -> str:
-    return bcrypt.hashpw(pw.encode(), bcrypt.gensalt()).decode()
+migrate()
 
-def check_password(pw: str, ph: str) -> bool:
-    try:
-        return bcrypt.checkpw(pw.encode(), ph.encode())
-    except Exception:
-        return False
+# ==================== Helpers ====================
+def db():
+    """Request-scoped connection: taken from the pool once, returned on teardown."""
+    if "db_conn" not in g:
+        g.db_conn = pool.acquire()
+    return g.db_conn
+
+@contextmanager
+def db_or_pooled():
+    """db() inside a request, otherwise a pooled connection for the block.
+
+    A request must not take a second pooled connection while holding its
+    own: under load every slot is held by a request waiting for another one.
+    """
+    if has_app_context():
+        yield db()
+    else:
+        with pool.connection() as conn:
+            yield conn
+
+@app.teardown_appcontext
+def release_db(exc):
+    conn = g.pop("db_conn", None)
+    if conn is not None:
+        pool.release(conn)
 
 def utc_to_msk(ts: str | None) -> str:
     if not ts: return "—"
@@ -240,43 +1313,391 @@ def safe_float(x, default=0.0):
     except Exception:
         return default
 
+def read_counter(conn, name: str) -> int:
+    row = conn.execute("SELECT value FROM counters WHERE name=?", (name,)).fetchone()
+    return row[0] if row else 0
+
+def bump_counter(conn, name: str):
+    # вызывать внутри транзакции, меняющей данные, — иначе другие воркеры увидят
+    # новую версию раньше самих данных
+    conn.execute("""
+        INSERT INTO counters (name, value) VALUES (?, 1)
+        ON CONFLICT(name) DO UPDATE SET value=value+1
+    """, (name,))
+
+FX_FALLBACK_RATE = 1.10
+
+class FxTable:
+    """In-memory copy of fx_rates: per currency, dates sorted ascending + rates."""
+
+    def __init__(self, version: int, rows):
+        self.version = version
+        by_cur = {}
+        for r in rows:
+            by_cur.setdefault(r[0], ([], []))
+            by_cur[r[0]][0].append(r[1])
+            by_cur[r[0]][1].append(float(r[2]))
+        self._by_cur = by_cur
+
+    def next_date(self, d: str, from_currency: str) -> str | None:
+        """First rate date strictly after `d`, or None."""
+        dates = self._by_cur.get(from_currency, ((), ()))[0]
+        i = bisect.bisect_right(dates, d)
+        return dates[i] if i < len(dates) else None
+
+    def rate(self, d: str, from_currency: str) -> float:
+        """Latest rate on or before `d`, as `date<=? ORDER BY date DESC LIMIT 1` did."""
+        dates, rates = self._by_cur.get(from_currency, ((), ()))
+        i = bisect.bisect_right(dates, d)
+        return rates[i - 1] if i else FX_FALLBACK_RATE
+
+_fx_table = FxTable(-1, [])
+_fx_lock = threading.Lock()
+
+def _reload_fx(conn, version: int) -> FxTable:
+    global _fx_table
+    with _fx_lock:
+        if _fx_table.version != version:
+            rows = conn.execute("""
+                SELECT from_currency, date, rate FROM fx_rates
+                WHERE to_currency='USD' ORDER BY from_currency, date
+            """).fetchall()
+            _fx_table = FxTable(version, rows)
+        return _fx_table
+
+def fx_table() -> FxTable:
+    """Current FX table; reloaded when another worker bumped the 'fx' counter.
+
+    The counter is read once per request (or per call outside a request). In a
+    request the reload reuses the request's connection: taking a second one from
+    the pool while holding the first can starve the pool under load.
+    """
+    if has_app_context():
+        if "fx_version" not in g:
+            g.fx_version = read_counter(db(), "fx")
+        table = _fx_table
+        return table if table.version == g.fx_version else _reload_fx(db(), g.fx_version)
+    with pool.connection() as conn:
+        version = read_counter(conn, "fx")
+        table = _fx_table
+        return table if table.version == version else _reload_fx(conn, version)
+
 def get_fx_rate(d: str, from_currency: str) -> float:
     if from_currency == "USD":
         return 1.0
-    conn = db()
-    row = conn.execute("""
-        SELECT rate FROM fx_rates
-        WHERE date<=? AND from_currency=? AND to_currency='USD'
-        ORDER BY date DESC LIMIT 1
-    """, (d, from_currency)).fetchone()
-    conn.close()
-    return float(row["rate"]) if row else 1.10  # fallback
+    return fx_table().rate(d, from_currency)
 
 def is_day_locked(user_id: int, d: str) -> bool:
     conn = db()
     row = conn.execute("SELECT 1 FROM day_locks WHERE user_id=? AND date=?", (user_id, d)).fetchone()
-    conn.close()
     return bool(row)
 
+# ==================== Audit ====================
+AUDIT_QUEUE_MAX = int(os.getenv("AUDIT_QUEUE_MAX", 10000))     # событий в памяти, сверх — drop
+AUDIT_BATCH_ROWS = int(os.getenv("AUDIT_BATCH_ROWS", 200))
+AUDIT_FLUSH_SECONDS = float(os.getenv("AUDIT_FLUSH_SECONDS", 1.0))
+
+AUDIT_INSERT_SQL = "INSERT INTO audit_log (ts, actor_user, action, payload) VALUES (?,?,?,?)"
+
+class AuditWriter:
+    """Writes audit events from a background thread in batched transactions.
+
+    A batch is flushed when it reaches `batch_rows` events or `flush_seconds`
+    after its first event, whichever comes first. When the queue is full new
+    events are dropped and counted rather than blocking the request; close()
+    (registered with atexit) writes whatever is still queued.
+    """
+
+    def __init__(self, max_queue: int = 10000, batch_rows: int = 200, flush_seconds: float = 1.0):
+        self.batch_rows = batch_rows
+        self.flush_seconds = flush_seconds
+        self._queue = queue.Queue(max_queue)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._counters = {"enqueued": 0, "written": 0, "batches": 0, "dropped": 0, "failed": 0}
+
+    def _count(self, key: str, n: int = 1):
+        with self._lock:
+            self._counters[key] += n
+
+    def submit(self, event: tuple):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self._count("dropped")
+            logging.warning("audit queue full, dropped %s by %s", event[2], event[1])
+            return
+        self._count("enqueued")
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+                    self._thread.start()
+
+    def _write(self, batch: list):
+        try:
+            with pool.connection() as conn, write_tx(conn):
+                conn.executemany(AUDIT_INSERT_SQL, batch)
+        except sqlite3.Error:
+            self._count("failed", len(batch))
+            logging.exception("audit batch of %d events not written", len(batch))
+            return
+        self._count("written", len(batch))
+        self._count("batches")
+
+    def _run(self):
+        stop = False
+        while not stop:
+            event = self._queue.get()
+            if event is None:
+                break
+            batch = [event]
+            deadline = time.monotonic() + self.flush_seconds
+            while len(batch) < self.batch_rows:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    break
+                try:
+                    event = self._queue.get(timeout=left)
+                except queue.Empty:
+                    break
+                if event is None:
+                    stop = True
+                    break
+                batch.append(event)
+            self._write(batch)
+        self._drain()
+
+    def _drain(self):
+        batch = []
+        while True:
+            try:
+                event = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if event is not None:
+                batch.append(event)
+        for k in range(0, len(batch), self.batch_rows):
+            self._write(batch[k:k + self.batch_rows])
+
+    def close(self, timeout: float = 5.0):
+        """Flush queued events and stop the writer thread (called at exit)."""
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            try:
+                self._queue.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+            thread.join(timeout)
+        self._thread = None
+        self._drain()
+
+    def stats(self) -> dict:
+        with self._lock:
+            out = dict(self._counters)
+        out["queued"] = self._queue.qsize()
+        return out
+
+audit_writer = AuditWriter(AUDIT_QUEUE_MAX, AUDIT_BATCH_ROWS, AUDIT_FLUSH_SECONDS)
+atexit.register(audit_writer.close)
+
+def audit(actor_user: str, action: str, payload: dict, conn: sqlite3.Connection | None = None):
+    """Record an audit event.
+
+    By default the event is queued for the background writer. Pass the
+    handler's connection inside its `with write_tx(conn):` block to insert it in the same
+    transaction, for actions whose audit row must commit or roll back together
+    with the change.
+    """
+    event = (datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"), actor_user, action,
+             json.dumps(payload, ensure_ascii=False))
+    if conn is not None:
+        conn.execute(AUDIT_INSERT_SQL, event)
+    else:
+        audit_writer.submit(event)
+
+# ==================== Login rate limiting ====================
+LOGIN_IP_BURST = float(os.getenv("LOGIN_IP_BURST", 20))        # попыток подряд с одного IP
+LOGIN_IP_PER_MIN = float(os.getenv("LOGIN_IP_PER_MIN", 20))    # пополнение в минуту
+LOGIN_USER_BURST = float(os.getenv("LOGIN_USER_BURST", 5))
+LOGIN_USER_PER_MIN = float(os.getenv("LOGIN_USER_PER_MIN", 5))
+LOGIN_LOCKOUT_AFTER = int(os.getenv("LOGIN_LOCKOUT_AFTER", 5))       # неудач подряд до блокировки
+LOGIN_LOCKOUT_BASE = float(os.getenv("LOGIN_LOCKOUT_BASE", 30))      # секунд, удваивается
+LOGIN_LOCKOUT_MAX = float(os.getenv("LOGIN_LOCKOUT_MAX", 900))
+LOGIN_STATE_TTL = float(os.getenv("LOGIN_STATE_TTL", 3600))          # забываем ключ после простоя
+LOGIN_LIMIT_STORE = os.getenv("LOGIN_LIMIT_STORE", "memory")          # memory | sqlite
+
+class MemoryLimitStore:
+    """Limiter state in a dict of this process; one lock, no I/O."""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            yield self
+
+    def get(self, key: str):
+        return self._data.get(key)
+
+    def put(self, key: str, state: list):
+        self._data[key] = state
+
+    def sweep(self, now: float, ttl: float):
+        with self._lock:
+            dead = [k for k, st in self._data.items() if st[1] < now - ttl and st[3] < now]
+            for k in dead:
+                del self._data[k]
+
+class _SqliteLimitTx:
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def get(self, key: str):
+        row = self.conn.execute(
+            "SELECT tokens, updated, failures, locked_until FROM login_limits WHERE key=?", (key,)
+        ).fetchone()
+        return list(row) if row else None
+
+    def put(self, key: str, state: list):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO login_limits (key, tokens, updated, failures, locked_until) "
+            "VALUES (?,?,?,?,?)", (key, *state))
+
+class SqliteLimitStore:
+    """Limiter state in the login_limits table, shared by all workers on the DB."""
+
+    @contextmanager
+    def transaction(self):
+        with db_or_pooled() as conn, write_tx(conn):
+            yield _SqliteLimitTx(conn)
+
+    def sweep(self, now: float, ttl: float):
+        with db_or_pooled() as conn, write_tx(conn):
+            conn.execute("DELETE FROM login_limits WHERE updated<? AND locked_until<?",
+                         (now - ttl, now))
+
+class LoginLimiter:
+    """Token buckets per IP and per username, plus progressive lockout per username.
+
+    State per key is [tokens, updated, failures, locked_until]. Buckets are
+    refilled lazily on access and idle keys are dropped by an occasional
+    sweep, so a check is a dict lookup and a bit of arithmetic.
+    """
+
+    SWEEP_EVERY = 1024
+
+    def __init__(self, store):
+        self.store = store
+        self._ops = 0
+        self._lock = threading.Lock()
+        self._counters = {"allowed": 0, "limited": 0, "locked": 0, "lockouts": 0}
+
+    @staticmethod
+    def _load(tx, key: str, burst: float, now: float) -> list:
+        st = tx.get(key)
+        if st is None or st[1] < now - LOGIN_STATE_TTL and st[3] < now:
+            st = [burst, now, 0, 0.0]
+        return st
+
+    def _take(self, tx, key: str, burst: float, per_min: float, now: float):
+        st = self._load(tx, key, burst, now)
+        rate = per_min / 60.0
+        st[0] = min(burst, st[0] + (now - st[1]) * rate)
+        st[1] = now
+        if st[3] > now:
+            tx.put(key, st)
+            return "locked", st[3] - now
+        if st[0] < 1:
+            tx.put(key, st)
+            return "limited", (1 - st[0]) / rate if rate else LOGIN_LOCKOUT_MAX
+        st[0] -= 1
+        tx.put(key, st)
+        return None, 0.0
+
+    def check(self, ip: str, username: str) -> float:
+        """Spends one token from the IP and username buckets; returns seconds to wait or 0."""
+        now = time.time()
+        with self.store.transaction() as tx:
+            verdict, wait = self._take(tx, "ip:" + ip, LOGIN_IP_BURST, LOGIN_IP_PER_MIN, now)
+            if verdict is None:
+                verdict, wait = self._take(tx, "user:" + username.lower(),
+                                           LOGIN_USER_BURST, LOGIN_USER_PER_MIN, now)
+        with self._lock:
+            self._counters[verdict or "allowed"] += 1
+            self._ops += 1
+            sweep = self._ops % self.SWEEP_EVERY == 0
+        if sweep:
+            self.store.sweep(now, LOGIN_STATE_TTL)
+        return wait
+
+    def failed(self, username: str):
+        """Counts a wrong password; from LOGIN_LOCKOUT_AFTER on the lockout doubles each time."""
+        now = time.time()
+        key = "user:" + username.lower()
+        with self.store.transaction() as tx:
+            st = self._load(tx, key, LOGIN_USER_BURST, now)
+            st[2] += 1
+            over = st[2] - LOGIN_LOCKOUT_AFTER
+            if over >= 0:
+                st[3] = now + min(LOGIN_LOCKOUT_MAX, LOGIN_LOCKOUT_BASE * 2 ** over)
+                with self._lock:
+                    self._counters["lockouts"] += 1
+            tx.put(key, st)
+
+    def succeeded(self, username: str):
+        key = "user:" + username.lower()
+        with self.store.transaction() as tx:
+            st = tx.get(key)
+            if st is not None:
+                st[2], st[3] = 0, 0.0
+                tx.put(key, st)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._counters, store=LOGIN_LIMIT_STORE)
+
+login_limiter = LoginLimiter(SqliteLimitStore() if LOGIN_LIMIT_STORE == "sqlite" else MemoryLimitStore())
+
 # ==================== Auth ====================
 @app.route("/", methods=["GET", "POST"])
 def login():
     if request.method == "POST":
         username = request.form.get("username", "").strip()
         password = request.form.get("password", "")
+        wait = login_limiter.check(request.remote_addr or "-", username)
+        if wait:
+            retry = max(1, int(wait + 0.999))
+            resp = app.make_response((render_template(
+                "login.html", error=f"Слишком много попыток входа, повторите через {retry} с"), 429))
+            resp.headers["Retry-After"] = str(retry)
+            return resp
         conn = db()
         user = conn.execute(
             "SELECT * FROM users WHERE username=? AND is_active=1 AND is_deleted=0",
             (username,)
         ).fetchone()
-        conn.close()
-        if user and check_password(password, user["password_hash"]):
+        try:
+            ok = check_password(password, user["password_hash"] if user else None)
+        except HasherBusy:
+            return render_template("login.html", error="Сервер перегружен, попробуйте ещё раз через минуту"), 503
+        if not ok:
+            login_limiter.failed(username)
+        else:
+            login_limiter.succeeded(username)
+            if hasher.needs_rehash(user["password_hash"]):
+                # cost factor поменялся — пароль известен только сейчас, перехэшируем
+                new_hash = hasher.rehash(password)  # до BEGIN IMMEDIATE: не держать лок записи
+                with write_tx(conn):
+                    conn.execute("UPDATE users SET password_hash=? WHERE id=?", (new_hash, user["id"]))
             session["uid"] = user["id"]
             session["username"] = user["username"]
             session["role"] = user["role"]
             return redirect(url_for("data_input"))
-        return render_template_string(LOGIN_TPL, error="Неверные логин/пароль или пользователь неактивен")
-    return render_template_string(LOGIN_TPL)
+        return render_template("login.html", error="Неверные логин/пароль или пользователь неактивен")
+    return render_template("login.html")
 
 @app.route("/logout", methods=["POST"])
 def logout():
@@ -306,25 +1727,14 @@ def accounts():
             "SELECT id,username,role,is_active,is_deleted FROM users ORDER BY username"
         ).fetchall()
 
-    socs = conn.execute("SELECT * FROM socs WHERE user_id=? ORDER BY name", (uid,)).fetchall()
-    soc_ids = [s["id"] for s in socs] or [-1]
-    cabs = conn.execute(f"""
-        SELECT * FROM cabinets WHERE soc_id IN ({','.join('?'*len(soc_ids))})
-        ORDER BY name
-    """, soc_ids).fetchall()
-
+    tree = load_soc_tree(uid)
     fx_rows = conn.execute("SELECT * FROM fx_rates ORDER BY date DESC LIMIT 30").fetchall()
-    conn.close()
-
-    by_soc = {}
-    for c in cabs:
-        by_soc.setdefault(c["soc_id"], []).append(c)
 
     today_iso = date.today().isoformat()
 
-    return render_template_string(
-        ACCOUNTS_TPL,
-        role=role, users=users, socs=socs, by_soc=by_soc, fx_rows=fx_rows,
+    return render_template(
+        "accounts.html",
+        role=role, users=users, socs=tree.socs, by_soc=tree.cabs_by_soc, fx_rows=fx_rows,
         today_iso=today_iso
     )
 
@@ -339,13 +1749,12 @@ def user_add():
     ph = hash_password(password)
     conn = db()
     try:
-        with conn:
+        with write_tx(conn):
             conn.execute("INSERT INTO users (username,password_hash,role) VALUES (?,?,?)",
                          (username, ph, role))
-        audit(session["username"], "ADD_USER", {"username":username, "role":role})
+            audit(session["username"], "ADD_USER", {"username":username, "role":role}, conn=conn)
     except Exception:
         pass
-    conn.close()
     return redirect(url_for("accounts"))
 
 @app.route("/accounts/user_toggle", methods=["POST"])
@@ -362,10 +1771,9 @@ def user_toggle():
     else:
         active = safe_int(request.form.get("is_active"),1)
     conn = db()
-    with conn:
+    with write_tx(conn):
         conn.execute("UPDATE users SET is_active=? WHERE id=?", (active, uid))
-    audit(session["username"], "TOGGLE_USER", {"id":uid,"is_active":active})
-    conn.close()
+        audit(session["username"], "TOGGLE_USER", {"id":uid,"is_active":active}, conn=conn)
     return redirect(url_for("accounts"))
 
 @app.route("/accounts/user_delete", methods=["POST"])
@@ -380,10 +1788,9 @@ def user_delete():
     row = conn.execute("SELECT username FROM users WHERE id=?", (uid,)).fetchone()
     if row:
         uname = row["username"]
-        with conn:
+        with write_tx(conn):
             conn.execute("DELETE FROM users WHERE id=?", (uid,))
-        audit(session["username"], "DELETE_USER", {"id": uid, "username": uname})
-    conn.close()
+            audit(session["username"], "DELETE_USER", {"id": uid, "username": uname}, conn=conn)
     return redirect(url_for("accounts"))
 
 @app.route("/accounts/user_pass", methods=["POST"])
@@ -394,10 +1801,9 @@ def user_pass():
     if not pw: return redirect(url_for("accounts"))
     ph = hash_password(pw)
     conn = db()
-    with conn:
+    with write_tx(conn):
         conn.execute("UPDATE users SET password_hash=? WHERE id=?", (ph, uid))
-    audit(session["username"], "RESET_PASS", {"id":uid})
-    conn.close()
+        audit(session["username"], "RESET_PASS", {"id":uid}, conn=conn)
     return redirect(url_for("accounts"))
 
 @app.route("/accounts/soc_add", methods=["POST"])
@@ -407,10 +1813,9 @@ def soc_add():
     name = request.form.get("name","").strip()
     if not name: return redirect(url_for("accounts"))
     conn = db()
-    with conn:
+    with write_tx(conn):
         conn.execute("INSERT INTO socs (user_id,name) VALUES (?,?)",(uid,name))
     audit(session["username"], "ADD_SOC", {"name":name})
-    conn.close()
     return redirect(url_for("accounts"))
 
 @app.route("/accounts/soc_update", methods=["POST"])
@@ -420,12 +1825,11 @@ def soc_update():
     name = request.form.get("name","").strip()
     is_closed = 1 if request.form.get("is_closed")=="1" else 0
     conn = db()
-    with conn:
+    with write_tx(conn):
         if name:
             conn.execute("UPDATE socs SET name=? WHERE id=?", (name, soc_id))
         conn.execute("UPDATE socs SET is_closed=? WHERE id=?", (is_closed, soc_id))
     audit(session["username"], "UPDATE_SOC", {"soc_id":soc_id,"name":name,"is_closed":is_closed})
-    conn.close()
     return redirect(url_for("accounts"))
 
 @app.route("/accounts/cab_add", methods=["POST"])
@@ -439,13 +1843,12 @@ def cab_add():
     if not (soc_id and name and currency in ("USD","EUR") and cab_type in ("AGENCY","FARM")):
         return redirect(url_for("accounts"))
     conn = db()
-    with conn:
+    with write_tx(conn):
         conn.execute("""
             INSERT INTO cabinets (soc_id,name,currency,cab_type,commission_pct)
             VALUES (?,?,?,?,?)
         """, (soc_id,name,currency,cab_type,commission_pct))
     audit(session["username"], "ADD_CAB", {"soc_id":soc_id,"name":name})
-    conn.close()
     return redirect(url_for("accounts"))
 
 @app.route("/accounts/cab_update", methods=["POST"])
@@ -457,7 +1860,7 @@ def cab_update():
     cab_type = request.form.get("cab_type","")
     commission_pct = safe_float(request.form.get("commission_pct"), 6.0)
     conn = db()
-    with conn:
+    with write_tx(conn):
         if status in ("ACTIVE","BANNED"):
             conn.execute("UPDATE cabinets SET status=? WHERE id=?", (status, cab_id))
         if currency in ("USD","EUR"):
@@ -466,40 +1869,79 @@ def cab_update():
             conn.execute("UPDATE cabinets SET cab_type=?, commission_pct=? WHERE id=?",
                          (cab_type, commission_pct, cab_id))
     audit(session["username"], "UPDATE_CAB", {"cab_id":cab_id})
-    conn.close()
     return redirect(url_for("accounts"))
 
 @app.route("/accounts/fx_set", methods=["POST"])
 def fx_set():
     if not require_tl(): return "Forbidden", 403
     d = request.form.get("date") or date.today().isoformat()
-    rate = safe_float(request.form.get("eurusd"), 1.10)
+    try:
+        d = date.fromisoformat(d).isoformat()
+    except ValueError:
+        return "date must be YYYY-MM-DD", 400
+    # новый курс пересчитывает все EUR-записи диапазона — мусор не пишем и не планируем
+    rate = safe_float(request.form.get("eurusd"), math.nan)
+    if not math.isfinite(rate) or rate <= 0:
+        return "eurusd must be a positive number", 400
     conn = db()
-    with conn:
+    with write_tx(conn):
         conn.execute("""
         INSERT INTO fx_rates (date,from_currency,to_currency,rate)
         VALUES (?,?,?,?)
         ON CONFLICT(date,from_currency,to_currency) DO UPDATE SET rate=excluded.rate
         """, (d, "EUR", "USD", rate))
-    audit(session["username"], "FX_SET", {"date":d,"EURUSD":rate})
-    conn.close()
+        bump_counter(conn, "fx")
+    g.pop("fx_version", None)
+    job = schedule_fx_recompute(d, "EUR")
+    audit(session["username"], "FX_SET", {"date":d,"EURUSD":rate,"recompute_job":job["id"]})
     return redirect(url_for("accounts"))
 
 # ==================== ВНЕСЕНИЕ ДАННЫХ ====================
-@app.route("/input", methods=["GET"])
-def data_input():
-    if not require_login(): return redirect(url_for("login"))
-    uid = session["uid"]
-    chosen_date = request.args.get("date") or date.today().isoformat()
-    chosen_soc = request.args.get("soc_id")
-    chosen_cab = request.args.get("cab_id")
+GEOS = sorted(set(CPA_SLOTS.keys()) | set(CPA_CRASH.keys()))
+CPA_BY_VERTICAL = {"Slots": CPA_SLOTS, "Crash": CPA_CRASH}
+
+UPSERT_RECORDS_SQL = """
+INSERT INTO records (user, user_id, date, geo, vertical, cabinet_id,
+                     spend_raw, spend_currency, spend, deps, revenue, profit, spend_usd,
+                     created_at, updated_at, spend_exact)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(user, date, geo, vertical, cabinet_id) DO UPDATE SET
+  spend_raw=excluded.spend_raw,
+  spend_exact=excluded.spend_exact,
+  spend_currency=excluded.spend_currency,
+  spend=excluded.spend,
+  spend_usd=excluded.spend_usd,
+  deps=excluded.deps,
+  revenue=excluded.revenue,
+  profit=excluded.profit,
+  updated_at=excluded.updated_at
+"""
 
+def build_record_row(uname, uid, d, geo, vertical, cab, sp_raw, deps, fx, now_ts):
+    """UPSERT_RECORDS_SQL parameters for one GEO/vertical cell, or None if it has no CPA."""
+    cpa = CPA_BY_VERTICAL[vertical].get(geo)
+    if cpa is None:
+        return None
+    factor = 1.0 + (float(cab["commission_pct"])/100.0) if cab["cab_type"]=="AGENCY" else 1.0
+    spend_usd = round(sp_raw * factor * fx, 4)
+    revenue = int(deps) * int(cpa)
+    profit = int(revenue) - int(round(spend_usd))
+    return (
+        uname, uid, d, geo, vertical, cab["id"],
+        int(round(sp_raw)),            # spend_raw как целое — по требованию
+        cab["currency"],
+        int(round(spend_usd)),         # legacy int
+        int(deps), int(revenue), int(profit),
+        float(spend_usd),              # точное
+        now_ts, now_ts,
+        float(sp_raw)                  # введённое без округления — для пересчёта курса
+    )
+def render_input(uid: int, chosen_date: str, chosen_soc, chosen_cab, posted: dict | None = None,
+                 error: str | None = None):
+    """Input form for one cabinet and day; `posted` overrides the saved values."""
     conn = db()
-    socs = conn.execute("SELECT * FROM socs WHERE user_id=? ORDER BY name", (uid,)).fetchall()
-    cabs_by_soc = {}
-    for s in socs:
-        cabs = conn.execute("SELECT * FROM cabinets WHERE soc_id=? ORDER BY name", (s["id"],)).fetchall()
-        cabs_by_soc[s["id"]] = cabs
+    tree = load_soc_tree(uid)
+    socs, cabs_by_soc = tree.socs, tree.cabs_by_soc
 
     chosen_soc = int(chosen_soc) if (chosen_soc and str(chosen_soc).isdigit()) else None
     chosen_cab = int(chosen_cab) if (chosen_cab and str(chosen_cab).isdigit()) else None
@@ -510,33 +1952,33 @@ def data_input():
         active = [c for c in cands if c["status"] == "ACTIVE"]
         chosen_cab = (active[0]["id"] if active else (cands[0]["id"] if cands else None))
 
-    cab = None
-    if chosen_cab:
-        cab = conn.execute("SELECT * FROM cabinets WHERE id=?", (chosen_cab,)).fetchone()
+    cab = tree.cabs_by_id.get(chosen_cab) if chosen_cab else None
 
     existing = {}
-    if cab:
-        rows = conn.execute("""
-            SELECT geo, vertical, spend_raw, spend_currency, deps
-            FROM records
-            WHERE user_id=? AND cabinet_id=? AND date=?
-        """, (uid, cab["id"], chosen_date)).fetchall()
+    if cab and posted is not None:
+        existing = posted
+    elif cab:
+        rows = conn.execute(INPUT_EXISTING_SQL, (uid, cab["id"], chosen_date)).fetchall()
         for r in rows:
             existing.setdefault(r["geo"], {})[r["vertical"]] = {
                 "spend_raw": r["spend_raw"] or 0.0,
                 "currency": r["spend_currency"] or cab["currency"],
                 "deps": int(r["deps"] or 0)
             }
-    conn.close()
 
-    geos = sorted(set(CPA_SLOTS.keys()) | set(CPA_CRASH.keys()))
-    return render_template_string(INPUT_TPL,
+    return render_template("input.html",
         chosen_date=chosen_date, socs=socs, cabs_by_soc=cabs_by_soc,
         chosen_soc=chosen_soc, chosen_cab=chosen_cab, cab=cab,
-        geos=geos, flags=FLAGS, cpa_slots=CPA_SLOTS, cpa_crash=CPA_CRASH,
-        existing=existing
+        geos=GEOS, flags=FLAGS, cpa_slots=CPA_SLOTS, cpa_crash=CPA_CRASH,
+        existing=existing, error=error
     )
 
+@app.route("/input", methods=["GET"])
+def data_input():
+    if not require_login(): return redirect(url_for("login"))
+    return render_input(session["uid"], request.args.get("date") or date.today().isoformat(),
+                        request.args.get("soc_id"), request.args.get("cab_id"))
+
 @app.route("/input/save", methods=["POST"])
 def input_save():
     if not require_login(): return redirect(url_for("login"))
@@ -551,73 +1993,164 @@ def input_save():
     conn = db()
     cab = conn.execute("SELECT * FROM cabinets WHERE id=?", (cab_id,)).fetchone()
     if not cab:
-        conn.close()
         return redirect(url_for("data_input", date=chosen_date, soc_id=soc_id, cab_id=cab_id))
 
     fx = get_fx_rate(chosen_date, cab["currency"])
     rows = []
+    posted = {}   # введённое — вернуть в форму, если запись не удалась
     now_ts = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
 
-    geos = sorted(set(CPA_SLOTS.keys()) | set(CPA_CRASH.keys()))
-    for geo in geos:
+    for geo in GEOS:
         dep_s = safe_int(request.form.get(f"deps_slots_{geo}"), 0)
         sp_s_raw = safe_float(request.form.get(f"spend_slots_{geo}"), 0.0)
 
         dep_c = safe_int(request.form.get(f"deps_crash_{geo}"), 0)
         sp_c_raw = safe_float(request.form.get(f"spend_crash_{geo}"), 0.0)
 
-        for vertical, deps, sp_raw, cpa in [
-            ("Slots", dep_s, sp_s_raw, CPA_SLOTS.get(geo)),
-            ("Crash", dep_c, sp_c_raw, CPA_CRASH.get(geo)),
-        ]:
-            if cpa is None:
-                continue
-            factor = 1.0 + (float(cab["commission_pct"])/100.0) if cab["cab_type"]=="AGENCY" else 1.0
-            spend_usd = round(sp_raw * factor * fx, 4)
-            revenue = int(deps) * int(cpa)
-            profit = int(revenue) - int(round(spend_usd))
-
-            rows.append((
-                uname, uid, chosen_date, geo, vertical, cab_id,
-                int(round(sp_raw)),            # spend_raw как целое — по требованию
-                cab["currency"],
-                int(round(spend_usd)),         # legacy int
-                int(deps), int(revenue), int(profit),
-                float(spend_usd),              # точное
-                now_ts, now_ts
-            ))
+        for vertical, deps, sp_raw in [("Slots", dep_s, sp_s_raw), ("Crash", dep_c, sp_c_raw)]:
+            row = build_record_row(uname, uid, chosen_date, geo, vertical, cab, sp_raw, deps, fx, now_ts)
+            if row:
+                rows.append(row)
+                posted.setdefault(geo, {})[vertical] = {
+                    "spend_raw": sp_raw, "currency": cab["currency"], "deps": deps}
 
     success = False
     try:
         if rows:
             ensure_daily_backup()
-            with conn:
-                conn.executemany("""
-                INSERT INTO records (user, user_id, date, geo, vertical, cabinet_id,
-                                     spend_raw, spend_currency, spend, deps, revenue, profit, spend_usd,
-                                     created_at, updated_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ON CONFLICT(user, date, geo, vertical, cabinet_id) DO UPDATE SET
-                  spend_raw=excluded.spend_raw,
-                  spend_currency=excluded.spend_currency,
-                  spend=excluded.spend,
-                  spend_usd=excluded.spend_usd,
-                  deps=excluded.deps,
-                  revenue=excluded.revenue,
-                  profit=excluded.profit,
-                  updated_at=excluded.updated_at
-                """, rows)
+            with write_tx(conn):
+                conn.executemany(UPSERT_RECORDS_SQL, rows)
             success = True
             audit(uname, "UPSERT_RECORDS", {"date":chosen_date,"cabinet_id":cab_id,"rows":len(rows)})
     except Exception as e:
         logging.exception("save failed: %s", e)
-    finally:
-        conn.close()
 
     if success:
         return redirect(url_for("data_input", date=chosen_date, soc_id=soc_id, cab_id=cab_id, saved=1))
-    else:
-        return redirect(url_for("data_input", date=chosen_date, soc_id=soc_id, cab_id=cab_id, error=1))
+    # форму не теряем: показываем введённое ещё раз, чтобы можно было отправить повторно
+    return render_input(uid, chosen_date, soc_id, cab_id, posted=posted,
+                        error="Данные не сохранены (база занята или ошибка записи) — отправьте форму ещё раз."), 503
+
+BULK_CHUNK_ROWS = int(os.getenv("BULK_CHUNK_ROWS", 1000))
+BULK_MAX_ROWS = int(os.getenv("BULK_MAX_ROWS", 50000))
+BULK_MAX_SPEND = 1e12        # выше — явно ошибка ввода; заодно держит суммы в пределах int64
+BULK_MAX_DEPS = 10**9
+
+def _parse_bulk_body() -> list:
+    # JSON-массив, {"rows": [...]} или NDJSON (по строке на запись)
+    ctype = (request.mimetype or "").lower()
+    raw = request.get_data(cache=False, as_text=True)
+    if ctype in ("application/x-ndjson", "application/ndjson", "application/jsonl"):
+        return [json.loads(line) for line in raw.splitlines() if line.strip()]
+    body = json.loads(raw or "null")
+    if isinstance(body, dict):
+        body = body.get("rows")
+    if not isinstance(body, list):
+        raise ValueError("expected a JSON array of rows, {\"rows\": [...]} or NDJSON")
+    return body
+
+def _validate_bulk_row(item) -> tuple[tuple | None, str | None]:
+    """(date, cabinet_id, geo, vertical, spend, deps) or an error message."""
+    if not isinstance(item, dict):
+        return None, "row must be an object"
+    try:
+        d = date.fromisoformat(str(item.get("date", ""))).isoformat()
+    except ValueError:
+        return None, "bad date"
+    cab_id = safe_int(item.get("cabinet_id"), 0)
+    if cab_id <= 0:
+        return None, "bad cabinet_id"
+    vertical = item.get("vertical")
+    if not isinstance(vertical, str) or vertical not in CPA_BY_VERTICAL:
+        return None, "vertical must be Slots or Crash"
+    geo = item.get("geo")
+    # список/объект вместо строки — невалидная строка, а не TypeError на весь запрос
+    if not isinstance(geo, str) or CPA_BY_VERTICAL[vertical].get(geo) is None:
+        return None, f"no CPA for {geo!r}/{vertical}"
+    spend = safe_float(item.get("spend"), -1.0)
+    deps = safe_int(item.get("deps"), -1)
+    if not math.isfinite(spend) or spend < 0 or deps < 0:
+        return None, "spend and deps must be finite non-negative numbers"
+    if spend > BULK_MAX_SPEND or deps > BULK_MAX_DEPS:
+        return None, f"spend must be <= {BULK_MAX_SPEND:.0e} and deps <= {BULK_MAX_DEPS:.0e}"
+    return (d, cab_id, geo, vertical, spend, deps), None
+
+@app.route("/input/bulk", methods=["POST"])
+def input_bulk():
+    """Upsert many (date, cabinet_id, geo, vertical, spend, deps) rows for the session user.
+
+    Day locks, cabinet ownership and FX are resolved once per distinct
+    date/cabinet; rows are written with executemany, one transaction per
+    BULK_CHUNK_ROWS. Responds with a per-row status list.
+    """
+    if not require_login(): return jsonify(error="login required"), 401
+    uid = session["uid"]; uname = session["username"]
+    try:
+        items = _parse_bulk_body()
+    except ValueError as e:  # json.JSONDecodeError тоже ValueError
+        return jsonify(error=str(e)), 400
+    if len(items) > BULK_MAX_ROWS:
+        return jsonify(error=f"too many rows, max {BULK_MAX_ROWS} per request"), 413
+
+    status = [None] * len(items)
+    parsed = []
+    for i, item in enumerate(items):
+        row, err = _validate_bulk_row(item)
+        if err:
+            status[i] = {"i": i, "status": "invalid", "error": err}
+        else:
+            parsed.append((i, row))
+
+    conn = db()
+    cab_ids = sorted({r[1] for _, r in parsed})
+    dates = sorted({r[0] for _, r in parsed})
+    cabs, locked = {}, set()
+    if cab_ids:
+        cabs = {c["id"]: c for c in conn.execute(f"""
+            SELECT c.* FROM cabinets c JOIN socs s ON s.id=c.soc_id
+            WHERE s.user_id=? AND c.id IN ({",".join("?" * len(cab_ids))})
+        """, [uid] + cab_ids).fetchall()}
+    if dates:
+        locked = {r[0] for r in conn.execute(f"""
+            SELECT date FROM day_locks WHERE user_id=? AND date IN ({",".join("?" * len(dates))})
+        """, [uid] + dates).fetchall()}
+    fx = fx_table()
+
+    now_ts = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    pending = []  # (индекс, параметры upsert)
+    for i, (d, cab_id, geo, vertical, spend, deps) in parsed:
+        cab = cabs.get(cab_id)
+        if cab is None:
+            status[i] = {"i": i, "status": "rejected", "error": "unknown cabinet"}
+        elif d in locked:
+            status[i] = {"i": i, "status": "rejected", "error": "day locked"}
+        else:
+            rate = 1.0 if cab["currency"] == "USD" else fx.rate(d, cab["currency"])
+            pending.append((i, build_record_row(uname, uid, d, geo, vertical, cab, spend, deps, rate, now_ts)))
+
+    if pending:
+        ensure_daily_backup()
+    saved = 0
+    for k in range(0, len(pending), BULK_CHUNK_ROWS):
+        chunk = pending[k:k + BULK_CHUNK_ROWS]
+        try:
+            with write_tx(conn):
+                conn.executemany(UPSERT_RECORDS_SQL, [p for _, p in chunk])
+        except sqlite3.Error as e:
+            logging.exception("bulk save chunk failed")
+            for i, _ in chunk:
+                status[i] = {"i": i, "status": "error", "error": str(e)}
+            continue
+        for i, _ in chunk:
+            status[i] = {"i": i, "status": "saved"}
+        saved += len(chunk)
+
+    if saved:
+        audit(uname, "BULK_UPSERT_RECORDS", {"rows": saved, "dates": dates[:1] + dates[-1:]})
+    summary = {}
+    for st in status:
+        summary[st["status"]] = summary.get(st["status"], 0) + 1
+    return jsonify(total=len(items), summary=summary, rows=status)
 
 @app.route("/day/lock", methods=["POST"])
 def day_lock():
@@ -625,184 +2158,898 @@ def day_lock():
     uid = safe_int(request.form.get("user_id"))
     d = request.form.get("date") or date.today().isoformat()
     conn = db()
-    with conn:
+    with write_tx(conn):
         conn.execute("INSERT OR IGNORE INTO day_locks (user_id,date) VALUES (?,?)", (uid,d))
     audit(session["username"], "CLOSE_DAY", {"user_id":uid,"date":d})
-    conn.close()
     return redirect(url_for("data_input", date=d))
 
-# ==================== ОТЧЁТЫ ====================
-@app.route("/dashboard", methods=["GET", "POST"])
-def dashboard():
-    if not require_login(): return redirect(url_for("login"))
-    role = session.get("role","BUYER")
-    session_user = session["username"]
-    session_uid  = session["uid"]
+# ==================== Фильтры и горячие запросы ====================
+# ключ сортировки выгрузки (см. _m010): NULL → '', для одного пользователя user не входит
+EXPORT_KEY_ALL = "date, IFNULL(user,''), IFNULL(vertical,''), IFNULL(geo,''), id"
+EXPORT_KEY_USER = "date, IFNULL(vertical,''), IFNULL(geo,''), id"
 
-    if request.method == "POST":
-        start_date = request.form.get("start_date") or date.today().isoformat()
-        end_date   = request.form.get("end_date") or date.today().isoformat()
-        sel_user   = request.form.get("selected_user")
-        sel_soc    = request.form.get("soc_id")
-        sel_cab    = request.form.get("cab_id")
+def export_key(user_val) -> str:
+    return EXPORT_KEY_ALL if user_val is None else EXPORT_KEY_USER
+
+def report_filter(start: str, end: str, user_col: str, user_val, soc_id=None, cab_id=None, after=None):
+    """WHERE clause shared by the dashboard and the export.
+
+    `user_val=None` means all users; `user_col` is "user_id" for daily_rollups
+    and "user" (username) for records. `after` is export-only: the
+    (date, user, vertical, geo, id) of the last row already sent; it replaces
+    the lower date bound with `export_key(user_val) > key of that row`.
+    """
+    if after is None:
+        where, params = "date>=?", [start]
     else:
-        start_date = request.args.get("start_date") or date.today().isoformat()
-        end_date   = request.args.get("end_date") or date.today().isoformat()
-        sel_user   = request.args.get("selected_user")
-        sel_soc    = request.args.get("soc_id")
-        sel_cab    = request.args.get("cab_id")
+        key = [after[0], *("" if v is None else v for v in after[1:4]), after[4]]
+        if user_val is not None:
+            del key[1]
+        where, params = f"({export_key(user_val)}) > ({','.join('?' * len(key))})", key
+    where += " AND date<=?"
+    params.append(end)
+    if user_val is not None:
+        where = f"{user_col}=? AND " + where
+        params = [user_val] + params
+    if soc_id and soc_id not in ("", "ALL"):
+        where += " AND cabinet_id IN (SELECT id FROM cabinets WHERE soc_id=?)"
+        params.append(soc_id)
+    if cab_id and cab_id not in ("", "ALL"):
+        where += " AND cabinet_id=?"
+        params.append(cab_id)
+    return where, params
+
+# daily_rollups уже на гранулярности (date, user, cabinet, vertical, geo) —
+# GROUP BY только сворачивает пользователей для ALL
+DASH_ROLLUP_SQL = """
+    SELECT date, vertical, geo, cabinet_id,
+           (SELECT soc_id FROM cabinets c WHERE c.id=daily_rollups.cabinet_id) AS soc_id,
+           SUM(spend_usd) AS spend, SUM(deps) AS deps,
+           SUM(revenue) AS revenue, SUM(profit) AS profit,
+           MAX(updated_at) AS last
+    FROM daily_rollups WHERE {where}
+    GROUP BY date, vertical, geo, cabinet_id
+"""
 
-    conn = db()
+EXPORT_SQL = """
+    SELECT id,user,date,vertical,geo,cabinet_id,spend_raw,spend_currency,spend_usd,deps,revenue,profit,updated_at
+    FROM records WHERE {where}
+    ORDER BY {order}
+    LIMIT ?
+"""
+
+INPUT_EXISTING_SQL = """
+    SELECT geo, vertical, spend_raw, spend_currency, deps
+    FROM records
+    WHERE user_id=? AND cabinet_id=? AND date=?
+"""
+
+SOC_COLS = ("id", "user_id", "name", "is_closed", "created_at")
+CAB_COLS = ("id", "soc_id", "name", "status", "currency", "cab_type", "commission_pct", "created_at")
+
+# SOC и их кабинеты одним запросом (LEFT JOIN — SOC без кабинетов тоже нужны)
+SOC_TREE_SQL = f"""
+    SELECT {", ".join("s." + c for c in SOC_COLS)}, {", ".join("c." + c for c in CAB_COLS)}
+    FROM socs s LEFT JOIN cabinets c ON c.soc_id=s.id
+    WHERE s.user_id=?
+    ORDER BY s.name, s.id, c.name, c.id
+"""
+
+SocTree = namedtuple("SocTree", "socs cabs_by_soc cabs_by_id")
+
+def load_soc_tree(user_id) -> SocTree:
+    """A user's SOCs (by name) with their cabinets (by name), cached for the request."""
+    cache = g.setdefault("soc_trees", {})
+    if user_id in cache:
+        return cache[user_id]
+    socs, cabs_by_soc, cabs_by_id = [], {}, {}
+    n = len(SOC_COLS)
+    for r in db().execute(SOC_TREE_SQL, (user_id,)).fetchall():
+        if not socs or socs[-1]["id"] != r[0]:
+            socs.append(dict(zip(SOC_COLS, r[:n])))
+            cabs_by_soc[r[0]] = []
+        if r[n] is not None:
+            cab = dict(zip(CAB_COLS, r[n:]))
+            cabs_by_soc[r[0]].append(cab)
+            cabs_by_id[cab["id"]] = cab
+    cache[user_id] = tree = SocTree(socs, cabs_by_soc, cabs_by_id)
+    return tree
+
+def cabinet_labels(conn, cab_ids) -> tuple[dict, dict]:
+    """Cabinet and SOC names for just the cabinets shown on a page."""
+    cab_ids = sorted(i for i in cab_ids if i)
+    cab_names, soc_names = {}, {}
+    if not cab_ids:
+        return cab_names, soc_names
+    for r in conn.execute(f"""
+        SELECT c.id, c.name, c.soc_id, s.name AS soc_name
+        FROM cabinets c LEFT JOIN socs s ON s.id=c.soc_id
+        WHERE c.id IN ({",".join("?" * len(cab_ids))})
+    """, cab_ids).fetchall():
+        cab_names[r["id"]] = r["name"]
+        soc_names[r["soc_id"]] = r["soc_name"]
+    return cab_names, soc_names
+
+def hot_queries():
+    """(name, sql, params) for every filter shape the pages issue against big tables."""
+    out = [
+        ("input.existing", INPUT_EXISTING_SQL, [1, 1, "2024-01-01"]),
+        ("socs.tree", SOC_TREE_SQL, [1]),
+        ("dashboard.version", REPORT_VERSION_SQL, ["2024-01-01", "2024-01-31"]),
+    ]
+    for name, kw in (("audit.range", {}), ("audit.actor", {"actor": "u"}),
+                     ("audit.action", {"action": "FX_SET", "key": "date"})):
+        where, params = audit_filter(start="2024-01-01", end="2024-01-31",
+                                     cursor=("2024-01-31", 1), **kw)
+        out.append((name, AUDIT_PAGE_SQL.format(where=where), params + [100]))
+    for soc in (None, "1"):
+        for cab in (None, "1"):
+            tag = "".join(["+soc" if soc else "", "+cab" if cab else ""])
+            for who, uid, uname in (("all", None, None), ("user", 1, "u")):
+                where, params = report_filter("2024-01-01", "2024-01-31", "user_id", uid, soc, cab)
+                out.append((f"dashboard.{who}{tag}", DASH_ROLLUP_SQL.format(where=where), params))
+                for page, after in (("", None), (".next", ("2024-01-05", "u", "Slots", "Germany", 1))):
+                    where, params = report_filter("2024-01-01", "2024-01-31", "user", uname, soc, cab, after)
+                    sql = EXPORT_SQL.format(where=where, order=export_key(uname))
+                    out.append((f"export.{who}{tag}{page}", sql, params + [100]))
+    return out
+
+def full_scans(conn) -> list[tuple[str, str]]:
+    """EXPLAIN QUERY PLAN every hot query; return (name, plan line) for each table scan."""
+    bad = []
+    for name, sql, params in hot_queries():
+        for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall():
+            detail = row[3]
+            if detail.startswith("SCAN ") and not detail.startswith("SCAN CONSTANT"):
+                bad.append((name, detail))
+    return bad
+
+# ==================== Агрегация отчётов ====================
+METRICS = ("spend", "deps", "revenue", "profit")
+
+def _acc(dst: dict, row) -> dict:
+    # те же правила, что у SQL SUM(): NULL пропускается, пустая группа остаётся None
+    for m in METRICS:
+        v = row[m]
+        if v is not None:
+            dst[m] = v if dst[m] is None else dst[m] + v
+    return dst
+
+def _bucket(**keys) -> dict:
+    keys.update(dict.fromkeys(METRICS))
+    return keys
+
+def pack_ts(rows):
+    spend, profit, deps, cac, roi = [], [], [], [], []
+    for d in rows:
+        s = int(d.get("spend") or 0)
+        p = int(d.get("profit") or 0)
+        r = int(d.get("revenue") or 0)
+        ft= int(d.get("deps") or 0)
+        spend.append(s); profit.append(p); deps.append(ft)
+        cac.append( (s/ft) if ft>0 else None )
+        roi.append( ((r - s)*100.0/s) if s>0 else None )
+    return dict(spend=spend, profit=profit, deps=deps, cac=cac, roi=roi)
+
+def aggregate_dashboard(rows) -> dict:
+    """Build every dashboard rollup from one scan at (date, vertical, geo, cabinet) grain.
+
+    `rows` must carry date, vertical, geo, cabinet_id, soc_id, last and the
+    METRICS columns. Result shapes and ordering match what the former
+    per-rollup GROUP BY queries returned.
+    """
+    total = _bucket()
+    by_vert, by_vert_geo, by_geo, by_day, per_v_day, per_geo_cab = {}, {}, {}, {}, {}, {}
+    for r in rows:
+        v, geo, d, cab = r["vertical"], r["geo"], r["date"], r["cabinet_id"]
+        _acc(total, r)
+        _acc(by_vert.get(v) or by_vert.setdefault(v, _bucket(vertical=v)), r)
+        k = (v, geo)
+        _acc(by_vert_geo.get(k) or by_vert_geo.setdefault(k, _bucket(vertical=v, geo=geo)), r)
+        _acc(by_geo.get(geo) or by_geo.setdefault(geo, _bucket(geo=geo)), r)
+        day = by_day.get(d) or by_day.setdefault(d, _bucket(date=d, last=None))
+        _acc(day, r)
+        if r["last"] is not None and (day["last"] is None or r["last"] > day["last"]):
+            day["last"] = r["last"]
+        k = (d, v)
+        _acc(per_v_day.get(k) or per_v_day.setdefault(k, _bucket(date=d, vertical=v)), r)
+        k = (geo, cab)
+        _acc(per_geo_cab.get(k) or per_geo_cab.setdefault(
+            k, _bucket(geo=geo, cabinet_id=cab, soc_id=r["soc_id"])), r)
+
+    # spend_usd хранится с 4 знаками; округляем суммы, чтобы результат не зависел
+    # от порядка сложения float
+    for bucket in (total, *by_vert.values(), *by_vert_geo.values(), *by_geo.values(),
+                   *by_day.values(), *per_v_day.values(), *per_geo_cab.values()):
+        if isinstance(bucket["spend"], float):
+            bucket["spend"] = round(bucket["spend"], 4)
+
+    # SQL сортирует NULL первыми — повторяем, чтобы порядок строк не поменялся
+    def nulls_first(x):
+        return (x is not None, x if x is not None else 0)
+
+    days = [by_day[k] for k in sorted(by_day, key=nulls_first)]
+    for d in days:
+        d["last_msk"] = utc_to_msk(d.get("last"))
+    labels = [d["date"] for d in days]
+
+    def align_series(vname):
+        zero = {"spend":0,"deps":0,"revenue":0,"profit":0}
+        return pack_ts([per_v_day.get((lab, vname), zero) for lab in labels])
+
+    vert_geo = {}
+    for k in sorted(by_vert_geo, key=lambda k: (nulls_first(k[0]), nulls_first(k[1]))):
+        vert_geo.setdefault(k[0], []).append(by_vert_geo[k])
+    geo_cab = {}
+    for k in sorted(per_geo_cab, key=lambda k: (nulls_first(k[0]), nulls_first(k[1]))):
+        row = per_geo_cab[k]
+        if row["spend"] is not None and row["spend"] > 0:
+            geo_cab.setdefault(k[0], []).append(row)
+
+    return dict(
+        by_vert={k: by_vert[k] for k in sorted(by_vert, key=nulls_first)},
+        by_vert_geo=vert_geo,
+        total=total,
+        total_by_geo=[by_geo[k] for k in sorted(by_geo, key=nulls_first)],
+        by_day=days,
+        labels=labels,
+        ts_total=pack_ts(days),
+        ts_slots=align_series("Slots"),
+        ts_crash=align_series("Crash"),
+        per_geo_cab=geo_cab,
+    )
+
+# ==================== ОТЧЁТЫ ====================
+DASH_CACHE_MB = float(os.getenv("DASH_CACHE_MB", 32))   # 0 — кэш выключен
+
+REPORT_VERSION_SQL = """
+    SELECT (SELECT value FROM counters WHERE name='reports'), total(version), count(*)
+    FROM data_versions WHERE date>=? AND date<=?
+"""
+
+class ReportCache:
+    """LRU of computed dashboard results, bounded by the memory they retain (deep_sizeof).
+
+    Each entry remembers the data version it was built from; a lookup with a
+    different version is a miss and drops the entry.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()   # key -> (version, size, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "stale": 0, "evictions": 0}
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self._counters["hits"] += 1
+                return entry[2]
+            if entry is not None:
+                self._counters["stale"] += 1
+                self._bytes -= entry[1]
+                del self._entries[key]
+            self._counters["misses"] += 1
+            return None
+
+    def put(self, key, version, value, size: int):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (version, size, value)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+                self._counters["evictions"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            out = dict(self._counters, entries=len(self._entries), bytes=self._bytes)
+        lookups = out["hits"] + out["misses"]
+        out["hit_ratio"] = round(out["hits"] / lookups, 4) if lookups else None
+        out["max_bytes"] = self.max_bytes
+        return out
+
+dash_cache = ReportCache(int(DASH_CACHE_MB * 1024 * 1024))
+
+def deep_sizeof(obj) -> int:
+    """Bytes retained by a tree of dicts/lists/tuples and scalars (shared objects counted once)."""
+    seen, size, stack = set(), 0, [obj]
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+    return size
+
+def report_version(conn, start: str, end: str) -> tuple:
+    """Fingerprint of everything a report over [start, end] depends on."""
+    return tuple(conn.execute(REPORT_VERSION_SQL, (start, end)).fetchone())
+
+def dashboard_key(start: str, end: str, view_uid, soc, cab) -> tuple:
+    return (start, end, view_uid, *(v if v not in ("", "ALL") else None for v in (soc, cab)))
+
+def dashboard_data(conn, start: str, end: str, view_uid, soc, cab, version=None) -> dict:
+    """Aggregates for one dashboard filter plus their serialized API body (`json`).
+
+    Served from dash_cache while no record, lock, rate or cabinet in scope has
+    changed; the version is read before the data so a concurrent save can only
+    make the entry stale, never wrong.
+    """
+    key = dashboard_key(start, end, view_uid, soc, cab)
+    if dash_cache.max_bytes and version is None:
+        version = report_version(conn, start, end)
+    if dash_cache.max_bytes:
+        hit = dash_cache.get(key, version)
+        if hit is not None:
+            return hit
+    where, params = report_filter(start, end, "user_id", view_uid, soc, cab)
+    data = aggregate_dashboard(conn.execute(DASH_ROLLUP_SQL.format(where=where), params))
+    data["cab_names"], data["soc_names"] = cabinet_labels(
+        conn, {row["cabinet_id"] for rows in data["per_geo_cab"].values() for row in rows})
+    data["json"] = json.dumps({
+        "filter": {"start_date": start, "end_date": end, "user_id": view_uid,
+                   "soc_id": key[3], "cab_id": key[4]},
+        "by_vert": data["by_vert"], "by_vert_geo": data["by_vert_geo"],
+        "total": data["total"], "total_by_geo": data["total_by_geo"], "by_day": data["by_day"],
+        "labels": data["labels"],
+        "series": {"total": data["ts_total"], "slots": data["ts_slots"], "crash": data["ts_crash"]},
+        "per_geo_cab": data["per_geo_cab"],
+        "cab_names": data["cab_names"], "soc_names": data["soc_names"],
+    }, ensure_ascii=False)
+    if dash_cache.max_bytes:
+        # в кэше лежит весь dict агрегатов, а не только JSON — считаем всё
+        dash_cache.put(key, version, data, deep_sizeof(data))
+    return data
+
+UNKNOWN_USER_ID = -1   # фильтр «никто»: id пользователей положительные, легаси-строки роллапа — 0
+
+def dashboard_scope(form) -> dict:
+    """Resolve the dashboard filter from form/query args and the session role.
+
+    Buyers always see their own data; team leads and admins pick a user or ALL.
+    """
+    role = session.get("role","BUYER")
+    today = date.today().isoformat()
+    scope = dict(
+        role=role, users=None,
+        start_date=form.get("start_date") or today,
+        end_date=form.get("end_date") or today,
+        sel_soc=form.get("soc_id"), sel_cab=form.get("cab_id"),
+    )
     if role in ("TEAM_LEAD","ADMIN"):
-        users = conn.execute("SELECT id,username FROM users WHERE is_deleted=0 ORDER BY username").fetchall()
-        view_user = sel_user or "ALL"
+        conn = db()
+        scope["users"] = conn.execute(
+            "SELECT id,username FROM users WHERE is_deleted=0 ORDER BY username").fetchall()
+        view_user = form.get("selected_user") or "ALL"
         view_uid = None
         if view_user != "ALL":
             row = conn.execute("SELECT id FROM users WHERE username=?", (view_user,)).fetchone()
             view_uid = row["id"] if row else None
     else:
-        users = None
-        view_user = session_user
-        view_uid = session_uid
+        view_user = session["username"]
+        view_uid = session["uid"]
+    if view_user == "ALL":
+        filter_uid = None
+    else:
+        # None в report_filter — «все пользователи»; неизвестный не должен туда проваливаться
+        filter_uid = view_uid if view_uid is not None else UNKNOWN_USER_ID
+    scope.update(view_user=view_user, view_uid=view_uid, filter_uid=filter_uid)
+    return scope
+
+@app.route("/dashboard", methods=["GET", "POST"])
+def dashboard():
+    if not require_login(): return redirect(url_for("login"))
+    sc = dashboard_scope(request.form if request.method == "POST" else request.args)
+    view_user, view_uid, sel_soc = sc["view_user"], sc["view_uid"], sc["sel_soc"]
 
     socs = []
     cabs = []
     if view_user != "ALL" and view_uid:
-        socs = conn.execute("SELECT * FROM socs WHERE user_id=? ORDER BY name", (view_uid,)).fetchall()
+        tree = load_soc_tree(view_uid)
+        socs = tree.socs
         if sel_soc:
-            cabs = conn.execute("SELECT * FROM cabinets WHERE soc_id=? ORDER BY name", (sel_soc,)).fetchall()
-
-    where = "date>=? AND date<=?"
-    params = [start_date, end_date]
-    if view_user != "ALL":
-        where = "user=? AND " + where
-        params = [view_user] + params
-    if sel_soc and sel_soc not in ("", "ALL"):
-        where += " AND cabinet_id IN (SELECT id FROM cabinets WHERE soc_id=?)"
-        params.append(sel_soc)
-    if sel_cab and sel_cab not in ("", "ALL"):
-        where += " AND cabinet_id=?"
-        params.append(sel_cab)
-
-    by_vert = {}
-    for r in conn.execute(f"""
-        SELECT vertical,
-               SUM(spend_usd) AS spend, SUM(deps) AS deps,
-               SUM(revenue) AS revenue, SUM(profit) AS profit
-        FROM records WHERE {where}
-        GROUP BY vertical
-    """, params).fetchall():
-        by_vert[r["vertical"]] = dict(r)
-
-    by_vert_geo = {}
-    for r in conn.execute(f"""
-        SELECT vertical, geo,
-               SUM(spend_usd) AS spend, SUM(deps) AS deps,
-               SUM(revenue) AS revenue, SUM(profit) AS profit
-        FROM records WHERE {where}
-        GROUP BY vertical, geo
-        ORDER BY vertical, geo
-    """, params).fetchall():
-        by_vert_geo.setdefault(r["vertical"], []).append(dict(r))
-
-    total = dict(conn.execute(f"""
-        SELECT SUM(spend_usd) AS spend, SUM(deps) AS deps,
-               SUM(revenue) AS revenue, SUM(profit) AS profit
-        FROM records WHERE {where}
-    """, params).fetchone())
-
-    total_by_geo = [dict(r) for r in conn.execute(f"""
-        SELECT geo,
-               SUM(spend_usd) AS spend, SUM(deps) AS deps,
-               SUM(revenue) AS revenue, SUM(profit) AS profit
-        FROM records WHERE {where}
-        GROUP BY geo
-        ORDER BY geo
-    """, params).fetchall()]
-
-    by_day = [dict(r) for r in conn.execute(f"""
-        SELECT date,
-               SUM(spend_usd) AS spend, SUM(deps) AS deps,
-               SUM(revenue) AS revenue, SUM(profit) AS profit,
-               MAX(updated_at) AS last
-        FROM records WHERE {where}
-        GROUP BY date
-        ORDER BY date
-    """, params).fetchall()]
-    for d in by_day:
-        d["last_msk"] = utc_to_msk(d.get("last"))
+            cabs = tree.cabs_by_soc.get(safe_int(sel_soc), [])
+
+    agg = dashboard_data(db(), sc["start_date"], sc["end_date"], sc["filter_uid"], sel_soc, sc["sel_cab"])
+
+    return render_template("dashboard.html",
+        role=sc["role"], session_user=session["username"], users=sc["users"],
+        view_user=view_user, start_date=sc["start_date"], end_date=sc["end_date"],
+        socs=socs, cabs=cabs, sel_soc=sel_soc, sel_cab=sc["sel_cab"],
+        by_vert=agg["by_vert"], by_vert_geo=agg["by_vert_geo"],
+        total=agg["total"], total_by_geo=agg["total_by_geo"], by_day=agg["by_day"],
+        per_geo_cab=agg["per_geo_cab"], cab_names=agg["cab_names"], soc_names=agg["soc_names"],
+        flags=FLAGS
+    )
 
-    labels = [d["date"] for d in by_day]
-    def pack_ts(rows):
-        spend, profit, deps, cac, roi = [], [], [], [], []
-        for d in rows:
-            s = int(d.get("spend") or 0)
-            p = int(d.get("profit") or 0)
-            r = int(d.get("revenue") or 0)
-            ft= int(d.get("deps") or 0)
-            spend.append(s); profit.append(p); deps.append(ft)
-            cac.append( (s/ft) if ft>0 else None )
-            roi.append( ((r - s)*100.0/s) if s>0 else None )
-        return dict(spend=spend, profit=profit, deps=deps, cac=cac, roi=roi)
-
-    ts_total = pack_ts(by_day)
-
-    per_v_day = {}
-    for r in conn.execute(f"""
-        SELECT date, vertical,
-               SUM(spend_usd) AS spend, SUM(deps) AS deps,
-               SUM(revenue) AS revenue, SUM(profit) AS profit
-        FROM records WHERE {where}
-        GROUP BY date, vertical
-        ORDER BY date, vertical
-    """, params).fetchall():
-        per_v_day.setdefault(r["vertical"], []).append(dict(r))
+@app.route("/api/dashboard", methods=["GET"])
+def api_dashboard():
+    """Dashboard aggregates as JSON with a strong ETag; If-None-Match answers 304.
 
-    def align_series(vname):
-        rows = per_v_day.get(vname, [])
-        idx = {row["date"]:row for row in rows}
-        arr = []
-        for lab in labels:
-            arr.append(idx.get(lab, {"date":lab,"spend":0,"deps":0,"revenue":0,"profit":0}))
-        return pack_ts(arr)
+    The ETag is derived from the filter and the data version alone, so a
+    revalidation costs one small query and never touches the aggregates.
+    """
+    if not require_login(): return jsonify(error="login required"), 401
+    sc = dashboard_scope(request.args)
+    conn = db()
+    key = dashboard_key(sc["start_date"], sc["end_date"], sc["filter_uid"], sc["sel_soc"], sc["sel_cab"])
+    version = report_version(conn, sc["start_date"], sc["end_date"])
+    etag = hashlib.sha1(repr((key, version)).encode()).hexdigest()
+    # сжатый ответ несёт ETag с суффиксом кодировки (см. compress_response)
+    match = next((t for t in (etag, etag + "-gzip", etag + "-br")
+                  if request.if_none_match.contains(t)), None)
+    if match:
+        resp = Response(status=304)
+        resp.set_etag(match)
+    else:
+        data = dashboard_data(conn, sc["start_date"], sc["end_date"], sc["filter_uid"],
+                              sc["sel_soc"], sc["sel_cab"], version=version)
+        resp = Response(data["json"], mimetype="application/json")
+        resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "private, no-cache"
+    return resp
+
+# ==================== Пересчёт по курсу FX ====================
+RECOMPUTE_CHUNK_ROWS = int(os.getenv("RECOMPUTE_CHUNK_ROWS", 500))
+RECOMPUTE_PAUSE = float(os.getenv("RECOMPUTE_PAUSE", 0.02))  # сек между чанками — окно для писателей
+
+RECOMPUTE_KEEP_JOBS = 100    # завершённых заданий в памяти для /accounts/fx_recompute
+
+# Та же формула, что в build_record_row, от введённого значения (spend_exact);
+# pyround = Python round(), чтобы округление совпадало до бита с сохранёнными
+# через форму. У строк до миграции 8 точного нет — берётся целый spend_raw.
+_SPEND_USD_EXPR = """pyround(COALESCE(records.spend_exact, records.spend_raw)
+    * (CASE WHEN c.cab_type='AGENCY' THEN 1.0 + c.commission_pct/100.0 ELSE 1.0 END)
+    * ?, 4)"""
+
+FX_RATE_ON_SQL = """
+    SELECT rate FROM fx_rates
+    WHERE date<=? AND from_currency=? AND to_currency='USD'
+    ORDER BY date DESC LIMIT 1
+"""
 
-    ts_slots = align_series("Slots")
-    ts_crash = align_series("Crash")
+_recompute_queue = queue.Queue()
+_recompute_jobs = {}           # job_id -> состояние (только этот воркер)
+_recompute_lock = threading.Lock()
+_recompute_ids = itertools.count(1)
+_recompute_thread = None
+
+def fx_affected_range(table: FxTable, d: str, currency: str) -> tuple[str, str | None]:
+    """[d, next rate date) — records whose rate lookup lands on the rate set for `d`."""
+    return d, table.next_date(d, currency)
+
+def recompute_fx(job: dict):
+    """Re-derive spend_usd/spend/profit for one currency and date range, chunk by chunk.
+
+    Each chunk is its own short BEGIN IMMEDIATE transaction over at most
+    RECOMPUTE_CHUNK_ROWS rows of one date, so buyers' saves interleave. The
+    rate is read inside that transaction, so a later correction is never
+    overwritten by an older job. daily_rollups follow through the records triggers.
+    """
+    cur_code, d_from, d_to = job["currency"], job["from_date"], job["to_date"]
+    date_cond = "date>=?" + (" AND date<?" if d_to else "")
+    date_params = [d_from] + ([d_to] if d_to else [])
+    with pool.connection() as conn:
+        conn.create_function("pyround", -1, round, deterministic=True)
+        days = [r[0] for r in conn.execute(f"""
+            SELECT DISTINCT date FROM records
+            WHERE {date_cond} AND spend_currency=? ORDER BY date
+        """, date_params + [cur_code]).fetchall()]
+        job["dates_total"] = len(days)
+        for day in days:
+            last_id = 0
+            while True:
+                hi = conn.execute("""
+                    SELECT MAX(id) FROM (
+                      SELECT id FROM records
+                      WHERE date=? AND spend_currency=? AND id>? ORDER BY id LIMIT ?)
+                """, (day, cur_code, last_id, RECOMPUTE_CHUNK_ROWS)).fetchone()[0]
+                if hi is None:
+                    break
+                with write_tx(conn):
+                    row = conn.execute(FX_RATE_ON_SQL, (day, cur_code)).fetchone()
+                    rate = row[0] if row else FX_FALLBACK_RATE
+                    n = conn.execute(f"""
+                        UPDATE records SET
+                          spend_usd = {_SPEND_USD_EXPR},
+                          spend = CAST(pyround({_SPEND_USD_EXPR}) AS INTEGER),
+                          profit = revenue - CAST(pyround({_SPEND_USD_EXPR}) AS INTEGER)
+                        FROM cabinets c
+                        WHERE c.id=records.cabinet_id AND records.spend_raw IS NOT NULL
+                          AND records.date=? AND records.spend_currency=?
+                          AND records.id>? AND records.id<=?
+                    """, (rate, rate, rate, day, cur_code, last_id, hi)).rowcount
+                job["rows_updated"] += n
+                last_id = hi
+                time.sleep(RECOMPUTE_PAUSE)
+            job["dates_done"] += 1
+            logging.info("fx recompute %s: %s done (%d/%d dates, %d rows)", job["id"], day,
+                         job["dates_done"], job["dates_total"], job["rows_updated"])
+
+def _recompute_worker():
+    while True:
+        job = _recompute_queue.get()
+        job["status"] = "running"
+        job["started_at"] = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            recompute_fx(job)
+            job["status"] = "done"
+        except Exception as e:
+            job["status"] = "failed"
+            job["error"] = repr(e)
+            logging.exception("fx recompute %s failed", job["id"])
+        finally:
+            job["finished_at"] = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+
+def schedule_fx_recompute(d: str, currency: str = "EUR") -> dict:
+    """Queue a background recompute for records affected by the rate set on `d`."""
+    global _recompute_thread
+    table = fx_table()
+    d_from, d_to = fx_affected_range(table, d, currency)
+    with _recompute_lock:
+        finished = [k for k, j in _recompute_jobs.items() if j["status"] in ("done", "failed")]
+        for k in finished[:max(0, len(finished) - RECOMPUTE_KEEP_JOBS)]:
+            del _recompute_jobs[k]
+        job = {
+            "id": f"fx-{int(time.time() * 1000)}-{next(_recompute_ids)}",
+            "currency": currency, "from_date": d_from, "to_date": d_to,
+            "rate": table.rate(d, currency), "status": "queued",
+            "dates_total": None, "dates_done": 0, "rows_updated": 0,
+            "started_at": None, "finished_at": None, "error": None,
+        }
+        _recompute_jobs[job["id"]] = job
+        if _recompute_thread is None or not _recompute_thread.is_alive():
+            _recompute_thread = threading.Thread(target=_recompute_worker,
+                                                 name="fx-recompute", daemon=True)
+            _recompute_thread.start()
+    _recompute_queue.put(job)
+    return job
+
+@app.route("/accounts/fx_recompute", methods=["GET"])
+def fx_recompute_status():
+    if not require_tl(): return "Forbidden", 403
+    job_id = request.args.get("id")
+    if job_id:
+        job = _recompute_jobs.get(job_id)
+        return (jsonify(job), 200) if job else ("Unknown job", 404)
+    return jsonify(jobs=sorted(_recompute_jobs.values(), key=lambda j: j["id"], reverse=True)[:20])
+
+# ==================== Журнал аудита ====================
+AUDIT_PAGE_MAX = 500
+AUDIT_KEEP_MONTHS = int(os.getenv("AUDIT_KEEP_MONTHS", 12))   # сколько месяцев держать в основной базе
+AUDIT_ARCHIVE_DIR = os.getenv("AUDIT_ARCHIVE_DIR",
+                              os.path.join(os.path.dirname(DB_PATH), "audit_archive"))
+AUDIT_ARCHIVE_CHUNK = 5000
+
+AUDIT_PAGE_SQL = """
+    SELECT id, ts, actor_user, action, payload FROM audit_log
+    WHERE {where}
+    ORDER BY ts DESC, id DESC
+    LIMIT ?
+"""
 
-    per_geo_cab = {}
-    for r in conn.execute(f"""
-        SELECT geo, cabinet_id,
-               (SELECT soc_id FROM cabinets c WHERE c.id=records.cabinet_id) AS soc_id,
-               SUM(spend_usd) AS spend, SUM(deps) AS deps,
-               SUM(revenue) AS revenue, SUM(profit) AS profit
-        FROM records WHERE {where}
-        GROUP BY geo, cabinet_id
-        HAVING spend>0
-        ORDER BY geo
-    """, params).fetchall():
-        per_geo_cab.setdefault(r["geo"], []).append(dict(r))
-
-    cab_names = {}
-    soc_names = {}
-    for r in conn.execute("SELECT id,name,soc_id FROM cabinets").fetchall():
-        cab_names[r["id"]] = r["name"]
-        soc_names.setdefault(r["soc_id"], None)
-    for s in conn.execute("SELECT id,name FROM socs").fetchall():
-        soc_names[s["id"]] = s["name"]
-
-    conn.close()
-
-    return render_template_string(DASH_TPL,
-        role=role, session_user=session_user, users=users,
-        view_user=view_user, start_date=start_date, end_date=end_date,
-        socs=socs, cabs=cabs, sel_soc=sel_soc, sel_cab=sel_cab,
-        by_vert=by_vert, by_vert_geo=by_vert_geo, total=total, total_by_geo=total_by_geo,
-        by_day=by_day, labels=json.dumps(labels),
-        ts_total=json.dumps(ts_total), ts_slots=json.dumps(ts_slots), ts_crash=json.dumps(ts_crash),
-        per_geo_cab=per_geo_cab, cab_names=cab_names, soc_names=soc_names, flags=FLAGS
+def audit_filter(actor=None, action=None, start=None, end=None,
+                 key=None, value=None, cursor=None) -> tuple[str, list]:
+    """WHERE clause for an audit page; `cursor` is (ts, id) of the last row already shown."""
+    where, params = ["1=1"], []
+    if actor:
+        where.append("actor_user=?"); params.append(actor)
+    if action:
+        where.append("action=?"); params.append(action)
+    if start:
+        where.append("ts>=?"); params.append(start)
+    if end:
+        # end — дата включительно
+        where.append("ts<?"); params.append(end + " 99")
+    if cursor:
+        where.append("(ts, id) < (?, ?)"); params.extend(cursor)
+    if key:
+        # payload не индексируется: фильтр по ключу — остаточный поверх индексного диапазона
+        if value is None:
+            where.append("json_extract(payload, ?) IS NOT NULL"); params.append(f"$.{key}")
+        else:
+            where.append("CAST(json_extract(payload, ?) AS TEXT)=?"); params += [f"$.{key}", value]
+    return " AND ".join(where), params
+
+def audit_archive_path(month: str) -> str:
+    return os.path.join(AUDIT_ARCHIVE_DIR, f"audit-{month}.db")
+
+def _open_audit_archive(month: str) -> sqlite3.Connection:
+    os.makedirs(AUDIT_ARCHIVE_DIR, exist_ok=True)
+    conn = sqlite3.connect(audit_archive_path(month))
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS audit_log (
+      id INTEGER PRIMARY KEY,
+      ts TEXT NOT NULL,
+      actor_user TEXT NOT NULL,
+      action TEXT NOT NULL,
+      payload TEXT
     )
+    """)
+    for sql in AUDIT_INDEXES:
+        conn.execute(sql)
+    conn.commit()
+    return conn
+
+def archive_audit(keep_months: int = AUDIT_KEEP_MONTHS, today: date | None = None) -> dict:
+    """Move audit rows older than `keep_months` whole months into audit-YYYY-MM.db files.
+
+    Each chunk is committed to the archive first and only then deleted from
+    the main database, so an interrupted run leaves duplicates (skipped by
+    INSERT OR IGNORE on the next run), never lost rows.
+    """
+    today = today or date.today()
+    y, m = divmod(today.year * 12 + today.month - 1 - keep_months, 12)
+    cutoff = f"{y:04d}-{m + 1:02d}-01"
+    moved = {}
+    with pool.connection() as conn:
+        months = [r[0] for r in conn.execute(
+            "SELECT DISTINCT substr(ts, 1, 7) FROM audit_log WHERE ts<? ORDER BY 1", (cutoff,))]
+        for month in months:
+            arc = _open_audit_archive(month)
+            try:
+                lo, hi, n = month + "-01", month + "-99", 0
+                while True:
+                    rows = conn.execute("""
+                        SELECT id, ts, actor_user, action, payload FROM audit_log
+                        WHERE ts>=? AND ts<? ORDER BY ts, id LIMIT ?
+                    """, (lo, hi, AUDIT_ARCHIVE_CHUNK)).fetchall()
+                    if not rows:
+                        break
+                    with arc:
+                        arc.executemany("INSERT OR IGNORE INTO audit_log VALUES (?,?,?,?,?)",
+                                        [tuple(r) for r in rows])
+                    with write_tx(conn):
+                        conn.executemany("DELETE FROM audit_log WHERE id=?", [(r[0],) for r in rows])
+                    n += len(rows)
+            finally:
+                arc.close()
+            moved[month] = n
+    return moved
+
+@app.route("/audit", methods=["GET"])
+def audit_browse():
+    """Audit log as JSON, newest first; ?cursor= from the previous page's `next`."""
+    if not require_admin(): return "Forbidden", 403
+    args = request.args
+    limit = min(max(safe_int(args.get("limit"), 100), 1), AUDIT_PAGE_MAX)
+    key = args.get("key") or None
+    if key and not key.replace("_", "").isalnum():
+        return "Bad payload key", 400
+    cursor = None
+    if args.get("cursor"):
+        ts, _, last_id = args["cursor"].rpartition("|")
+        if not ts or not last_id.isdigit():
+            return "Bad cursor", 400
+        cursor = (ts, int(last_id))
+    where, params = audit_filter(args.get("actor"), args.get("action"),
+                                 args.get("start") or None, args.get("end") or None,
+                                 key, args.get("value"), cursor)
+
+    month = args.get("archive")
+    if month:
+        if len(month) != 7 or not month.replace("-", "").isdigit():
+            return "Bad archive month", 400
+        path = audit_archive_path(month)
+        if not os.path.exists(path):
+            return "Unknown archive", 404
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    else:
+        conn = db()
+    try:
+        rows = conn.execute(AUDIT_PAGE_SQL.format(where=where), params + [limit]).fetchall()
+    finally:
+        if month:
+            conn.close()
+
+    items = []
+    for r in rows:
+        try:
+            payload = json.loads(r[4]) if r[4] else None
+        except ValueError:
+            payload = r[4]
+        items.append({"id": r[0], "ts": r[1], "ts_msk": utc_to_msk(r[1]),
+                      "actor": r[2], "action": r[3], "payload": payload})
+    nxt = f"{rows[-1][1]}|{rows[-1][0]}" if len(rows) == limit else None
+    archives = sorted(f[6:13] for f in os.listdir(AUDIT_ARCHIVE_DIR)
+                      if f.startswith("audit-") and f.endswith(".db")) if os.path.isdir(AUDIT_ARCHIVE_DIR) else []
+    return jsonify(items=items, next=nxt, archives=archives)
+
+# ==================== CLI ====================
+@app.cli.command("rebuild-rollups")
+def rebuild_rollups_command():
+    """Recompute daily_rollups from records (flask --app main rebuild-rollups)."""
+    with pool.connection() as conn:
+        n = rebuild_daily_rollups(conn)
+    print(f"daily_rollups: {n} rows")
+
+@app.cli.command("recompute-fx")
+@click.argument("from_date")
+@click.option("--currency", default="EUR", show_default=True)
+def recompute_fx_command(from_date, currency):
+    """Recompute spend_usd/profit for records priced by the rate set on FROM_DATE."""
+    table = fx_table()
+    d_from, d_to = fx_affected_range(table, from_date, currency)
+    job = {"id": "cli", "currency": currency, "from_date": d_from, "to_date": d_to,
+           "rate": table.rate(from_date, currency), "dates_done": 0, "rows_updated": 0}
+    recompute_fx(job)
+    print(f"{currency} {d_from} → {d_to or '…'} @ {job['rate']}: "
+          f"{job['rows_updated']} rows over {job['dates_done']} dates")
+
+@app.cli.command("archive-audit")
+@click.option("--keep-months", default=AUDIT_KEEP_MONTHS, show_default=True, type=int)
+def archive_audit_command(keep_months):
+    """Move old audit_log rows into monthly archive databases (AUDIT_ARCHIVE_DIR)."""
+    moved = archive_audit(keep_months)
+    for month, n in moved.items():
+        print(f"{month}: {n} rows → {audit_archive_path(month)}")
+    print(f"archived {sum(moved.values())} rows in {len(moved)} months")
+
+@app.cli.command("check-query-plans")
+def check_query_plans_command():
+    """Fail if EXPLAIN QUERY PLAN shows a table scan in any hot query."""
+    with pool.connection() as conn:
+        bad = full_scans(conn)
+    for name, detail in bad:
+        print(f"FULL SCAN  {name}: {detail}")
+    if bad:
+        raise SystemExit(1)
+    print(f"ok: {len(hot_queries())} hot queries, no full scans")
 
 # ==================== Export CSV / Backup / Health ====================
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", 2000))
+EXPORT_HEADER = ["user", "date", "vertical", "geo", "cabinet", "spend_raw", "spend_currency",
+                 "spend_usd", "deps", "revenue", "profit", "updated_at"]
+
+def iter_export_chunks(flt: dict):
+    """Yield lists of export rows, EXPORT_CHUNK_ROWS at a time; `flt` is report_filter kwargs.
+
+    Every batch is one short query on a pooled connection that goes straight
+    back to the pool, so a slow download never pins a connection or keeps a
+    read transaction (and the WAL behind it) open. The next batch continues
+    after the last row's ORDER BY key: each batch is consistent on its own,
+    and rows saved mid-download appear only if they sort after that point.
+    """
+    # выражения в row value SQLite в диапазон индекса не берёт: продолжение ищется
+    # по индексу до даты последней строки, остаток этого дня отсеивается по нему же
+    order = export_key(flt["user_val"])
+    after = None
+    while True:
+        where, params = report_filter(after=after, **flt)
+        with pool.connection() as conn:
+            rows = conn.execute(EXPORT_SQL.format(where=where, order=order),
+                                params + [EXPORT_CHUNK_ROWS]).fetchall()
+        if rows:
+            yield rows
+        if len(rows) < EXPORT_CHUNK_ROWS:
+            return
+        last = rows[-1]
+        after = (last["date"], last["user"], last["vertical"], last["geo"], last["id"])
+
+def _csv_row(r) -> list:
+    return [r["user"], r["date"], r["vertical"], r["geo"],
+            r["cabinet_id"] or "", r["spend_raw"] or 0,
+            r["spend_currency"] or "", r["spend_usd"] or 0,
+            int(r["deps"] or 0), int(r["revenue"] or 0),
+            int(r["profit"] or 0), r["updated_at"] or ""]
+
+def _opt(cast, v):
+    return None if v is None else cast(v)
+
+def _typed_row(r) -> list:
+    # для NDJSON/Arrow: NULL остаётся null, числа — числами (в CSV всё строки)
+    return [r["user"], r["date"], r["vertical"], r["geo"],
+            _opt(int, r["cabinet_id"]), _opt(float, r["spend_raw"]),
+            r["spend_currency"], _opt(float, r["spend_usd"]),
+            _opt(int, r["deps"]), _opt(int, r["revenue"]),
+            _opt(int, r["profit"]), r["updated_at"]]
+
+def stream_csv(flt: dict):
+    # заголовок уходит сразу, до выполнения запроса; дальше — по чанку за раз
+    buf = io.StringIO()
+    w = csv.writer(buf, lineterminator="\n")
+    w.writerow(EXPORT_HEADER)
+    yield buf.getvalue()
+    for rows in iter_export_chunks(flt):
+        buf.seek(0); buf.truncate()
+        w.writerows(map(_csv_row, rows))
+        yield buf.getvalue()
+
+def stream_ndjson(flt: dict):
+    for rows in iter_export_chunks(flt):
+        yield "".join(
+            json.dumps(dict(zip(EXPORT_HEADER, _typed_row(r))), ensure_ascii=False) + "\n"
+            for r in rows
+        )
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only sink for pyarrow writers; the generator drains it after each batch."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._pos = 0
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        self._pos += len(b)
+        return len(b)
+
+    def tell(self):
+        # Parquet пишет смещения колонок в футер — позиция должна быть сквозной
+        return self._pos
+
+    def drain(self) -> bytes:
+        out = b"".join(self._chunks)
+        self._chunks.clear()
+        return out
+
+def _arrow_schema():
+    return pa.schema([
+        ("user", pa.string()), ("date", pa.string()), ("vertical", pa.string()),
+        ("geo", pa.string()), ("cabinet", pa.int64()), ("spend_raw", pa.float64()),
+        ("spend_currency", pa.string()), ("spend_usd", pa.float64()),
+        ("deps", pa.int64()), ("revenue", pa.int64()), ("profit", pa.int64()),
+        ("updated_at", pa.string()),
+    ])
+
+def _arrow_batch(rows, schema):
+    cols = list(zip(*map(_typed_row, rows)))
+    return pa.record_batch([pa.array(c, type=f.type) for c, f in zip(cols, schema)], schema=schema)
+
+def stream_arrow(flt: dict):
+    schema = _arrow_schema()
+    sink = _ChunkSink()
+    opts = pa.ipc.IpcWriteOptions(compression="zstd")
+    with pa.ipc.new_stream(sink, schema, options=opts) as writer:
+        yield sink.drain()
+        for rows in iter_export_chunks(flt):
+            writer.write_batch(_arrow_batch(rows, schema))
+            yield sink.drain()
+    yield sink.drain()
+
+PARQUET_ROW_GROUP_ROWS = 64 * 1024
+
+def stream_parquet(flt: dict):
+    schema = _arrow_schema()
+    sink = _ChunkSink()
+    pending, n = [], 0
+    with pa.parquet.ParquetWriter(sink, schema, compression="zstd") as writer:
+        for rows in iter_export_chunks(flt):
+            pending.append(_arrow_batch(rows, schema)); n += len(rows)
+            if n >= PARQUET_ROW_GROUP_ROWS:
+                writer.write_table(pa.Table.from_batches(pending, schema=schema))
+                pending, n = [], 0
+                yield sink.drain()
+        if pending:
+            writer.write_table(pa.Table.from_batches(pending, schema=schema))
+    yield sink.drain()
+
+# format= → (расширение, mimetype, генератор, нужен ли pyarrow)
+EXPORT_FORMATS = {
+    "csv": ("csv", "text/csv", stream_csv, False),
+    "ndjson": ("ndjson", "application/x-ndjson", stream_ndjson, False),
+    "arrow": ("arrows", "application/vnd.apache.arrow.stream", stream_arrow, True),
+    "parquet": ("parquet", "application/vnd.apache.parquet", stream_parquet, True),
+}
+
 @app.route("/export_csv")
 def export_csv():
     if not require_login(): return redirect(url_for("login"))
@@ -812,62 +3059,205 @@ def export_csv():
     user  = request.args.get("user") or session["username"]
     soc_id= request.args.get("soc_id")
     cab_id= request.args.get("cab_id")
+    fmt   = (request.args.get("format") or "csv").lower()
 
-    where = "date>=? AND date<=?"
-    params = [start, end]
-    if user != "ALL":
-        where = "user=? AND " + where
-        params = [user] + params
-    if soc_id and soc_id not in ("","ALL"):
-        where += " AND cabinet_id IN (SELECT id FROM cabinets WHERE soc_id=?)"
-        params.append(soc_id)
-    if cab_id and cab_id not in ("","ALL"):
-        where += " AND cabinet_id=?"
-        params.append(cab_id)
+    if fmt not in EXPORT_FORMATS:
+        return f"Unknown format, use one of: {', '.join(EXPORT_FORMATS)}", 400
+    ext, mimetype, stream, needs_arrow = EXPORT_FORMATS[fmt]
+    if needs_arrow and pa is None:
+        return f"format={fmt} requires pyarrow on the server", 501
 
-    conn = db()
-    rows = conn.execute(f"""
-        SELECT user,date,vertical,geo,cabinet_id,spend_raw,spend_currency,spend_usd,deps,revenue,profit,updated_at
-        FROM records WHERE {where}
-        ORDER BY date, user, vertical, geo
-    """, params).fetchall()
-    conn.close()
-
-    out = ["user,date,vertical,geo,cabinet,spend_raw,spend_currency,spend_usd,deps,revenue,profit,updated_at"]
-    for r in rows:
-        out.append("{user},{date},{vertical},{geo},{cab},{sraw},{sc},{susd},{deps},{rev},{prof},{upd}".format(
-            user=r["user"], date=r["date"], vertical=r["vertical"], geo=r["geo"],
-            cab=r["cabinet_id"] or "", sraw=str(r["spend_raw"] or 0),
-            sc=r["spend_currency"] or "", susd=str(r["spend_usd"] or 0),
-            deps=int(r["deps"] or 0), rev=int(r["revenue"] or 0),
-            prof=int(r["profit"] or 0), upd=r["updated_at"] or ""
-        ))
-
-    filename = f"report_{user}_{start}_{end}.csv"
-    return Response("\n".join(out), mimetype="text/csv",
-        headers={"Content-Disposition": f"attachment; filename={filename}"})
+    flt = dict(start=start, end=end, user_col="user", user_val=None if user == "ALL" else user,
+               soc_id=soc_id, cab_id=cab_id)
+    filename = f"report_{user}_{start}_{end}.{ext}".replace('"', "")
+    return Response(stream(flt), mimetype=mimetype,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'})
 
 @app.route("/backup")
 def backup_download():
+    if not require_admin(): return "Forbidden", 403
     if not os.path.exists(DB_PATH):
         return "No DB yet", 404
-    return send_file(DB_PATH, as_attachment=True)
+    filename = f"data-{datetime.utcnow().strftime('%Y-%m-%d_%H%M%S')}.db"
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+    if request.method == "HEAD":
+        # снимок ради заголовков не делаем
+        return Response(mimetype="application/vnd.sqlite3", headers=headers)
+    fd, path = tempfile.mkstemp(prefix="snapshot-", suffix=".db", dir=BACKUP_DIR)
+    os.close(fd)
+    try:
+        snapshot_db(path)
+    except Exception:
+        os.remove(path)
+        raise
+
+    def stream():
+        with open(path, "rb") as fh:
+            while chunk := fh.read(256 * 1024):
+                yield chunk
+
+    def cleanup():
+        # call_on_close срабатывает и когда клиент отвалился до начала чтения
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    headers["Content-Length"] = str(os.path.getsize(path))
+    resp = Response(stream(), mimetype="application/vnd.sqlite3", headers=headers)
+    resp.call_on_close(cleanup)
+    return resp
 
 @app.route("/health")
 def health():
     return "ok", 200
 
+@app.route("/health/db")
+def health_db():
+    return jsonify(pool=pool.stats(), audit=audit_writer.stats())
+
+@app.route("/health/cache")
+def health_cache():
+    return jsonify(dashboard=dash_cache.stats())
+
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(render_metrics(gather_snapshots()),
+                    content_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.route("/admin/slow_queries", methods=["GET", "POST"])
+def slow_queries():
+    """Slow-query log (JSON); POST clears it."""
+    if not require_admin(): return "Forbidden", 403
+    if slow_log is None:
+        return jsonify(enabled=False, hint="set SLOW_QUERY_MS to enable")
+    if request.method == "POST":
+        slow_log.reset()
+    return jsonify(enabled=True, **slow_log.report(safe_int(request.args.get("top"), SLOW_QUERY_TOP)))
+
+@app.route("/health/bcrypt")
+def health_bcrypt():
+    return jsonify(bcrypt=hasher.stats(), login_limiter=login_limiter.stats())
+
+# ==================== Static assets & compression ====================
+STATIC_DIR = os.path.join(app.root_path, "static")
+ASSET_MAX_AGE = 365 * 24 * 3600
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", 1024))   # меньше — не сжимаем; <0 — выкл
+COMPRESS_GZIP_LEVEL = int(os.getenv("COMPRESS_GZIP_LEVEL", 6))
+COMPRESS_BROTLI_QUALITY = int(os.getenv("COMPRESS_BROTLI_QUALITY", 5))
+COMPRESSIBLE_TYPES = {"text/html", "text/css", "text/plain", "text/csv",
+                      "application/javascript", "text/javascript", "application/json"}
+
+def compress_body(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=COMPRESS_BROTLI_QUALITY)
+    return gzip.compress(data, COMPRESS_GZIP_LEVEL, mtime=0)
+
+def negotiate_encoding() -> str | None:
+    """Best content coding the client accepts: br (if brotli is installed), then gzip."""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        return "br"
+    if accepted["gzip"]:
+        return "gzip"
+    return None
+
+class Asset:
+    """A file under static/, read once; compressed variants are made on first request."""
+
+    def __init__(self, name: str, data: bytes):
+        self.name = name
+        self.data = data
+        self.digest = hashlib.sha256(data).hexdigest()[:16]
+        self.mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        self._encoded = {}
+
+    def coding(self, encoding: str | None) -> str | None:
+        """Content coding actually applied when the client accepts `encoding`."""
+        if (encoding is None or self.mimetype not in COMPRESSIBLE_TYPES
+                or COMPRESS_MIN_BYTES < 0 or len(self.data) < COMPRESS_MIN_BYTES):
+            return None
+        return encoding
+
+    def body(self, encoding: str | None) -> tuple[bytes, str | None]:
+        encoding = self.coding(encoding)
+        if encoding is None:
+            return self.data, None
+        if encoding not in self._encoded:
+            self._encoded[encoding] = compress_body(self.data, encoding)
+        return self._encoded[encoding], encoding
+
+def load_assets(root: str) -> dict:
+    assets = {}
+    for dirpath, _, files in os.walk(root):
+        for fn in files:
+            path = os.path.join(dirpath, fn)
+            name = os.path.relpath(path, root).replace(os.sep, "/")
+            with open(path, "rb") as fh:
+                assets[name] = Asset(name, fh.read())
+    return assets
+
+ASSETS = load_assets(STATIC_DIR) if os.path.isdir(STATIC_DIR) else {}
+
+@app.template_global()
+def asset_url(name: str) -> str:
+    """Content-hashed URL of a static asset."""
+    asset = ASSETS.get(name)
+    if asset is None:
+        raise KeyError(f"unknown static asset {name!r}")
+    return url_for("asset", digest=asset.digest, name=name)
+
+@app.route("/assets/<digest>/<path:name>")
+def asset(digest, name):
+    a = ASSETS.get(name)
+    if a is None:
+        return "Not found", 404
+    if digest != a.digest:
+        # ссылка со старой страницы после деплоя — отдаём актуальную версию
+        return redirect(url_for("asset", digest=a.digest, name=name))
+    # у сжатых вариантов свои байты — и свой strong ETag, как в compress_response
+    encoding = a.coding(negotiate_encoding())
+    etag = f"{a.digest}-{encoding}" if encoding else a.digest
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+    else:
+        data, _ = a.body(encoding)
+        resp = Response(data, mimetype=a.mimetype)
+        if encoding:
+            resp.headers["Content-Encoding"] = encoding
+    resp.set_etag(etag)
+    resp.headers["Cache-Control"] = f"public, max-age={ASSET_MAX_AGE}, immutable"
+    resp.vary.add("Accept-Encoding")
+    return resp
+
+@app.after_request
+def compress_response(resp):
+    """gzip/brotli for buffered text responses of at least COMPRESS_MIN_BYTES.
+
+    Streams (exports) and files (backup) pass through untouched. A strong
+    ETag gets the coding appended, since the compressed bytes differ.
+    """
+    if (COMPRESS_MIN_BYTES < 0 or resp.status_code != 200 or resp.direct_passthrough
+            or resp.is_streamed or "Content-Encoding" in resp.headers
+            or resp.mimetype not in COMPRESSIBLE_TYPES):
+        return resp
+    resp.vary.add("Accept-Encoding")
+    encoding = negotiate_encoding()
+    if encoding is None or resp.content_length is None or resp.content_length < COMPRESS_MIN_BYTES:
+        return resp
+    resp.set_data(compress_body(resp.get_data(), encoding))
+    resp.headers["Content-Encoding"] = encoding
+    tag, weak = resp.get_etag()
+    if tag and not weak:
+        resp.set_etag(f"{tag}-{encoding}")
+    return resp
+
 # ==================== Templates ====================
 LOGIN_TPL = """
 <!doctype html><html><head>
 <meta charset="utf-8"><title>Login</title>
-<style>
-body{font-family:Inter,Arial,sans-serif;background:#f6f7fb;display:flex;height:100vh;align-items:center;justify-content:center}
-.card{background:#fff;padding:28px;border-radius:16px;box-shadow:0 10px 30px rgba(0,0,0,.08);width:min(380px,92vw)}
-input,button{width:100%;padding:12px 14px;border-radius:10px;border:1px solid #ddd}
-button{background:#2563eb;color:#fff;border:none;margin-top:10px;cursor:pointer}
-.err{color:#b91c1c;margin-top:8px}
-</style></head><body>
+<link rel="stylesheet" href="{{ asset_url('css/login.css') }}">
+</head><body>
 <div class="card">
   <h3>Вход</h3>
   {% if error %}<div class="err">{{error}}</div>{% endif %}
@@ -885,23 +3275,8 @@ ACCOUNTS_TPL = """
 <!doctype html><html><head>
 <meta charset="utf-8"><title>Аккаунты</title>
 <meta name="viewport" content="width=device-width, initial-scale=1">
-<style>
-:root{--bg:#f6f7fb;--card:#fff;--primary:#2563eb;--muted:#6b7280}
-body{font-family:Inter,Arial,sans-serif;background:var(--bg);margin:14px;color:#0f172a}
-.header,.card{background:#fff;border-radius:16px;box-shadow:0 10px 30px rgba(0,0,0,.06);padding:12px 14px}
-.row{display:flex;gap:12px;flex-wrap:wrap}
-.btn{padding:8px 12px;border-radius:10px;border:1px solid #d1d5db;background:#fff;cursor:pointer}
-.btn.primary{background:var(--primary);color:#fff;border:none}
-.small{font-size:12px;color:var(--muted)}
-.badge{padding:2px 8px;border-radius:999px;font-size:12px}
-.badge.green{background:#dcfce7;color:#166534}
-.badge.red{background:#fee2e2;color:#991b1b}
-.input{padding:8px 10px;border-radius:10px;border:1px solid #e5e7eb}
-table{border-collapse:collapse;width:100%}
-th,td{border:1px solid #eef2f7;padding:6px 8px;text-align:left;vertical-align:top}
-.flex{display:flex;gap:8px;flex-wrap:wrap}
-.section{margin-top:12px}
-</style></head><body>
+<link rel="stylesheet" href="{{ asset_url('css/accounts.css') }}">
+</head><body>
 
 <div class="header" style="display:flex;gap:10px;align-items:center">
   <div class="flex">
@@ -1058,35 +3433,7 @@ th,td{border:1px solid #eef2f7;padding:6px 8px;text-align:left;vertical-align:to
 
 </div>
 
-<script>
-function userAction(form, val){
-  // только меняем action, отправка по кнопке OK
-  if(val === 'DEL'){
-    form.setAttribute('data-target', '/accounts/user_delete');
-  }else{
-    form.setAttribute('data-target', '/accounts/user_toggle');
-  }
-}
-function submitStatus(btn){
-  const form = btn.closest('form');
-  const sel  = form.querySelector('select[name="status_action"]');
-  const target = form.getAttribute('data-target') || '/accounts/user_toggle';
-  if(sel.value === 'DEL'){
-    if(!confirm('Удалить пользователя?')) return;
-    if(!confirm('Точно удалить?')) return;
-  }
-  // создаём скрытую «настоящую» форму для POST
-  const f = document.createElement('form');
-  f.method='post';
-  f.action=target;
-  const id = form.querySelector('input[name="id"]').value;
-  const hid = document.createElement('input'); hid.type='hidden'; hid.name='id'; hid.value=id; f.appendChild(hid);
-  if(sel.value !== 'DEL'){
-    const st = document.createElement('input'); st.type='hidden'; st.name='status_action'; st.value=sel.value; f.appendChild(st);
-  }
-  document.body.appendChild(f); f.submit();
-}
-</script>
+<script src="{{ asset_url('js/accounts.js') }}"></script>
 
 </body></html>
 """
@@ -1096,118 +3443,9 @@ INPUT_TPL = """
 <!doctype html><html><head>
 <meta charset="utf-8"><title>Внесение данных</title>
 <meta name="viewport" content="width=device-width, initial-scale=1">
-<style>
-:root{
-  --bg:#f6f7fb; --card:#fff; --primary:#2563eb; --muted:#6b7280;
-  --green:#16a34a; --red:#dc2626; --line:#eef2f7; --sub:#f3f4f6;
-}
-*{box-sizing:border-box}
-html,body{height:100%}
-body{font-family:Inter,Arial,sans-serif;background:var(--bg);margin:14px;color:#0f172a}
-.header,.card{background:#fff;border-radius:16px;box-shadow:0 10px 30px rgba(0,0,0,.06);padding:12px 14px}
-.flex{display:flex;gap:10px;flex-wrap:wrap;align-items:center}
-.btn{padding:8px 12px;border-radius:10px;border:1px solid #d1d5db;background:#fff;cursor:pointer}
-.btn.primary{background:var(--primary);color:#fff;border:none}
-.btn.soc{background:#f3f4f6}
-.btn.soc.selected{background:#dbeafe;border-color:#93c5fd}
-.btn.cab.ACTIVE{background:#dcfce7;color:#14532d;border:none}
-.btn.cab.BANNED{background:#fee2e2;color:#7f1d1d;border:none}
-.btn.cab.selected{outline:2px solid #2563eb}
-.input{padding:8px 10px;border-radius:10px;border:1px solid #e5e7eb;min-width:90px}
-.small{color:#6b7280;font-size:12px}
-.badge{padding:2px 8px;border-radius:999px;font-size:12px}
-.badge.info{background:#e0f2fe;color:#075985}
-.badge.tip{background:#fef3c7;color:#92400e}
-.tbl-wrap{overflow:auto;border-radius:12px;border:1px solid var(--line);background:#fff;max-width:100%}
-table{width:100%;border-collapse:separate;border-spacing:0;table-layout:auto}
-th,td{border-bottom:1px solid var(--line);padding:12px 14px;white-space:nowrap;text-align:center}
-th.left,td.left{text-align:left}
-thead tr:nth-child(1) th{background:#f0f3fa;font-weight:700}
-thead tr:nth-child(2) th{background:var(--sub);color:#334155}
-thead th{position:sticky;top:0;z-index:2}
-tbody tr:nth-child(even) td{background:#fafbff}
-.vert{font-weight:600}
-.geo{font-weight:600}
-.sep td{border-top:1px solid var(--line)}
-.footer-actions{display:flex;gap:10px;justify-content:flex-end;margin-top:12px}
-.toast{position:fixed;left:50%;bottom:16px;transform:translateX(-50%) translateY(10px);background:#16a34a;color:#fff;padding:10px 14px;border-radius:10px;box-shadow:0 10px 30px rgba(0,0,0,.15);opacity:0;transition:.2s;z-index:9999}
-.toast.show{opacity:1;transform:translateX(-50%) translateY(0)}
-.toast.error{background:#dc2626}
-@media (max-width:900px){
-  .input{min-width:72px}
-  th,td{padding:10px}
-}
-</style>
-
-<script>
-let formDirty=false;
-let allowUnload=false;
-
-function markDirty(){ formDirty=true; }
-
-function go(href){
-  if(!formDirty || confirm('Есть несохранённые изменения. Уйти без сохранения?')){
-    window.location = href;
-  }
-}
-
-window.onbeforeunload = function(e){
-  if(!formDirty || allowUnload) return;
-  e.preventDefault(); e.returnValue=''; return '';
-};
+<link rel="stylesheet" href="{{ asset_url('css/input.css') }}">
 
-function onDateChange(form){
-  if(!formDirty || confirm('Есть несохранённые изменения. Переключить дату без сохранения?')){
-    window.location = form.action;
-  }
-}
-
-// «0 UX»: при фокусе очищаем 0, при blur возвращаем 0, если пусто
-function ZeroUX(){
-  document.querySelectorAll('input[type="number"]').forEach(el=>{
-    el.addEventListener('focus', function(){
-      if(this.value==='0' || this.value==='0.0' || this.value==='0.00') this.value='';
-    });
-    el.addEventListener('blur', function(){
-      if(this.value.trim()==='') this.value='0';
-    });
-  });
-}
-
-function armSaveForm(){
-  const f=document.getElementById('saveForm');
-  if(!f) return;
-  f.addEventListener('submit', ()=>{
-    allowUnload=true;
-    window.onbeforeunload = null;
-  });
-}
-
-function toastOnSaved(){
-  const url = new URL(window.location.href);
-  if(url.searchParams.get('saved')==='1'){
-    const t=document.getElementById('toast');
-    t.textContent='Сохранено!';
-    t.classList.add('show');
-    setTimeout(()=>t.classList.remove('show'), 1800);
-    url.searchParams.delete('saved');
-    history.replaceState({},'',url.toString());
-    formDirty=false; allowUnload=false;
-  }
-  if(url.searchParams.get('error')==='1'){
-    const t=document.getElementById('toast');
-    t.textContent='Ошибка сохранения';
-    t.classList.add('show','error');
-    setTimeout(()=>{t.classList.remove('show','error');}, 2200);
-    url.searchParams.delete('error');
-    history.replaceState({},'',url.toString());
-  }
-}
-
-document.addEventListener('DOMContentLoaded', ()=>{
-  ZeroUX(); armSaveForm(); toastOnSaved();
-});
-</script>
+<script src="{{ asset_url('js/input.js') }}"></script>
 </head><body>
 
 <div class="header" style="display:flex;gap:10px;align-items:center">
@@ -1226,6 +3464,8 @@ document.addEventListener('DOMContentLoaded', ()=>{
   <form method="post" action="/logout"><button class="btn">Выйти</button></form>
 </div>
 
+{% if error %}<div class="card err">{{error}}</div>{% endif %}
+
 <div class="card">
   <div style="font-weight:600;margin-bottom:6px">Выбор аккаунта</div>
   <div class="flex">
@@ -1332,90 +3572,12 @@ DASH_TPL = """
 <!doctype html><html><head>
 <meta charset="utf-8"><title>Отчёты</title>
 <meta name="viewport" content="width=device-width, initial-scale=1">
-<script src="https://cdn.jsdelivr.net/npm/chart.js@4.4.1/dist/chart.umd.min.js"></script>
-<script src="https://cdnjs.cloudflare.com/ajax/libs/html2canvas/1.4.1/html2canvas.min.js" crossorigin="anonymous"></script>
-<style>
-:root{--bg:#f6f7fb;--card:#fff;--primary:#2563eb;--muted:#6b7280;--pos:#0a8a0a;--neg:#c1121f;--line:#eef2f7}
-*{box-sizing:border-box}
-html,body{height:100%}
-body{font-family:Inter,Arial,sans-serif;background:var(--bg);margin:14px;color:#0f172a}
-.header,.card{background:#fff;border-radius:16px;box-shadow:0 10px 30px rgba(0,0,0,.06);padding:12px 14px}
-.flex{display:flex;gap:10px;flex-wrap:wrap;align-items:center}
-.btn{padding:8px 12px;border-radius:10px;border:1px solid #d1d5db;background:#fff;cursor:pointer}
-.btn.primary{background:var(--primary);color:#fff;border:none}
-.btn.ghost{background:#f3f4f6;border-color:#e5e7eb;color:#111827}
-table{border-collapse:separate;border-spacing:0;width:100%;border-radius:12px;overflow:hidden}
-th,td{border:1px solid var(--line);padding:8px 10px;text-align:right;white-space:nowrap}
-th{background:#f0f3fa}
-th.left, td.left{text-align:left}
-.roi-pos{color:var(--pos);font-weight:600}
-.roi-neg{color:var(--neg);font-weight:600}
-.small{color:var(--muted)}
-.subwrap{overflow:auto;max-width:100%}
-</style>
-<script>
-let currentGraphKey=null;
-
-function savePngFull(){
-  // снимок всей страницы, а не только блока
-  html2canvas(document.body,{scale:2,backgroundColor:'#ffffff',useCORS:true}).then(canvas=>{
-    const a=document.createElement('a'); a.href=canvas.toDataURL('image/png'); a.download='report.png'; a.click();
-  });
-}
-
-function buildChart(datasets, labels, title){
-  document.getElementById('chartTitle').textContent=title;
-  const ctx=document.getElementById('tsChart').getContext('2d');
-  if(window._chart) window._chart.destroy();
-  window._chart = new Chart(ctx,{
-    type:'line',
-    data:{labels,datasets},
-    options:{responsive:true, interaction:{mode:'index',intersect:false},
-      scales:{
-        y:{beginAtZero:true,title:{display:true,text:'USD / CAC'}},
-        y1:{beginAtZero:true,title:{display:true,text:'ROI %'},position:'right',grid:{drawOnChartArea:false}},
-        y2:{beginAtZero:true,title:{display:true,text:'FTD'},position:'right',grid:{drawOnChartArea:false}}
-      }
-    }
-  });
-}
-function setRange(preset){
-  const sd=document.querySelector('input[name="start_date"]');
-  const ed=document.querySelector('input[name="end_date"]');
-  const toLocalISO=(d)=>{const y=d.getFullYear(),m=String(d.getMonth()+1).padStart(2,'0'),dd=String(d.getDate()).padStart(2,'0');return `${y}-${m}-${dd}`};
-  const t=new Date(); let s,e;
-  if(preset==='today'){ s=new Date(t.getFullYear(),t.getMonth(),t.getDate()); e=new Date(s); }
-  else if(preset==='yesterday'){ e=new Date(t.getFullYear(),t.getMonth(),t.getDate()-1); s=new Date(e); }
-  else if(preset==='thisweek'){ const d=new Date(t.getFullYear(),t.getMonth(),t.getDate()); const w=(d.getDay()+6)%7; s=new Date(d.getFullYear(),d.getMonth(),d.getDate()-w); e=d; }
-  else if(preset==='thismonth'){ s=new Date(t.getFullYear(),t.getMonth(),1); e=new Date(t.getFullYear(),t.getMonth(),t.getDate()); }
-  else if(preset==='lastmonth'){ const y=t.getFullYear(),m=t.getMonth(); s=new Date(y,m-1,1); e=new Date(y,m,0); }
-  else return;
-  sd.value=toLocalISO(s); ed.value=toLocalISO(e); sd.form.submit();
-}
-function onGraph(key, title){
-  if(currentGraphKey===key){ currentGraphKey=null; document.getElementById('chartWrap').style.display='none'; return; }
-  currentGraphKey=key; document.getElementById('chartWrap').style.display='block';
-  const packs={ total: {{ts_total|safe}}, slots: {{ts_slots|safe}}, crash: {{ts_crash|safe}} };
-  const ts=packs[key]||packs.total; const labels={{labels|safe}};
-  buildChart([
-    {label:'Spend',data:ts.spend,yAxisID:'y',tension:.3},
-    {label:'Profit',data:ts.profit,yAxisID:'y',tension:.3},
-    {label:'CAC',data:ts.cac,yAxisID:'y',spanGaps:true,tension:.3},
-    {label:'FTD',data:ts.deps,yAxisID:'y2',tension:.3,stepped:true},
-    {label:'ROI %',data:ts.roi,yAxisID:'y1',tension:.3}
-  ], labels, title);
-}
-</script>
+<script src="{{ asset_url('vendor/chart.umd.min.js') }}"></script>
+<link rel="stylesheet" href="{{ asset_url('css/dashboard.css') }}">
+<script src="{{ asset_url('js/dashboard.js') }}"></script>
 </head><body>
 
 <div class="header" id="fullReport">
-  <style>
-    .toolbar{display:flex;gap:12px;flex-wrap:wrap;align-items:center}
-    .group{display:flex;gap:8px;align-items:center;background:#f8fafc;border:1px solid #e5e7eb;padding:8px 10px;border-radius:14px}
-    .group .title{font-size:12px;color:#6b7280;margin-right:6px;white-space:nowrap}
-    .linkbar{display:flex;gap:10px}
-    .linkbar .btn{padding:8px 10px}
-  </style>
 
   <!-- Навигация -->
   <div class="linkbar">
@@ -1491,7 +3653,8 @@ function onGraph(key, title){
   </form>
 </div>
 
-<div class="card" id="chartWrap" style="display:none;margin-top:12px">
+<div class="card" id="chartWrap" style="display:none;margin-top:12px"
+     data-api="{{ url_for('api_dashboard', start_date=start_date, end_date=end_date, selected_user=view_user, soc_id=sel_soc or '', cab_id=sel_cab or '') }}">
   <h3 id="chartTitle" style="margin:0 0 10px">Динамика</h3>
   <canvas id="tsChart" height="120"></canvas>
 </div>
@@ -1668,6 +3831,22 @@ function onGraph(key, title){
 </body></html>
 """
 
+# Шаблоны компилируются один раз при старте; render_template_string собирал
+# их из исходника на каждый запрос. JINJA_CACHE_DIR — опциональный кэш
+# байткода между перезапусками воркеров.
+TEMPLATES = {
+    "login.html": LOGIN_TPL,
+    "accounts.html": ACCOUNTS_TPL,
+    "input.html": INPUT_TPL,
+    "dashboard.html": DASH_TPL,
+}
+app.jinja_env.loader = ChoiceLoader([DictLoader(TEMPLATES), app.jinja_env.loader])
+if os.getenv("JINJA_CACHE_DIR"):
+    os.makedirs(os.environ["JINJA_CACHE_DIR"], exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(os.environ["JINJA_CACHE_DIR"])
+for _name in TEMPLATES:
+    app.jinja_env.get_template(_name)
+
 # ==================== Run ====================
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=PORT)
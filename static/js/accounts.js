@@ -0,0 +1,27 @@
+function userAction(form, val){
+  // только меняем action, отправка по кнопке OK
+  if(val === 'DEL'){
+    form.setAttribute('data-target', '/accounts/user_delete');
+  }else{
+    form.setAttribute('data-target', '/accounts/user_toggle');
+  }
+}
+function submitStatus(btn){
+  const form = btn.closest('form');
+  const sel  = form.querySelector('select[name="status_action"]');
+  const target = form.getAttribute('data-target') || '/accounts/user_toggle';
+  if(sel.value === 'DEL'){
+    if(!confirm('Удалить пользователя?')) return;
+    if(!confirm('Точно удалить?')) return;
+  }
+  // создаём скрытую «настоящую» форму для POST
+  const f = document.createElement('form');
+  f.method='post';
+  f.action=target;
+  const id = form.querySelector('input[name="id"]').value;
+  const hid = document.createElement('input'); hid.type='hidden'; hid.name='id'; hid.value=id; f.appendChild(hid);
+  if(sel.value !== 'DEL'){
+    const st = document.createElement('input'); st.type='hidden'; st.name='status_action'; st.value=sel.value; f.appendChild(st);
+  }
+  document.body.appendChild(f); f.submit();
+}
@@ -0,0 +1,101 @@
+let currentGraphKey=null;
+
+function copyFormState(src, dst){
+  // cloneNode не переносит введённые значения — пишем их в атрибуты копии
+  const a=src.querySelectorAll('input,select,textarea'), b=dst.querySelectorAll('input,select,textarea');
+  a.forEach((el,i)=>{
+    if(el.tagName==='SELECT') [...b[i].options].forEach((o,k)=>o.toggleAttribute('selected', k===el.selectedIndex));
+    else if(el.type==='checkbox'||el.type==='radio') b[i].toggleAttribute('checked', el.checked);
+    else if(el.tagName==='TEXTAREA') b[i].textContent=el.value;
+    else b[i].setAttribute('value', el.value);
+  });
+}
+
+function savePngFull(){
+  // снимок всей страницы без сторонних библиотек: DOM -> SVG foreignObject -> canvas.
+  // CSS страницы свой (same-origin) — встраиваем текстом, графики Chart.js переносим картинками
+  const scale=2, w=document.documentElement.scrollWidth, h=document.documentElement.scrollHeight;
+  const links=[...document.querySelectorAll('link[rel="stylesheet"]')];
+  Promise.all(links.map(l=>fetch(l.href).then(r=>r.text()))).then(sheets=>{
+    const body=document.body.cloneNode(true);
+    body.querySelectorAll('script').forEach(s=>s.remove());
+    const canvases=document.body.querySelectorAll('canvas');
+    body.querySelectorAll('canvas').forEach((c,i)=>{
+      const img=document.createElement('img');
+      img.src=canvases[i].toDataURL('image/png');
+      img.className=c.className;
+      img.style.cssText=`width:${canvases[i].clientWidth}px;height:${canvases[i].clientHeight}px`;
+      c.replaceWith(img);
+    });
+    copyFormState(document.body, body);
+    const style=document.createElement('style'); style.textContent=sheets.join('\n');
+    body.prepend(style);
+    body.style.margin='0'; body.style.width=w+'px'; body.style.background='#ffffff';
+    const svg=`<svg xmlns="http://www.w3.org/2000/svg" width="${w}" height="${h}">`+
+      `<foreignObject width="100%" height="100%">${new XMLSerializer().serializeToString(body)}</foreignObject></svg>`;
+    return new Promise((ok,fail)=>{
+      const img=new Image(); img.onload=()=>ok(img); img.onerror=fail;
+      img.src='data:image/svg+xml;charset=utf-8,'+encodeURIComponent(svg);
+    });
+  }).then(img=>{
+    const canvas=document.createElement('canvas'); canvas.width=w*scale; canvas.height=h*scale;
+    const ctx=canvas.getContext('2d'); ctx.scale(scale,scale);
+    ctx.fillStyle='#ffffff'; ctx.fillRect(0,0,w,h); ctx.drawImage(img,0,0);
+    const a=document.createElement('a'); a.href=canvas.toDataURL('image/png'); a.download='report.png'; a.click();
+  }).catch(err=>{
+    // Safari считает canvas с foreignObject «грязным» — toDataURL бросает SecurityError
+    console.error('PNG export failed', err);
+    alert('Не удалось сохранить PNG: браузер запретил снимок страницы. Попробуйте другой браузер или сделайте скриншот.');
+  });
+}
+
+function buildChart(datasets, labels, title){
+  document.getElementById('chartTitle').textContent=title;
+  const ctx=document.getElementById('tsChart').getContext('2d');
+  if(window._chart) window._chart.destroy();
+  window._chart = new Chart(ctx,{
+    type:'line',
+    data:{labels,datasets},
+    options:{responsive:true, interaction:{mode:'index',intersect:false},
+      scales:{
+        y:{beginAtZero:true,title:{display:true,text:'USD / CAC'}},
+        y1:{beginAtZero:true,title:{display:true,text:'ROI %'},position:'right',grid:{drawOnChartArea:false}},
+        y2:{beginAtZero:true,title:{display:true,text:'FTD'},position:'right',grid:{drawOnChartArea:false}}
+      }
+    }
+  });
+}
+function setRange(preset){
+  const sd=document.querySelector('input[name="start_date"]');
+  const ed=document.querySelector('input[name="end_date"]');
+  const toLocalISO=(d)=>{const y=d.getFullYear(),m=String(d.getMonth()+1).padStart(2,'0'),dd=String(d.getDate()).padStart(2,'0');return `${y}-${m}-${dd}`};
+  const t=new Date(); let s,e;
+  if(preset==='today'){ s=new Date(t.getFullYear(),t.getMonth(),t.getDate()); e=new Date(s); }
+  else if(preset==='yesterday'){ e=new Date(t.getFullYear(),t.getMonth(),t.getDate()-1); s=new Date(e); }
+  else if(preset==='thisweek'){ const d=new Date(t.getFullYear(),t.getMonth(),t.getDate()); const w=(d.getDay()+6)%7; s=new Date(d.getFullYear(),d.getMonth(),d.getDate()-w); e=d; }
+  else if(preset==='thismonth'){ s=new Date(t.getFullYear(),t.getMonth(),1); e=new Date(t.getFullYear(),t.getMonth(),t.getDate()); }
+  else if(preset==='lastmonth'){ const y=t.getFullYear(),m=t.getMonth(); s=new Date(y,m-1,1); e=new Date(y,m,0); }
+  else return;
+  sd.value=toLocalISO(s); ed.value=toLocalISO(e); sd.form.submit();
+}
+// ряды графиков грузятся из /api/dashboard при первом открытии графика
+let seriesReq=null;
+function loadSeries(){
+  if(!seriesReq) seriesReq=fetch(document.getElementById('chartWrap').dataset.api,{credentials:'same-origin'}).then(r=>{ if(!r.ok) throw new Error(r.status); return r.json(); });
+  return seriesReq;
+}
+function onGraph(key, title){
+  if(currentGraphKey===key){ currentGraphKey=null; document.getElementById('chartWrap').style.display='none'; return; }
+  currentGraphKey=key; document.getElementById('chartWrap').style.display='block';
+  loadSeries().then(d=>{
+    if(currentGraphKey!==key) return;
+    const ts=d.series[key]||d.series.total;
+    buildChart([
+      {label:'Spend',data:ts.spend,yAxisID:'y',tension:.3},
+      {label:'Profit',data:ts.profit,yAxisID:'y',tension:.3},
+      {label:'CAC',data:ts.cac,yAxisID:'y',spanGaps:true,tension:.3},
+      {label:'FTD',data:ts.deps,yAxisID:'y2',tension:.3,stepped:true},
+      {label:'ROI %',data:ts.roi,yAxisID:'y1',tension:.3}
+    ], d.labels, title);
+  }).catch(()=>{ seriesReq=null; document.getElementById('chartTitle').textContent='Не удалось загрузить данные графика'; });
+}
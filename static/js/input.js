@@ -0,0 +1,67 @@
+let formDirty=false;
+let allowUnload=false;
+
+function markDirty(){ formDirty=true; }
+
+function go(href){
+  if(!formDirty || confirm('Есть несохранённые изменения. Уйти без сохранения?')){
+    window.location = href;
+  }
+}
+
+window.onbeforeunload = function(e){
+  if(!formDirty || allowUnload) return;
+  e.preventDefault(); e.returnValue=''; return '';
+};
+
+function onDateChange(form){
+  if(!formDirty || confirm('Есть несохранённые изменения. Переключить дату без сохранения?')){
+    window.location = form.action;
+  }
+}
+
+// «0 UX»: при фокусе очищаем 0, при blur возвращаем 0, если пусто
+function ZeroUX(){
+  document.querySelectorAll('input[type="number"]').forEach(el=>{
+    el.addEventListener('focus', function(){
+      if(this.value==='0' || this.value==='0.0' || this.value==='0.00') this.value='';
+    });
+    el.addEventListener('blur', function(){
+      if(this.value.trim()==='') this.value='0';
+    });
+  });
+}
+
+function armSaveForm(){
+  const f=document.getElementById('saveForm');
+  if(!f) return;
+  f.addEventListener('submit', ()=>{
+    allowUnload=true;
+    window.onbeforeunload = null;
+  });
+}
+
+function toastOnSaved(){
+  const url = new URL(window.location.href);
+  if(url.searchParams.get('saved')==='1'){
+    const t=document.getElementById('toast');
+    t.textContent='Сохранено!';
+    t.classList.add('show');
+    setTimeout(()=>t.classList.remove('show'), 1800);
+    url.searchParams.delete('saved');
+    history.replaceState({},'',url.toString());
+    formDirty=false; allowUnload=false;
+  }
+  if(url.searchParams.get('error')==='1'){
+    const t=document.getElementById('toast');
+    t.textContent='Ошибка сохранения';
+    t.classList.add('show','error');
+    setTimeout(()=>{t.classList.remove('show','error');}, 2200);
+    url.searchParams.delete('error');
+    history.replaceState({},'',url.toString());
+  }
+}
+
+document.addEventListener('DOMContentLoaded', ()=>{
+  ZeroUX(); armSaveForm(); toastOnSaved();
+});
@@ -0,0 +1,73 @@
+"""Shared fixtures: main.py imported once against a throwaway database."""
+import os
+import sys
+import tempfile
+import threading
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_TMP = tempfile.mkdtemp(prefix="statka-test-")
+os.environ["DATA_PATH"] = os.path.join(_TMP, "test.db")   # никогда не рабочая data.db
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+os.chdir(_TMP)  # main.py создаёт ./backups
+sys.path.insert(0, ROOT)
+
+import main  # noqa: E402
+
+PASSWORD = "pw"
+
+
+@pytest.fixture(scope="session")
+def m():
+    return main
+
+
+def make_buyer(username: str, socs: int, cabs_per_soc: int, dates=("2024-01-01",)) -> dict:
+    """Buyer with `socs` SOCs of `cabs_per_soc` cabinets and one record per cabinet, GEO and date."""
+    ph = main.hash_password(PASSWORD)
+    cabs = []
+    with main.pool.connection() as conn, main.write_tx(conn):
+        uid = conn.execute("INSERT INTO users (username, password_hash, role) VALUES (?,?,?)",
+                           (username, ph, "BUYER")).lastrowid
+        for s in range(socs):
+            soc_id = conn.execute("INSERT INTO socs (user_id, name) VALUES (?,?)",
+                                  (uid, f"{username}-soc{s}")).lastrowid
+            for k in range(cabs_per_soc):
+                cab_id = conn.execute("""
+                    INSERT INTO cabinets (soc_id, name, currency, cab_type) VALUES (?,?,?,?)
+                """, (soc_id, f"{username}-s{s}-c{k}", "EUR", "AGENCY")).lastrowid
+                cabs.append(conn.execute("SELECT * FROM cabinets WHERE id=?", (cab_id,)).fetchone())
+        rows = [main.build_record_row(username, uid, d, "Germany", v, cab, 100.0, 2, 1.1, "2024-01-01 00:00:00")
+                for cab in cabs for d in dates for v in ("Slots", "Crash")]
+        conn.executemany(main.UPSERT_RECORDS_SQL, rows)
+    return {"id": uid, "username": username, "cabs": cabs}
+
+
+def login(client, username: str, password: str = PASSWORD):
+    resp = client.post("/", data={"username": username, "password": password})
+    assert resp.status_code == 302, resp.status_code
+    return client
+
+
+@pytest.fixture
+def statements(monkeypatch):
+    """SQL statements run on pooled connections by the test thread (background writers excluded)."""
+    seen = []
+    test_thread = threading.current_thread()
+    acquire, release = main.pool.acquire, main.pool.release
+
+    def traced_acquire():
+        conn = acquire()
+        if threading.current_thread() is test_thread:
+            conn.set_trace_callback(seen.append)
+        return conn
+
+    def untraced_release(conn):
+        conn.set_trace_callback(None)
+        release(conn)
+
+    monkeypatch.setattr(main.pool, "acquire", traced_acquire)
+    monkeypatch.setattr(main.pool, "release", untraced_release)
+    return seen
@@ -0,0 +1,23 @@
+"""Hashed static assets: each content coding gets its own strong ETag."""
+
+
+def test_etag_carries_content_coding(m):
+    client = m.app.test_client()
+    digest = m.ASSETS["js/dashboard.js"].digest
+    url = f"/assets/{digest}/js/dashboard.js"
+
+    plain = client.get(url)
+    assert plain.headers.get("Content-Encoding") is None
+    assert plain.headers["ETag"] == f'"{digest}"'
+
+    gz = client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert gz.headers["Content-Encoding"] == "gzip"
+    assert gz.headers["ETag"] == f'"{digest}-gzip"'
+    assert gz.data != plain.data
+
+    assert client.get(url, headers={"Accept-Encoding": "gzip",
+                                    "If-None-Match": f'"{digest}-gzip"'}).status_code == 304
+    # кэш хранит несжатое тело — на сжатый запрос оно не годится
+    assert client.get(url, headers={"Accept-Encoding": "gzip",
+                                    "If-None-Match": f'"{digest}"'}).status_code == 200
+    assert client.get(url, headers={"If-None-Match": f'"{digest}"'}).status_code == 304
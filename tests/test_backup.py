@@ -0,0 +1,44 @@
+"""Backups: a consistent snapshot under concurrent writes, /backup for admins only."""
+import sqlite3
+import threading
+
+from conftest import login, make_buyer
+
+
+def test_snapshot_under_steady_writes(m, tmp_path):
+    stop = threading.Event()
+
+    def writer():
+        conn = sqlite3.connect(m.DB_PATH)
+        while not stop.is_set():
+            with conn:
+                conn.execute("INSERT INTO counters (name, value) VALUES ('backup_test', 1) "
+                             "ON CONFLICT(name) DO UPDATE SET value=value+1")
+        conn.close()
+
+    t = threading.Thread(target=writer)
+    t.start()
+    try:
+        dest = str(tmp_path / "snap.db")
+        m.snapshot_db(dest)
+    finally:
+        stop.set()
+        t.join()
+    conn = sqlite3.connect(dest)
+    assert conn.execute("PRAGMA integrity_check").fetchone()[0] == "ok"
+    assert conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] >= 1
+    conn.close()
+
+
+def test_backup_route_admin_only_and_head_without_snapshot(m, monkeypatch):
+    make_buyer("backup_buyer", socs=1, cabs_per_soc=1, dates=())
+    assert login(m.app.test_client(), "backup_buyer").get("/backup").status_code == 403
+    admin = login(m.app.test_client(), "ADMIN_HEAD", "chinCHIN")
+
+    def no_snapshot(_):
+        raise AssertionError("HEAD must not snapshot")
+
+    monkeypatch.setattr(m, "snapshot_db", no_snapshot)
+    resp = admin.head("/backup")
+    assert resp.status_code == 200
+    assert "attachment" in resp.headers["Content-Disposition"]
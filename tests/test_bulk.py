@@ -0,0 +1,39 @@
+"""POST /input/bulk: bad rows are reported per row, the rest of the request still saves."""
+import json
+
+from conftest import login, make_buyer
+
+
+def test_bulk_reports_every_row(m):
+    me = make_buyer("bulk_buyer", socs=1, cabs_per_soc=1, dates=())
+    other = make_buyer("bulk_other", socs=1, cabs_per_soc=1, dates=())
+    cab, foreign = me["cabs"][0]["id"], other["cabs"][0]["id"]
+    with m.pool.connection() as conn, m.write_tx(conn):
+        conn.execute("INSERT INTO day_locks (user_id, date) VALUES (?, '2024-04-02')", (me["id"],))
+
+    def row(**kw):
+        base = {"date": "2024-04-01", "cabinet_id": cab, "geo": "Germany", "vertical": "Slots",
+                "spend": 100, "deps": 2}
+        return json.dumps(dict(base, **kw))
+
+    rows = [
+        row(),                                    # 0 saved
+        row(geo=["Germany"]),                     # 1 invalid: geo не строка
+        row(vertical={"v": "Slots"}),             # 2 invalid: vertical не строка
+        row(spend=float("nan")),                  # 3 invalid: NaN
+        row().replace('"spend": 100', '"spend": 1e400'),  # 4 invalid: inf
+        row(deps=10**12),                         # 5 invalid: слишком много депозитов
+        row(date="2024-04-02"),                   # 6 rejected: день закрыт
+        row(cabinet_id=foreign),                  # 7 rejected: чужой кабинет
+    ]
+    client = login(m.app.test_client(), "bulk_buyer")
+    resp = client.post("/input/bulk", data="\n".join(rows), content_type="application/x-ndjson")
+    assert resp.status_code == 200, resp.get_data(as_text=True)
+    body = resp.get_json()
+    assert [r["status"] for r in body["rows"]] == ["saved"] + ["invalid"] * 5 + ["rejected"] * 2
+    assert body["rows"][6]["error"] == "day locked"
+    assert body["rows"][7]["error"] == "unknown cabinet"
+    with m.pool.connection() as conn:
+        saved = conn.execute("SELECT date, cabinet_id, spend_raw FROM records WHERE user=?",
+                             ("bulk_buyer",)).fetchall()
+    assert [tuple(r) for r in saved] == [("2024-04-01", cab, 100)]
@@ -0,0 +1,70 @@
+"""Export formats: NDJSON keeps NULLs and numeric types."""
+import json
+
+from conftest import login, make_buyer
+
+
+def test_ndjson_rows_are_typed(m):
+    buyer = make_buyer("ndjson_buyer", socs=1, cabs_per_soc=1, dates=("2024-02-01",))
+    with m.pool.connection() as conn, m.write_tx(conn):
+        # легаси-строка без кабинета
+        conn.execute("""
+            INSERT INTO records (user, user_id, date, geo, vertical, spend_raw, spend_currency,
+                                 spend_usd, deps, revenue, profit)
+            VALUES (?, ?, '2024-02-02', 'Germany', 'Slots', 50, 'USD', 50.0, 1, 250, 200)
+        """, ("ndjson_buyer", buyer["id"]))
+    client = login(m.app.test_client(), "ndjson_buyer")
+    resp = client.get("/export_csv?start=2024-02-01&end=2024-02-02&format=ndjson")
+    assert resp.status_code == 200
+    rows = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+    assert len(rows) == 3
+    legacy = rows[-1]
+    assert legacy["cabinet"] is None
+    assert legacy["updated_at"] is None
+    assert all(isinstance(r["cabinet"], int) for r in rows[:-1])
+    for r in rows:
+        assert isinstance(r["spend_raw"], float) and isinstance(r["spend_usd"], float)
+        assert all(isinstance(r[k], int) for k in ("deps", "revenue", "profit"))
+
+
+def test_batched_export_matches_single_batch_and_holds_no_connection(m, monkeypatch):
+    make_buyer("batch_buyer", socs=2, cabs_per_soc=3, dates=("2024-03-01", "2024-03-02"))
+    client = login(m.app.test_client(), "batch_buyer")
+    url = "/export_csv?start=2024-03-01&end=2024-03-02"
+    whole = client.get(url).get_data(as_text=True)
+    assert whole.count("\n") == 1 + 2 * 3 * 2 * 2
+
+    held = []
+    acquire, release = m.pool.acquire, m.pool.release
+    monkeypatch.setattr(m.pool, "acquire", lambda: held.append(1) or acquire())
+    monkeypatch.setattr(m.pool, "release", lambda conn: (held.pop(), release(conn)))
+    monkeypatch.setattr(m, "EXPORT_CHUNK_ROWS", 5)
+    resp = client.get(url, buffered=False)
+    parts = []
+    for chunk in resp.response:
+        parts.append(chunk.decode() if isinstance(chunk, bytes) else chunk)
+        assert held == []   # между батчами соединение в пуле
+    resp.close()
+    assert len(parts) > 3
+    assert "".join(parts) == whole
+
+
+def test_batch_boundary_on_null_key_loses_nothing(m, monkeypatch):
+    # легаси-строки без кабинета, часть — с NULL geo/vertical
+    with m.pool.connection() as conn, m.write_tx(conn):
+        for i, (geo, vertical) in enumerate([(None, "Slots"), (None, "Slots"), ("Austria", None),
+                                             ("Austria", "Crash"), ("Germany", "Slots"),
+                                             ("Italy", "Crash")]):
+            conn.execute("""
+                INSERT INTO records (user, date, geo, vertical, spend_raw, spend_usd, deps, revenue, profit)
+                VALUES ('legacy_user', '2024-05-01', ?, ?, ?, ?, 0, 0, 0)
+            """, (geo, vertical, i, float(i)))
+    for user in ("legacy_user", "ALL"):
+        url = f"/export_csv?start=2024-05-01&end=2024-05-01&user={user}&format=ndjson"
+        client = login(m.app.test_client(), "ADMIN_HEAD", "chinCHIN")
+        monkeypatch.setattr(m, "EXPORT_CHUNK_ROWS", 10000)
+        whole = client.get(url).get_data(as_text=True)
+        assert whole.count("\n") == 6
+        for size in (1, 2, 3):
+            monkeypatch.setattr(m, "EXPORT_CHUNK_ROWS", size)
+            assert client.get(url).get_data(as_text=True) == whole, (user, size)
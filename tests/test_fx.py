@@ -0,0 +1,72 @@
+"""FX: table reloads on the request connection, rate validation, recompute vs form save."""
+
+from conftest import login, make_buyer
+
+
+def test_reload_uses_request_connection(m, monkeypatch):
+    with m.pool.connection() as conn, m.write_tx(conn):
+        conn.execute("INSERT OR REPLACE INTO fx_rates (date, from_currency, to_currency, rate) "
+                     "VALUES ('2024-01-01', 'EUR', 'USD', 1.25)")
+        m.bump_counter(conn, "fx")
+    with m.app.test_request_context("/"):
+        m.db()   # соединение запроса уже взято
+
+        def no_second_connection():
+            raise AssertionError("fx_table() took a second pooled connection")
+
+        monkeypatch.setattr(m.pool, "acquire", no_second_connection)
+        assert m.fx_table().rate("2024-01-05", "EUR") == 1.25
+        monkeypatch.undo()
+
+
+def _admin(m):
+    return login(m.app.test_client(), "ADMIN_HEAD", "chinCHIN")
+
+
+def test_fx_set_rejects_bad_rate_without_writing(m, monkeypatch):
+    def no_recompute(*a, **kw):
+        raise AssertionError("bad rate must not schedule a recompute")
+
+    monkeypatch.setattr(m, "schedule_fx_recompute", no_recompute)
+    admin = _admin(m)
+    for form in ({"date": "2024-07-01"}, {"date": "2024-07-01", "eurusd": "abc"},
+                 {"date": "2024-07-01", "eurusd": "0"}, {"date": "2024-07-01", "eurusd": "-1.1"},
+                 {"date": "2024-07-01", "eurusd": "inf"}, {"date": "01.07.2024", "eurusd": "1.1"}):
+        assert admin.post("/accounts/fx_set", data=form).status_code == 400, form
+    with m.pool.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM fx_rates WHERE date='2024-07-01'").fetchone()[0] == 0
+
+
+def test_recompute_matches_form_save(m, monkeypatch):
+    buyer = make_buyer("fx_buyer", socs=1, cabs_per_soc=1, dates=())
+    cab = buyer["cabs"][0]
+    jobs = []
+    monkeypatch.setattr(m, "schedule_fx_recompute", lambda d, currency="EUR": jobs.append(
+        {"id": "test", "currency": currency, "from_date": d,
+         "to_date": m.fx_table().next_date(d, currency), "dates_done": 0, "rows_updated": 0}) or jobs[-1])
+    monkeypatch.setattr(m, "RECOMPUTE_PAUSE", 0)
+    admin = _admin(m)
+    assert admin.post("/accounts/fx_set", data={"date": "2024-06-01", "eurusd": "1.1"}).status_code == 302
+
+    form = {"date": "2024-06-03", "soc_id": cab["soc_id"], "cab_id": cab["id"]}
+    for i, geo in enumerate(m.GEOS):
+        form.update({f"spend_slots_{geo}": f"{100 + i}.37", f"deps_slots_{geo}": i % 4,
+                     f"spend_crash_{geo}": f"{55 + i}.5", f"deps_crash_{geo}": i % 3})
+    client = login(m.app.test_client(), "fx_buyer")
+    assert client.post("/input/save", data=form).status_code == 302
+
+    assert admin.post("/accounts/fx_set", data={"date": "2024-06-01", "eurusd": "1.2345"}).status_code == 302
+    m.recompute_fx(jobs[-1])
+    assert jobs[-1]["rows_updated"] > 0
+
+    expected = {}
+    for i, geo in enumerate(m.GEOS):
+        for vertical, spend, deps in (("Slots", 100 + i + 0.37, i % 4), ("Crash", 55 + i + 0.5, i % 3)):
+            row = m.build_record_row("fx_buyer", buyer["id"], "2024-06-03", geo, vertical, cab,
+                                     float(f"{spend:.2f}"), deps, 1.2345, "-")
+            if row is not None:
+                expected[(geo, vertical)] = (row[8], row[11], row[12])   # spend, profit, spend_usd
+    with m.pool.connection() as conn:
+        got = {(r["geo"], r["vertical"]): (r["spend"], r["profit"], r["spend_usd"])
+               for r in conn.execute("SELECT * FROM records WHERE user='fx_buyer'")}
+    assert got == expected
@@ -0,0 +1,34 @@
+"""The SQLite-backed login limiter works on the request's connection."""
+import threading
+
+from conftest import make_buyer
+
+
+def test_sqlite_limiter_uses_request_connection(m, monkeypatch):
+    make_buyer("limited_buyer", socs=1, cabs_per_soc=1, dates=())
+    monkeypatch.setattr(m, "login_limiter", m.LoginLimiter(m.SqliteLimitStore()))
+    test_thread = threading.current_thread()
+    held, peak = [0], [0]
+    acquire, release = m.pool.acquire, m.pool.release
+
+    def counting_acquire():
+        if threading.current_thread() is test_thread:
+            held[0] += 1
+            peak[0] = max(peak[0], held[0])
+        return acquire()
+
+    def counting_release(conn):
+        if threading.current_thread() is test_thread:
+            held[0] -= 1
+        release(conn)
+
+    monkeypatch.setattr(m.pool, "acquire", counting_acquire)
+    monkeypatch.setattr(m.pool, "release", counting_release)
+    client = m.app.test_client()
+    resp = client.post("/", data={"username": "limited_buyer", "password": "wrong"})
+    assert resp.status_code == 200
+    resp = client.post("/", data={"username": "limited_buyer", "password": "pw"})
+    assert resp.status_code == 302
+    assert peak[0] == 1   # одно соединение на запрос: лимитер не берёт второе из пула
+    with m.pool.connection() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM login_limits WHERE key LIKE '%limited_buyer'").fetchone()[0]
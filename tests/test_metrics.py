@@ -0,0 +1,14 @@
+"""With METRICS_DIR set, every worker writes snapshots, not only the one serving /metrics."""
+import os
+import time
+
+
+def test_first_request_starts_snapshots(m, monkeypatch, tmp_path):
+    monkeypatch.setattr(m, "METRICS_DIR", str(tmp_path))
+    monkeypatch.setattr(m, "_metrics_thread_pid", None)
+    assert m.app.test_client().get("/health").status_code == 200
+    path = tmp_path / f"worker-{os.getpid()}.json"
+    deadline = time.monotonic() + 5
+    while not path.exists() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert path.exists()
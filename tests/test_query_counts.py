@@ -0,0 +1,28 @@
+"""Statements per page must not grow with the number of SOCs and cabinets (no N+1)."""
+import pytest
+
+from conftest import login, make_buyer
+
+PAGES = ("/input?date=2024-01-01", "/accounts", "/dashboard?start_date=2024-01-01&end_date=2024-01-31")
+
+
+@pytest.fixture(scope="module")
+def buyers():
+    return make_buyer("one_soc", socs=1, cabs_per_soc=1), make_buyer("many_socs", socs=12, cabs_per_soc=4)
+
+
+def _count(m, statements, username, path):
+    client = login(m.app.test_client(), username)
+    assert client.get(path).status_code == 200   # прогрев: курсы FX, кэши процесса
+    statements.clear()
+    assert client.get(path).status_code == 200
+    return len(statements)
+
+
+@pytest.mark.parametrize("path", PAGES)
+def test_statements_do_not_grow_with_socs(m, statements, buyers, path, monkeypatch):
+    monkeypatch.setattr(m.dash_cache, "max_bytes", 0)   # дашборд считается заново
+    small = _count(m, statements, "one_soc", path)
+    large = _count(m, statements, "many_socs", path)
+    assert small > 0
+    assert small == large, (small, large)
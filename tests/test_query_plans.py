@@ -0,0 +1,24 @@
+"""Hot queries are served by indexes: no table scans, exports read covering indexes only."""
+import pytest
+
+import main
+
+EXPORTS = [name for name, _, _ in main.hot_queries() if name.startswith("export.")]
+
+
+def _plans(m):
+    with m.pool.connection() as conn:
+        return {name: [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+                for name, sql, params in m.hot_queries()}
+
+
+def test_no_full_scans(m):
+    with m.pool.connection() as conn:
+        assert m.full_scans(conn) == []
+
+
+@pytest.mark.parametrize("name", EXPORTS)
+def test_export_reads_covering_index_in_order(m, name):
+    plan = _plans(m)[name]
+    assert "COVERING INDEX" in plan[0], plan
+    assert not any("TEMP B-TREE" in line for line in plan), plan